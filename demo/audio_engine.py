@@ -0,0 +1,294 @@
+"""Module audio_engine
+
+Plays audio through one long-lived mpg123 per output device instead of
+starting a player for every clip.
+"""
+import heapq
+import itertools
+import logging
+import subprocess
+import threading
+import time
+
+# Playback priorities. A clip preempts a playing clip of lower priority.
+PRIORITY_MUSIC = 0
+PRIORITY_SPEECH = 10
+
+
+# pylint: disable=too-many-instance-attributes
+class AudioPlayer():
+    """Queue of clips played by an mpg123 in remote control mode.
+
+    The player process is started once and kept running, so starting a
+    clip is a LOAD command to a decoder that is already loaded rather
+    than a process spawn. If the process dies it is started again.
+    """
+
+    def __init__(self, device, command=("mpg123", "-R")):
+        self.device = device
+        self.command = list(command)
+        self.process = None
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.queue = []
+        self.sequence = itertools.count()
+        self.current = None
+        self.state = "stopped"
+        self.started = False
+        self.threads = []
+        self.counters = {
+            "played": 0,
+            "preempted": 0,
+            "stopped": 0,
+            "errors": 0,
+            "restarts": 0,
+        }
+        self.start_latency_ms = None
+
+    def start(self):
+        """Start the player process and its threads.
+
+        Raises OSError if the player cannot be started.
+        """
+        with self.condition:
+            if self.started:
+                return
+            self.spawn()
+            self.started = True
+        for target, name in ((AudioPlayer.read_loop, "reader"),
+                             (AudioPlayer.play_loop, "queue")):
+            thread = threading.Thread(
+                target=target,
+                args=(self, ),
+                name=f"audio-{name}-{self.device}",
+                daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def spawn(self):
+        """Start the mpg123 process. Call with the condition held."""
+        logging.info("Starting audio player for %s", self.device)
+        # pylint: disable=consider-using-with
+        self.process = subprocess.Popen(
+            self.command + ["-a", self.device],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1
+        )
+        # Do not report the progress of every frame
+        self.send("SILENCE")
+
+    def send(self, command):
+        """Send a command to the player process."""
+        with self.write_lock:
+            try:
+                self.process.stdin.write(command + "\n")
+                self.process.stdin.flush()
+            except (OSError, ValueError) as error:
+                logging.error("Audio player for %s: %s", self.device, error)
+
+    def play(self, path, priority=PRIORITY_MUSIC, interrupt=False):
+        """Queue a clip.
+
+        Clips play in priority order, first come first served within a
+        priority. A playing clip of lower priority is stopped. With
+        interrupt, the playing clip and the queued clips of the same or
+        lower priority are dropped as well.
+        """
+        self.start()
+        with self.condition:
+            if interrupt:
+                self.queue = [item for item in self.queue
+                              if -item[0] > priority]
+                heapq.heapify(self.queue)
+            heapq.heappush(
+                self.queue,
+                (-priority, next(self.sequence), path, time.monotonic())
+            )
+            current = self.current
+            if current is not None and (
+                current["priority"] < priority
+                or (interrupt and current["priority"] <= priority)
+            ):
+                current["ending"] = "preempted"
+                self.send("STOP")
+            self.condition.notify_all()
+
+    def stop(self):
+        """Stop the playing clip and drop the queued clips."""
+        with self.condition:
+            self.queue = []
+            if self.current is not None:
+                self.current["ending"] = "stopped"
+                self.send("STOP")
+
+    def play_loop(self):
+        """Thread that loads the next clip when the player is idle."""
+        while True:
+            with self.condition:
+                while self.current is not None or not self.queue:
+                    self.condition.wait()
+                priority, _, path, queued = heapq.heappop(self.queue)
+                self.current = {
+                    "path": path,
+                    "priority": -priority,
+                    "waited_ms": round((time.monotonic() - queued) * 1000,
+                                       1),
+                    "loaded": time.monotonic(),
+                    "playing": False,
+                    "ending": "played",
+                }
+                self.send(f"LOAD {path}")
+
+    def read_loop(self):
+        """Thread that follows the player's status messages."""
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                # The player died, so start another one
+                logging.error("Audio player for %s exited", self.device)
+                with self.condition:
+                    self.finish("error")
+                self.respawn()
+                continue
+            self.handle(line.strip())
+
+    def respawn(self):
+        """Start the player process again, retrying until it starts."""
+        while True:
+            time.sleep(1)
+            with self.condition:
+                try:
+                    self.spawn()
+                except OSError as error:
+                    logging.error("Could not restart audio player for %s: %s",
+                                  self.device, error)
+                    continue
+                self.counters["restarts"] += 1
+                return
+
+    def handle(self, line):
+        """Handle one status message from the player."""
+        with self.condition:
+            current = self.current
+            if line.startswith("@P"):
+                state = line[3:].strip()
+                if state == "2" and current is not None:
+                    if not current["playing"]:
+                        current["playing"] = True
+                        self.start_latency_ms = round(
+                            (time.monotonic() - current["loaded"]) * 1000, 1
+                        )
+                    self.state = "playing"
+                elif state == "1":
+                    self.state = "paused"
+                elif (
+                    state in ("0", "3")
+                    and current is not None
+                    and current["playing"]
+                ):
+                    # A stop sent while idle also reports @P 0, so only
+                    # a clip that started playing can end
+                    self.finish(current["ending"])
+            elif line.startswith("@E"):
+                logging.error("Audio player for %s: %s", self.device, line)
+                if current is not None:
+                    self.finish("error")
+
+    def finish(self, how):
+        """The current clip ended. Call with the condition held.
+
+        how is "played", "preempted", "stopped" or "error".
+        """
+        if self.current is not None:
+            self.counters["errors" if how == "error" else how] += 1
+        self.current = None
+        self.state = "stopped"
+        self.condition.notify_all()
+
+    def status(self):
+        """Return what the player is doing."""
+        with self.condition:
+            current = dict(self.current) if self.current else None
+            queue = [
+                {"path": path, "priority": -priority}
+                for priority, _, path, _ in sorted(self.queue)
+            ]
+            return {
+                "device": self.device,
+                "pid": self.process.pid if self.process else None,
+                "state": self.state,
+                "current": current,
+                "queue": queue,
+                "start_latency_ms": self.start_latency_ms,
+                **self.counters,
+            }
+
+
+class AudioEngine():
+    """One AudioPlayer per output device, started on first use.
+
+    Every stop() starts a new generation. A clip prepared before the stop,
+    such as speech still being synthesized, is dropped when it is played
+    with its older generation.
+    """
+
+    def __init__(self, command=("mpg123", "-R")):
+        self.command = command
+        self.lock = threading.Lock()
+        self.players = {}
+        self.generation = 0
+
+    def player(self, device):
+        """Return the running player of a device."""
+        with self.lock:
+            player = self.players.get(device)
+            if player is None:
+                player = self.players[device] = AudioPlayer(device,
+                                                            self.command)
+        player.start()
+        return player
+
+    def prewarm(self, devices):
+        """Start the players of devices before they are needed."""
+        for device in devices:
+            self.player(device)
+
+    # pylint: disable=too-many-arguments
+    def play(self, device, path, priority=PRIORITY_MUSIC, interrupt=False,
+             generation=None):
+        """Queue a clip on a device.
+
+        Returns False if the device has no player, or if the audio was
+        stopped since generation.
+        """
+        try:
+            player = self.player(device)
+            with self.lock:
+                if generation is not None and generation != self.generation:
+                    logging.info("Not playing %s, the audio was stopped",
+                                 path)
+                    return False
+                player.play(path, priority, interrupt)
+        except OSError as error:
+            logging.error("Could not play %s on %s: %s", path, device, error)
+            return False
+        return True
+
+    def stop(self):
+        """Stop and clear every player, and drop the clips in preparation."""
+        with self.lock:
+            self.generation += 1
+            players = list(self.players.values())
+        for player in players:
+            player.stop()
+
+    def status(self):
+        """Return the status of every player."""
+        with self.lock:
+            players = list(self.players.values())
+        return {"players": [player.status() for player in players]}
+
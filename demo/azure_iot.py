@@ -4,45 +4,382 @@
 
 import json
 import os
+import sys
 import asyncio
 import argparse
-from azure.iot.device.aio import IoTHubModuleClient
+import copy
+import atexit
+import collections
+import logging
+import threading
+import time
 
 
-async def connect():
-    """Connect to the hub."""
-    module_client = IoTHubModuleClient.create_from_edge_environment(
+class LocalModuleClient():
+    """Local stand-in for IoTHubModuleClient.
+
+    Records every message sent so output throughput can be measured
+    without an edge hub.
+    """
+
+    def __init__(self, twin=None, latency=0.0):
+        if twin is None:
+            twin = {
+                "desired": {"inputs": {}, "device": {"sensors": {}}},
+                "reported": {}
+            }
+        self.twin = twin
+        self.latency = latency
+        self.online = True
+        self.connected = False
+        self.on_twin_desired_properties_patch_received = None
+        self.messages = []
+        self.bytes_sent = 0
+        self.first_sent = None
+        self.last_sent = None
+
+    async def connect(self):
+        """Pretend to connect to the hub."""
+        await asyncio.sleep(self.latency)
+        if not self.online:
+            raise ConnectionError("Local hub is offline")
+        self.connected = True
+
+    async def disconnect(self):
+        """Pretend to disconnect from the hub."""
+        self.connected = False
+
+    async def get_twin(self):
+        """Return a copy of the local twin."""
+        await asyncio.sleep(self.latency)
+        return copy.deepcopy(self.twin)
+
+    async def patch_twin_reported_properties(self, patch):
+        """Merge a patch into the reported properties."""
+        await asyncio.sleep(self.latency)
+        self.twin.setdefault("reported", {}).update(patch)
+
+    async def send_message_to_output(self, msg, output_name):
+        """Record a message sent to an output."""
+        await asyncio.sleep(self.latency)
+        if not self.online:
+            self.connected = False
+            raise ConnectionError("Local hub is offline")
+        now = time.monotonic()
+        if self.first_sent is None:
+            self.first_sent = now
+        self.last_sent = now
+        self.messages.append((output_name, msg))
+        self.bytes_sent += len(msg)
+
+    def push_desired_patch(self, patch):
+        """Apply a desired property patch and deliver it to the handler."""
+        desired = self.twin.setdefault("desired", {})
+        version = desired.get("$version", 1) + 1
+        patch = dict(patch, **{"$version": version})
+        merge_patch_into(desired, patch)
+        handler = self.on_twin_desired_properties_patch_received
+        if handler is not None and self.connected:
+            handler(patch)
+
+    def throughput(self):
+        """Return the messages and bytes sent with their rates."""
+        elapsed = 0.0
+        if self.first_sent is not None:
+            elapsed = self.last_sent - self.first_sent
+        messages = len(self.messages)
+        return {
+            "messages": messages,
+            "bytes": self.bytes_sent,
+            "seconds": elapsed,
+            "messagesPerSecond": messages / elapsed if elapsed else 0.0,
+            "bytesPerSecond": self.bytes_sent / elapsed if elapsed else 0.0,
+        }
+
+
+def merge_patch_into(target, patch):
+    """Merge a twin patch into target in place. None removes a key."""
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_patch_into(target[key], value)
+        else:
+            target[key] = value
+
+
+# Set by use_local_hub() to route all hub traffic to a stand-in client
+LOCAL_HUB = None
+
+
+def use_local_hub(client=None):
+    """Route hub traffic to a LocalModuleClient and return it."""
+    # pylint: disable=global-statement
+    global LOCAL_HUB
+    LOCAL_HUB = client if client is not None else LocalModuleClient()
+    return LOCAL_HUB
+
+
+def create_client():
+    """Create the module client, or the local stand-in if enabled."""
+    if LOCAL_HUB is None and os.getenv("OPTRA_LOCAL_HUB"):
+        use_local_hub()
+    if LOCAL_HUB is not None:
+        return LOCAL_HUB
+    # pylint: disable=import-outside-toplevel
+    from azure.iot.device.aio import IoTHubModuleClient
+    return IoTHubModuleClient.create_from_edge_environment(
         websockets=True
     )
-    await module_client.connect()
-    return module_client
+
+
+def retryable_errors(client):
+    """Return the errors of client that mean it must be reconnected."""
+    if client is None or isinstance(client, LocalModuleClient):
+        return (ConnectionError, )
+    # The azure sdk is slow to import, so load it when the hub is first used
+    # pylint: disable=import-outside-toplevel
+    from azure.iot.device import exceptions as iot_exceptions
+    return (
+        ConnectionError,
+        iot_exceptions.ConnectionFailedError,
+        iot_exceptions.ConnectionDroppedError,
+        iot_exceptions.OperationTimeout,
+        iot_exceptions.OperationCancelled,
+    )
+
+
+# pylint: disable=too-many-instance-attributes
+class ModuleConnection():
+    """A single long-lived module client.
+
+    The client is owned by an asyncio loop running in a background
+    thread. Operations are submitted from any thread, sync or async, and
+    the client is reconnected when the connection drops.
+    """
+
+    def __init__(
+        self,
+        client_factory=create_client,
+        retries=3,
+        reconnect_delay=0.5,
+        max_reconnect_delay=30.0
+    ):
+        self.client_factory = client_factory
+        self.retries = retries
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.client = None
+        self.loop = None
+        self.loop_thread = None
+        self.connect_lock = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=1000)
+        self.connects = 0
+        self.reconnects = 0
+        self.patch_handlers = []
+
+    def start(self):
+        """Start the loop thread if it is not running."""
+        with self.lock:
+            if self.loop_thread and self.loop_thread.is_alive():
+                return
+            self.ready.clear()
+            self.loop_thread = threading.Thread(
+                target=ModuleConnection.run_loop,
+                args=(self, ),
+                name="iot-hub-loop",
+                daemon=True
+            )
+            self.loop_thread.start()
+        self.ready.wait()
+
+    def stop(self):
+        """Disconnect and stop the loop thread."""
+        with self.lock:
+            if not (self.loop_thread and self.loop_thread.is_alive()):
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+
+    def run_loop(self):
+        """Thread that runs the event loop owning the client."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.connect_lock = asyncio.Lock()
+        self.ready.set()
+        logging.info("Starting iot hub loop")
+        try:
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.disconnect())
+        finally:
+            self.loop.close()
+        logging.info("Ending iot hub loop")
+
+    async def ensure_connected(self):
+        """Return the client, connecting it first if needed."""
+        async with self.connect_lock:
+            if self.client is None:
+                self.client = self.client_factory()
+                if self.patch_handlers:
+                    self.client.on_twin_desired_properties_patch_received = (
+                        self.dispatch_patch
+                    )
+            if not self.client.connected:
+                await self.client.connect()
+                self.connects += 1
+            return self.client
+
+    async def disconnect(self):
+        """Disconnect and forget the client."""
+        client = self.client
+        self.client = None
+        if client is not None:
+            try:
+                await client.disconnect()
+            # pylint: disable=broad-except
+            except Exception as error:
+                logging.info("Disconnect failed: %s", error)
+
+    async def execute(self, func, *args):
+        """Run func(client, *args), reconnecting on connection errors."""
+        delay = self.reconnect_delay
+        for attempt in range(self.retries + 1):
+            try:
+                client = await self.ensure_connected()
+                start = time.monotonic()
+                result = await func(client, *args)
+                self.latencies.append(time.monotonic() - start)
+                return result
+            # pylint: disable=broad-except
+            except Exception as error:
+                if (
+                    attempt == self.retries
+                    or not isinstance(error, retryable_errors(self.client))
+                ):
+                    raise
+                logging.warning("Hub connection error, reconnecting: %s",
+                                error)
+                self.reconnects += 1
+                await self.disconnect()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+        return None
+
+    def add_patch_handler(self, handler):
+        """Call handler(patch) for each desired property patch."""
+        self.patch_handlers.append(handler)
+        if self.loop is not None and self.client is not None:
+            self.loop.call_soon_threadsafe(
+                setattr,
+                self.client,
+                "on_twin_desired_properties_patch_received",
+                self.dispatch_patch
+            )
+
+    def dispatch_patch(self, patch):
+        """Deliver a desired property patch to the handlers."""
+        for handler in self.patch_handlers:
+            try:
+                handler(patch)
+            # pylint: disable=broad-except
+            except Exception as error:
+                logging.error("Twin patch handler failed: %s", error)
+
+    def submit(self, func, *args):
+        """Submit func(client, *args) from any thread.
+
+        Returns a concurrent.futures.Future.
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(
+            self.execute(func, *args),
+            self.loop
+        )
+
+    def call(self, func, *args, timeout=None):
+        """Run func(client, *args) and wait for the result."""
+        return self.submit(func, *args).result(timeout)
+
+    async def run(self, func, *args):
+        """Run func(client, *args) from another event loop."""
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    def stats(self):
+        """Return connection counts and operation latencies in ms."""
+        latencies = sorted(self.latencies)
+        stats = {
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "operations": len(latencies),
+        }
+        if latencies:
+            stats["meanMs"] = 1000 * sum(latencies) / len(latencies)
+            stats["p50Ms"] = 1000 * latencies[len(latencies) // 2]
+            stats["maxMs"] = 1000 * latencies[-1]
+        return stats
+
+
+CONNECTION = None
+
+
+def get_connection():
+    """Return the shared module connection."""
+    # pylint: disable=global-statement
+    global CONNECTION
+    if CONNECTION is None:
+        CONNECTION = ModuleConnection()
+        atexit.register(CONNECTION.stop)
+    return CONNECTION
+
+
+async def fetch_twin(module_client):
+    """Get the module twin using a connected client."""
+    return await module_client.get_twin()
+
+
+async def patch_twin(module_client, new_data):
+    """Patch the reported properties using a connected client."""
+    await module_client.patch_twin_reported_properties(new_data)
+
+
+async def send_message(module_client, message):
+    """Send a message to output1 using a connected client."""
+    await module_client.send_message_to_output(json.dumps(message), "output1")
+
+
+async def send_batch(module_client, messages):
+    """Send a batch of messages to output1 as a single message."""
+    if len(messages) == 1:
+        await send_message(module_client, messages[0])
+    else:
+        await send_message(module_client, {"batch": messages})
+
+
+def build_message(data: dict) -> dict:
+    """Build the output message for the supplied data."""
+    data["optraDeviceName"] = os.getenv("OPTRA_DEVICE_NAME")
+    data["optraSerialNumber"] = os.getenv("OPTRA_SERIAL_NUMBER")
+    message = {}
+    message["data"] = data
+    return message
 
 
 async def get_twin():
     """Get the module twin"""
-    module_client = await connect()
-    twin_data = await module_client.get_twin()
-    await module_client.disconnect()
-    return twin_data
+    return await get_connection().run(fetch_twin)
 
 
 async def update_twin(new_data):
     """Update the module twin"""
-    module_client = await connect()
-    await module_client.patch_twin_reported_properties(new_data)
-    await module_client.disconnect()
+    await get_connection().run(patch_twin, new_data)
 
 
 async def send_outputs(data: dict) -> dict:
     """Send outputs to the hub."""
-    module_client = await connect()
-    data["optraDeviceName"] = os.getenv("OPTRA_DEVICE_NAME")
-    data["optraSerialNumber"] = os.getenv("OPTRA_SERIAL_NUMBER")
-    message = {}
-    message["data"] = data
-    msg = json.dumps(message)
-    await module_client.send_message_to_output(msg, "output1")
-    await module_client.disconnect()
+    message = build_message(data)
+    await get_connection().run(send_message, message)
     return message
 
 
@@ -57,13 +394,118 @@ async def update(data):
     await update_twin(data)
 
 
-async def send(data):
-    """Send the supplied data to the hub."""
+async def send(data=None, stream=None, inflight=16):
+    """Send the supplied data to the hub, or stream NDJSON from a file."""
+    if stream is not None:
+        if data is not None:
+            raise SystemExit("send: data and --stream cannot both be given")
+        await send_stream(stream, inflight)
+        return
+    if data is None:
+        raise SystemExit("send: data or --stream is required")
     jsondata = json.loads(data)
     sent = await send_outputs(jsondata)
     print("Sent:\n" + json.dumps(sent, indent=4))
 
 
+def positive_int(value):
+    """Parse a command line count of at least 1."""
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise argparse.ArgumentTypeError(
+            f"must be a whole number of at least 1: {value!r}"
+        )
+    return count
+
+
+def percentile(values, pct):
+    """Return the pct percentile of a sorted list."""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def send_stream(path, inflight):
+    """Send each line of an NDJSON file ("-" for stdin) over one connection.
+
+    Up to inflight messages are sent concurrently. Throughput and latency
+    percentiles are printed at the end.
+    """
+    connection = get_connection()
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(inflight)
+    latencies = []
+    errors = []
+    tasks = set()
+
+    async def send_one(message):
+        start = time.monotonic()
+        try:
+            await connection.run(send_message, message)
+            latencies.append(time.monotonic() - start)
+        # pylint: disable=broad-except
+        except Exception as error:
+            errors.append(error)
+        finally:
+            slots.release()
+
+    # pylint: disable=consider-using-with
+    file = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    start = time.monotonic()
+    line_number = 0
+    try:
+        while True:
+            line = await loop.run_in_executor(None, file.readline)
+            if not line:
+                break
+            line_number += 1
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+                if not isinstance(data, dict):
+                    raise ValueError("Not a JSON object")
+            except ValueError as error:
+                logging.error("Skipping line %d: %s", line_number, error)
+                errors.append(error)
+                continue
+            await slots.acquire()
+            task = asyncio.ensure_future(send_one(build_message(data)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        # Let the sends already started finish, even if reading failed
+        if tasks:
+            await asyncio.wait(tasks)
+        if file is not sys.stdin:
+            file.close()
+    elapsed = time.monotonic() - start
+
+    latencies.sort()
+    report = {
+        "sent": len(latencies),
+        "errors": len(errors),
+        "seconds": round(elapsed, 3),
+        "messagesPerSecond": round(len(latencies) / elapsed, 1)
+                             if elapsed else 0.0,
+        "inflight": inflight,
+        "latencyMs": {
+            "p50": round(1000 * percentile(latencies, 50), 3),
+            "p90": round(1000 * percentile(latencies, 90), 3),
+            "p99": round(1000 * percentile(latencies, 99), 3),
+            "max": round(1000 * percentile(latencies, 100), 3),
+        },
+    }
+    if errors:
+        report["firstError"] = str(errors[0])
+    print(json.dumps(report, indent=4))
+
+
 if __name__ == '__main__':
     P = argparse.ArgumentParser(
         description='Perform azure iot device functions'
@@ -71,6 +513,10 @@ if __name__ == '__main__':
     P.version = '1.0'
 
     P.add_argument('-v', '--version', action='version')
+    P.add_argument('--local', action='store_true',
+                   help='use a local stand-in hub instead of the edge hub')
+    P.add_argument('--local-latency', type=float, default=0.0,
+                   help='seconds of latency added by the local stand-in hub')
 
     subp = P.add_subparsers(required=True, dest='func')
 
@@ -82,12 +528,24 @@ if __name__ == '__main__':
     Pupdate.set_defaults(func=update)
 
     Psend = subp.add_parser('send', help='send outputs to hub')
-    Psend.add_argument('data')
+    Psend_source = Psend.add_mutually_exclusive_group(required=True)
+    Psend_source.add_argument('data', nargs='?')
+    Psend_source.add_argument('--stream', nargs='?', const='-',
+                              metavar='FILE',
+                              help='send each line of an NDJSON file or stdin')
+    Psend.add_argument('--inflight', type=positive_int, default=16,
+                       help='messages in flight at once with --stream')
     Psend.set_defaults(func=send)
 
     args = P.parse_args()
     args_ = vars(args).copy()
     args_.pop('command', None)
     args_.pop('func', None)
+    args_.pop('local', None)
+    args_.pop('local_latency', None)
+
+    if args.local:
+        use_local_hub(LocalModuleClient(latency=args.local_latency))
 
     asyncio.run(args.func(**args_))
+    get_connection().stop()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Camera registry benchmark for the demo skill.
+
+Builds a synthetic module twin with many RTSP sensors and times the
+camera operations of Settings against the linear list and dict the
+settings used before the camera registry, then times the camera pages.
+
+Run from the demo directory:
+
+    python3 benchmarks/cameras.py [--cameras 1000] [--repeat 50]
+"""
+import argparse
+import itertools
+import os
+import statistics
+import sys
+import time
+
+DEMO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DEMO_DIR)
+os.environ.setdefault("OPTRA_DEVICE_MODEL", "vz5000")
+
+# pylint: disable=wrong-import-position
+from settings import Settings  # noqa: E402
+
+
+def synthetic_twin(count):
+    """Return a module twin with count RTSP sensors."""
+    sensors = {}
+    for i in range(count):
+        sensors[f"sensor-{i:05d}"] = {
+            "name": f"Camera {i:05d}",
+            "ip": f"rtsp://10.{i // 65536}.{i // 256 % 256}.{i % 256}"
+                  "/axis-media/media.amp",
+        }
+    return {"desired": {"device": {"sensors": sensors}}, "reported": {}}
+
+
+class LinearCameras():
+    """The camera list and dict as they were kept before the registry."""
+
+    def __init__(self, twin):
+        self.twin = twin
+        self.camera_info = {}
+        self.camera_list = []
+        self.selected_camera = ""
+        self.camera_source = ""
+
+    def populate_attached_cameras(self):
+        """Rebuild the list and dict from the twin."""
+        self.camera_info = {}
+        self.camera_list = []
+        for key, value in self.twin["desired"]["device"]["sensors"].items():
+            self.camera_info[key] = {"name": value["name"],
+                                     "ip":   value["ip"]}
+            self.camera_list.append(value["name"])
+        if self.camera_list and self.selected_camera not in self.camera_list:
+            self.selected_camera = self.camera_list[0]
+        self.set_camera_source()
+
+    def update_sensor(self, key):
+        """Update one sensor in place."""
+        value = self.twin["desired"]["device"]["sensors"][key]
+        old = self.camera_info.pop(key, None)
+        if old is not None and old["name"] in self.camera_list:
+            self.camera_list.remove(old["name"])
+        self.camera_info[key] = {"name": value["name"], "ip": value["ip"]}
+        self.camera_list.append(value["name"])
+        if self.camera_list and self.selected_camera not in self.camera_list:
+            self.selected_camera = self.camera_list[0]
+        self.set_camera_source()
+
+    def select(self, name):
+        """Select a camera."""
+        self.selected_camera = name
+        self.set_camera_source()
+
+    def set_camera_source(self):
+        """Scan for the selected camera."""
+        for value in self.camera_info.values():
+            if value["name"] == self.selected_camera:
+                self.camera_source = value["ip"]
+                break
+
+
+def measure(func, repeat):
+    """Return the median milliseconds of func()."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cameras", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--no-pages", action="store_true",
+                        help="do not time the Flask camera pages")
+    args = parser.parse_args()
+
+    twin = synthetic_twin(args.cameras)
+    last_key = f"sensor-{args.cameras - 1:05d}"
+    last_name = f"Camera {args.cameras - 1:05d}"
+    first_name = "Camera 00000"
+
+    linear = LinearCameras(twin)
+    settings = Settings()
+    settings.twin = twin
+
+    sensor = twin["desired"]["device"]["sensors"][last_key]
+    base_url = sensor["ip"]
+    patches = itertools.count()
+
+    def patch_twin(cameras):
+        sensor["ip"] = f"{base_url}?patch={next(patches)}"
+        if cameras is linear:
+            linear.update_sensor(last_key)
+        else:
+            settings.update_sensors([last_key])
+
+    def toggle_selection(cameras):
+        if cameras is linear:
+            linear.select(
+                first_name if linear.selected_camera == last_name
+                else last_name
+            )
+        else:
+            settings.update_camera_state(
+                selected_camera=first_name
+                if settings.selected_camera == last_name else last_name
+            )
+
+    operations = [
+        ("populate from twin",
+         linear.populate_attached_cameras,
+         settings.populate_attached_cameras),
+        ("patch one sensor",
+         lambda: patch_twin(linear), lambda: patch_twin(settings)),
+        ("select last camera",
+         lambda: toggle_selection(linear),
+         lambda: toggle_selection(settings)),
+        ("lookup by name",
+         lambda: last_name in linear.camera_list,
+         lambda: settings.state.snapshot.cameras.find_name(last_name)),
+    ]
+    print(f"{args.cameras} cameras, median of {args.repeat} runs")
+    print(f"{'operation':<22} {'before ms':>10} {'registry ms':>12}")
+    for name, before, after in operations:
+        print(f"{name:<22} {measure(before, args.repeat):10.3f} "
+              f"{measure(after, args.repeat):12.3f}")
+
+    if args.no_pages:
+        return
+
+    # pylint: disable=import-outside-toplevel
+    import demo
+    from camera_health import RtspProber
+    demo.settings = settings
+    demo.camera_health = RtspProber(lambda: [])
+    client = demo.app.test_client()
+    for url in ("/cameras", "/cameras?q=Camera 009", "/api/cameras",
+                "/api/cameras?offset=900&limit=50"):
+        milliseconds = measure(lambda url=url: client.get(url), args.repeat)
+        print(f"GET {url:<34} {milliseconds:8.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Startup benchmark for the demo skill.
+
+Profiles the import time of demo.py with -X importtime and measures how
+long it takes from launching demo.py until the home page is served.
+
+Run from the demo directory:
+
+    python3 benchmarks/startup.py [--top 20] [--no-serve]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+DEMO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_profile():
+    """Return (module, self_us, cumulative_us) for each import of demo."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import demo"],
+        cwd=DEMO_DIR,
+        capture_output=True,
+        text=True,
+        check=False
+    )
+    if result.returncode:
+        print(result.stderr, file=sys.stderr)
+        raise SystemExit("import demo failed")
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        imports.append(
+            (fields[2].strip(), int(fields[0]), int(fields[1]))
+        )
+    return imports
+
+
+def time_to_first_response(url, timeout):
+    """Launch demo.py and return the seconds until url answers."""
+    env = dict(os.environ)
+    env.setdefault("OPTRA_DEVICE_MODEL", "vz5000")
+    env.setdefault("OPTRA_LOCAL_HUB", "1")
+    start = time.monotonic()
+    with subprocess.Popen(
+        [sys.executable, "demo.py"],
+        cwd=DEMO_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    ) as server:
+        try:
+            while time.monotonic() - start < timeout:
+                try:
+                    with urllib.request.urlopen(url, timeout=1) as response:
+                        if response.status == 200:
+                            return time.monotonic() - start
+                except OSError:
+                    time.sleep(0.02)
+            return None
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top", type=int, default=20,
+                        help="number of slowest imports to list")
+    parser.add_argument("--no-serve", action="store_true",
+                        help="only profile the imports")
+    parser.add_argument("--url", default="http://127.0.0.1:7000/")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    imports = import_profile()
+    total = sum(self_us for _, self_us, _ in imports)
+    print(f"import demo: {total / 1000:.1f} ms, {len(imports)} modules")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    slowest = sorted(imports, key=lambda item: item[2], reverse=True)
+    for module, self_us, cumulative_us in slowest[:args.top]:
+        print(f"{cumulative_us / 1000:14.1f} {self_us / 1000:9.1f}  {module}")
+
+    if not args.no_serve:
+        seconds = time_to_first_response(args.url, args.timeout)
+        if seconds is None:
+            print(f"time to first response: no answer in {args.timeout}s")
+        else:
+            print(f"time to first response: {seconds:.3f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,16 @@
 """Module camera
 """
 import os
+import functools
 import logging
+import re
 import threading
 import time
-import cv2
+from lazy_import import lazy_import
+from usbcaminfo import UsbCameraInfo
+
+# OpenCV takes a while to import, so load it when a camera is first used
+cv2 = lazy_import("cv2")
 
 
 # pylint: disable=too-many-instance-attributes
@@ -24,16 +30,35 @@ class Camera():
         self.cascade = None
         self.queue_size = 10
         self.seconds_to_wait_for_frame = 0.5
+        self.name = None
+        self.cascade_name = None
+        self.detections = None
+        self.options = None
+        # cap_lock guards the capture against reads during a change.
+        # apply_lock serializes starting and changing the capture.
+        self.cap_lock = threading.Lock()
+        self.apply_lock = threading.RLock()
+        self.wanted = None
+        self.wanted_lock = threading.Lock()
+        # With an HDMI sink the capture is a GStreamer pipeline that
+        # tees the frames to HDMI. capture_hdmi_sink is the sink of the
+        # open capture.
+        self.hdmi_sink = None
+        self.capture_hdmi_sink = None
+
+        self.frame = None
 
-        # Load the test pattern frame for times when a captured frame
-        # is not available
-        self.test_pattern_frame = cv2.imread("test_pattern.jpg")
-        self.frame = self.test_pattern_frame
+    @functools.cached_property
+    def test_pattern_frame(self):
+        """Test pattern frame for times when a captured frame is not
+        available. Loaded on first use."""
+        return cv2.imread("test_pattern.jpg")
 
-        # Load the test pattern frame as a jpeg for use if jpeg
-        # conversion fails
+    @functools.cached_property
+    def test_pattern_jpeg(self):
+        """Test pattern as a jpeg for use if jpeg conversion fails."""
         with open("test_pattern.jpg", "rb") as file:
-            self.test_pattern_jpeg = file.read()
+            return file.read()
 
     def __del__(self):
         # Stop the capture thread if it is running
@@ -47,66 +72,314 @@ class Camera():
         resolution,
         frame_rate,
         cascade_classifier=None,
-        resize_factor=1.0
+        resize_factor=1.0,
+        name=None
     ):
         """Start the capture on a source."""
+        with self.apply_lock:
+            # Make sure capture thread is stopped
+            self.stop()
+
+            self.source = source
+            self.name = name if name else source
+            self.options = (pixel_format, resolution, frame_rate)
+            self.set_classifier(cascade_classifier, resize_factor)
+
+            # Open the capture source
+            self.cap = self.open_capture(source, self.options)
+
+            # If failed to open, return
+            if not self.cap.isOpened():
+                logging.info("Failed to open camera %s", source)
+                return
+
+            self.cap_thread = threading.Thread(
+                target=Camera.capture_thread,
+                args=(self, )
+            )
 
-        # Make sure capture thread is stopped
-        self.stop()
+            # Clear the stop event
+            self.time_to_stop.clear()
 
-        # Check for a selected cascade classifier
+            # Start thread that capatures the frames
+            self.cap_thread.start()
+
+    def open_capture(self, source, options):
+        """Open a capture of source with the (pixel_format, resolution,
+        frame_rate) options.
+
+        With an HDMI sink the capture is a GStreamer pipeline that also
+        shows the frames on HDMI.
+        """
+        logging.info("Opening camera %s", source)
+        hdmi_sink = self.hdmi_sink_for(source)
+        if hdmi_sink is not None:
+            cap = cv2.VideoCapture(
+                Camera.capture_pipeline(source, *options,
+                                        hdmi_sink=hdmi_sink),
+                cv2.CAP_GSTREAMER
+            )
+            self.capture_hdmi_sink = hdmi_sink
+            return cap
+        cap = cv2.VideoCapture(source)
+        self.capture_hdmi_sink = None
+        # RTSP cameras must use the URL to set properties
+        if cap.isOpened() and Camera.is_usb_cam(source):
+            Camera.set_usb_properties(cap, *options)
+        return cap
+
+    def hdmi_sink_for(self, source):
+        """Return the HDMI sink a capture of source would have."""
+        if self.hdmi_sink is None or not Camera.can_share_hdmi(source):
+            return None
+        return self.hdmi_sink
+
+    def set_hdmi_sink(self, sink):
+        """Show the capture on HDMI through sink, or stop showing it.
+
+        sink is a GStreamer sink description, or None. A running capture
+        is reopened with the HDMI branch added or removed. Returns the
+        result of apply(), or None if the capture is not running.
+        """
+        with self.apply_lock:
+            self.hdmi_sink = sink
+            if not self.is_running():
+                return None
+            return self.apply(self.source, *self.options, self.cascade_name,
+                              name=self.name)
+
+    def set_classifier(self, cascade_classifier, resize_factor=None):
+        """Change the cascade classifier run on the frames."""
+        if resize_factor is not None:
+            self.resize_factor = resize_factor
         if cascade_classifier is None or cascade_classifier == "none":
             self.cascade = None
-        else:
+            self.cascade_name = None
+        elif cascade_classifier != self.cascade_name:
             self.cascade = cv2.CascadeClassifier(
                 f"{cv2.data.haarcascades}{cascade_classifier}"
             )
-            self.resize_factor = resize_factor
+            self.cascade_name = cascade_classifier
 
-        # Open the capture source
-        logging.info("Opening camera %s", source)
-        self.cap = cv2.VideoCapture(source)
+    def is_running(self):
+        """Return True if the capture thread is running."""
+        return self.cap_thread is not None and self.cap_thread.is_alive()
+
+    # pylint: disable=too-many-arguments
+    def apply(
+        self,
+        source,
+        pixel_format,
+        resolution,
+        frame_rate,
+        cascade_classifier=None,
+        name=None
+    ):
+        """Start the capture, or change the running capture to new options.
 
-        # If failed to open, return
-        if not self.cap.isOpened():
+        The classifier, and USB formats the device accepts while open,
+        are changed in place. A new source is opened and delivering
+        frames before the old one is released, so viewers never see a
+        gap. A USB device cannot be opened twice, so a format it refuses
+        while open restarts the capture.
+
+        Returns "started", "unchanged", "in place", "swapped",
+        "restarted" or "failed".
+        """
+        with self.apply_lock:
+            if not self.is_running():
+                self.start(source, pixel_format, resolution, frame_rate,
+                           cascade_classifier, name=name)
+                return "started" if self.is_running() else "failed"
+
+            how = "unchanged"
+            if (cascade_classifier or "none") != (self.cascade_name or "none"):
+                self.set_classifier(cascade_classifier)
+                how = "in place"
+            self.name = name if name else source
+            options = (pixel_format, resolution, frame_rate)
+
+            if source != self.source:
+                if self.swap(source, options):
+                    return "swapped"
+                self.stop()
+                return "failed"
+
+            if self.hdmi_sink_for(source) != self.capture_hdmi_sink:
+                # The HDMI branch is added or removed with a new capture
+                if not Camera.is_usb_cam(source) and self.swap(source,
+                                                               options):
+                    return "swapped"
+                self.start(source, pixel_format, resolution, frame_rate,
+                           cascade_classifier, name=name)
+                return "restarted" if self.is_running() else "failed"
+
+            if not Camera.is_usb_cam(source) or options == self.options:
+                return how
+
+            with self.cap_lock:
+                # A GStreamer capture has its format in the pipeline
+                if (
+                    self.capture_hdmi_sink is None
+                    and Camera.set_usb_properties(self.cap, *options)
+                ):
+                    self.options = options
+                    self.queue = []
+                    return "in place"
+            logging.info("Camera %s cannot change to %s while open, "
+                         "restarting", source, options)
+            self.start(source, pixel_format, resolution, frame_rate,
+                       cascade_classifier, name=name)
+            return "restarted" if self.is_running() else "failed"
+
+    def swap(self, source, options):
+        """Switch the running capture to a new source.
+
+        The new source is opened and must deliver a frame before it
+        replaces the old one. Returns False if it did not.
+        """
+        hdmi_sink = self.capture_hdmi_sink
+        cap = self.open_capture(source, options)
+        success = cap.isOpened()
+        frame = None
+        if success:
+            success, frame = cap.read()
+        if not success:
             logging.info("Failed to open camera %s", source)
-            return
-
-        # If Camera is USB, then set the properties
-        #   FOURCC is the pixel format, usually MJPG or YUYV
-        #   WIDTH is the resolution width
-        #   HEIGHT is the resolution height
-        #   FPS is the frame rate
-        #
-        # RTSP cameras must use the URL to set properties
+            cap.release()
+            self.capture_hdmi_sink = hdmi_sink
+            return False
+
+        with self.cap_lock:
+            old_cap = self.cap
+            self.cap = cap
+            self.source = source
+            self.options = options
+            self.frame = frame
+            self.queue = [frame]
+        old_cap.release()
+        logging.info("Switched capture to %s", source)
+        return True
+
+    def reconfigure_soon(self, *options, name=None):
+        """Apply new options to the running capture in the background.
+
+        Only the latest options are applied when changes come quickly.
+        """
+        with self.wanted_lock:
+            self.wanted = (options, name)
+        threading.Thread(
+            target=Camera.apply_wanted,
+            args=(self, ),
+            name="camera-reconfigure",
+            daemon=True
+        ).start()
+
+    def apply_wanted(self):
+        """Apply the options from reconfigure_soon()."""
+        with self.apply_lock:
+            with self.wanted_lock:
+                wanted = self.wanted
+                self.wanted = None
+            # A later thread may have applied them already
+            if wanted is None or not self.is_running():
+                return
+            options, name = wanted
+            how = self.apply(*options, name=name)
+            logging.info("Camera reconfigured: %s", how)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def has_gstreamer():
+        """Return True if OpenCV can capture from GStreamer pipelines."""
+        return re.search(
+            r"GStreamer:\s*YES", cv2.getBuildInformation()
+        ) is not None
+
+    @staticmethod
+    def can_share_hdmi(source):
+        """Return True if a capture of source can also feed HDMI."""
+        return (
+            Camera.capture_pipeline(source, None, None, None) is not None
+            and Camera.has_gstreamer()
+        )
+
+    @staticmethod
+    def capture_pipeline(source, pixel_format, resolution, frame_rate,
+                         hdmi_sink=None):
+        """Return a GStreamer pipeline capturing source for OpenCV.
+
+        The frames are decoded once. With an hdmi_sink description a tee
+        sends them to HDMI as well as to the appsink OpenCV reads, so the
+        display, the stream and the classifier share one capture. The
+        queue of each branch drops frames rather than hold up the other.
+        "videotestsrc" captures a test pattern. Returns None for sources
+        that are not USB or RTSP cameras.
+        """
         if Camera.is_usb_cam(source):
-            self.cap.set(
-                cv2.CAP_PROP_FOURCC,
-                cv2.VideoWriter_fourcc(*pixel_format)
-            )
-            self.cap.set(
-                cv2.CAP_PROP_FRAME_WIDTH,
-                float(resolution.split('x')[0])
-            )
-            self.cap.set(
-                cv2.CAP_PROP_FRAME_HEIGHT,
-                float(resolution.split('x')[1])
-            )
-            self.cap.set(
-                cv2.CAP_PROP_FPS,
-                float(frame_rate)
-            )
+            if pixel_format == "MJPG":
+                caps = ["image/jpeg"]
+            else:
+                caps = ["video/x-raw"]
+                if pixel_format:
+                    # YUYV is called YUY2 in GStreamer
+                    caps.append("format=" + pixel_format.replace("YUYV",
+                                                                 "YUY2"))
+            if resolution:
+                width, height = resolution.split("x")
+                caps += [f"width={width}", f"height={height}"]
+            if frame_rate:
+                caps.append("framerate="
+                            + UsbCameraInfo.fractional_frame_rate(frame_rate))
+            capture = f"v4l2src device={source} ! {','.join(caps)}"
+            if pixel_format == "MJPG":
+                capture += " ! jpegdec"
+        elif Camera.is_rtsp_cam(source):
+            capture = f'rtspsrc location="{source}" latency=200 ! decodebin'
+        elif source == "videotestsrc":
+            capture = "videotestsrc is-live=true"
+        else:
+            return None
 
-        self.cap_thread = threading.Thread(
-            target=Camera.capture_thread,
-            args=(self, )
+        appsink = (
+            "queue leaky=downstream max-size-buffers=2"
+            " ! videoconvert ! video/x-raw,format=BGR"
+            " ! appsink drop=true max-buffers=1 sync=false"
+        )
+        if hdmi_sink is None:
+            return f"{capture} ! {appsink}"
+        return (
+            f"{capture} ! tee name=hdmi_tee"
+            f" hdmi_tee. ! {appsink}"
+            f" hdmi_tee. ! queue leaky=downstream max-size-buffers=2"
+            f" ! {hdmi_sink}"
         )
 
-        # Clear the stop event
-        self.time_to_stop.clear()
+    @staticmethod
+    def set_usb_properties(cap, pixel_format, resolution, frame_rate):
+        """Set the USB camera properties on a capture.
 
-        # Start thread that capatures the frames
-        self.cap_thread.start()
+        FOURCC is the pixel format, usually MJPG or YUYV, WIDTH and
+        HEIGHT come from the resolution and FPS is the frame rate.
+        Returns True if the device accepted the format and resolution.
+        """
+        accepted = True
+        if pixel_format:
+            fourcc = cv2.VideoWriter_fourcc(*pixel_format)
+            cap.set(cv2.CAP_PROP_FOURCC, fourcc)
+            accepted = int(cap.get(cv2.CAP_PROP_FOURCC)) == fourcc
+        if resolution:
+            width, height = (float(value) for value in resolution.split('x'))
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+            accepted = (
+                accepted
+                and cap.get(cv2.CAP_PROP_FRAME_WIDTH) == width
+                and cap.get(cv2.CAP_PROP_FRAME_HEIGHT) == height
+            )
+        if frame_rate:
+            cap.set(cv2.CAP_PROP_FPS, float(frame_rate))
+        return accepted
 
     def stop(self):
         """Stop the capture thread and wait for it to die."""
@@ -125,19 +398,26 @@ class Camera():
 
         # Run until time to stop
         while not self.time_to_stop.is_set():
-            success, self.frame = self.cap.read()
+            with self.cap_lock:
+                success, self.frame = self.cap.read()
             if not success:
                 logging.info("Read failed in thread")
                 self.frame = self.test_pattern_frame
+                frame = self.frame
+            else:
+                # Classify every captured frame once, whether or not
+                # anyone is viewing the stream
+                frame = self.classify(self.frame)
 
             if len(self.queue) < self.queue_size:
-                self.queue.append(self.frame)
+                self.queue.append(frame)
 
             # Give the main thread a chance to run
             time.sleep(0)
 
         logging.info("Releasing camera")
         self.cap.release()
+        self.capture_hdmi_sink = None
         self.frame = None
         self.source = None
         self.queue = []
@@ -154,12 +434,10 @@ class Camera():
 
         cv2.imwrite("/demo/static/capture/frame.jpg", frame)
 
-    # pylint: disable=no-member
-    # pylint: disable=invalid-name
     def get_frame(self):
-        """Get a frame from the source.
+        """Get a frame from the source as a jpeg.
 
-        Optionally, do a classification on the frame.
+        The frames were classified by the capture thread.
         """
 
         # Wait a short time for a frame
@@ -173,34 +451,6 @@ class Camera():
         else:
             frame = self.queue.pop(0)
 
-        # Do classifer if selected
-        if self.cascade:
-
-            try:
-                # Resize the frame based on resize_factor
-                frame = cv2.resize(
-                    frame,
-                    None,
-                    fx=self.resize_factor,
-                    fy=self.resize_factor,
-                    interpolation=cv2.INTER_AREA
-                )
-
-                # Create a gray scale version of the frame
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-                # Find the object and return the rectangles
-                rects = self.cascade.detectMultiScale(gray, 1.3, 5)
-
-                # Draw the rectangles on the frame
-                for (x, y, w, h) in rects:
-                    cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
-
-            # If we get an exception, just continue on to display the frame
-            # pylint: disable=broad-except
-            except Exception as error:
-                logging.error(error)
-
         # Convert and return the frame
         success, jpeg = cv2.imencode('.jpg', frame)
         if not success:
@@ -208,6 +458,51 @@ class Camera():
             jpeg = self.test_pattern_jpeg
         return jpeg.tobytes()
 
+    # pylint: disable=no-member
+    # pylint: disable=invalid-name
+    def classify(self, frame):
+        """Do a classification on a captured frame, if one is selected.
+
+        The detections are recorded and drawn on the returned frame.
+        """
+        cascade = self.cascade
+        if cascade is None:
+            return frame
+
+        try:
+            # Resize the frame based on resize_factor
+            frame = cv2.resize(
+                frame,
+                None,
+                fx=self.resize_factor,
+                fy=self.resize_factor,
+                interpolation=cv2.INTER_AREA
+            )
+
+            # Create a gray scale version of the frame
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+            # Find the object and return the rectangles
+            rects = cascade.detectMultiScale(gray, 1.3, 5)
+
+            # Add the detections to the windowed summaries
+            if self.detections is not None:
+                self.detections.record(
+                    self.name,
+                    self.cascade_name,
+                    len(rects)
+                )
+
+            # Draw the rectangles on the frame
+            for (x, y, w, h) in rects:
+                cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
+
+        # If we get an exception, just continue on to display the frame
+        # pylint: disable=broad-except
+        except Exception as error:
+            logging.error(error)
+        return frame
+
     @staticmethod
     def is_usb_cam(source):
         """Return True if camera is USB."""
@@ -241,3 +536,25 @@ class Camera():
             if file.endswith(".xml"):
                 classifiers.append(file)
         return classifiers
+
+
+if __name__ == '__main__':
+    import sys
+
+    # Capture a test pattern shown on a software sink, the way a camera
+    # is shown on HDMI, and count the frames OpenCV reads meanwhile
+    logging.basicConfig(level=logging.INFO)
+    print(Camera.capture_pipeline("videotestsrc", None, None, None,
+                                  hdmi_sink="fakesink sync=true"))
+    if not Camera.has_gstreamer():
+        sys.exit("OpenCV was built without GStreamer")
+    CAMERA = Camera()
+    CAMERA.set_hdmi_sink("fakesink sync=true")
+    print(CAMERA.apply("videotestsrc", None, None, None))
+    FRAMES = 0
+    END = time.monotonic() + 3
+    while time.monotonic() < END:
+        CAMERA.get_frame()
+        FRAMES += 1
+    print(f"{FRAMES / 3:.1f} frames/s with the HDMI branch")
+    CAMERA.stop()
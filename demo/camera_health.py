@@ -0,0 +1,418 @@
+"""Module camera_health
+
+Probes the RTSP cameras in the background so dead cameras are known
+before anyone opens them.
+"""
+import asyncio
+import base64
+import collections
+import hashlib
+import logging
+import re
+import secrets
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+
+RTSP_PORT = 554
+
+
+class RtspError(Exception):
+    """The camera did not answer with a valid RTSP response."""
+
+
+def parse_sdp(sdp):
+    """Return the streams advertised in an SDP description."""
+    streams = []
+    stream = None
+    for line in sdp.splitlines():
+        if line.startswith("m="):
+            fields = line[2:].split()
+            stream = {"media": fields[0] if fields else ""}
+            streams.append(stream)
+        elif stream is not None and line.startswith("a="):
+            key, _, value = line[2:].partition(":")
+            try:
+                if key == "rtpmap" and "codec" not in stream:
+                    encoding = value.split(None, 1)[1].split("/")
+                    stream["codec"] = encoding[0]
+                    stream["clock_rate"] = int(encoding[1])
+                elif key == "framerate":
+                    stream["framerate"] = float(value)
+                elif key == "x-dimensions":
+                    width, height = value.split(",")
+                    stream["resolution"] = f"{int(width)}x{int(height)}"
+            except (IndexError, ValueError):
+                logging.debug("Ignoring SDP attribute %s", line)
+    return streams
+
+
+def parse_challenge(challenge):
+    """Return the parameters of a Digest challenge, with lowercase keys."""
+    return {
+        key.lower(): quoted if quoted else plain
+        for key, quoted, plain in re.findall(
+            r'(\w+)\s*=\s*(?:"([^"]*)"|([^\s,]*))',
+            challenge[len("Digest"):]
+        )
+    }
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def digest_authorization(challenge, method, url, username, password,
+                         nonce_count=1, cnonce=None):
+    """Return the Authorization header answering a Digest challenge.
+
+    A challenge offering qop=auth is answered with a client nonce and
+    the nonce count, as Axis and ONVIF cameras require.
+    """
+    params = parse_challenge(challenge)
+
+    def md5(text):
+        return hashlib.md5(text.encode()).hexdigest()
+
+    realm = params.get("realm", "")
+    nonce = params.get("nonce", "")
+    ha1 = md5(f"{username}:{realm}:{password}")
+    ha2 = md5(f"{method}:{url}")
+    header = (
+        f'Digest username="{username}", realm="{realm}", '
+        f'nonce="{nonce}", uri="{url}"'
+    )
+    qops = [item.strip() for item in params.get("qop", "").split(",")]
+    if "auth" in qops:
+        if cnonce is None:
+            cnonce = secrets.token_hex(8)
+        nc_value = f"{nonce_count:08x}"
+        response = md5(f"{ha1}:{nonce}:{nc_value}:{cnonce}:auth:{ha2}")
+        header += (
+            f', response="{response}", qop=auth, nc={nc_value}, '
+            f'cnonce="{cnonce}"'
+        )
+    else:
+        response = md5(f"{ha1}:{nonce}:{ha2}")
+        header += f', response="{response}"'
+    if "algorithm" in params:
+        header += f', algorithm={params["algorithm"]}'
+    if "opaque" in params:
+        header += f', opaque="{params["opaque"]}"'
+    return header
+
+
+class RtspSession():
+    """One RTSP connection used for a probe."""
+
+    def __init__(self, url):
+        parts = urlparse(url)
+        if not parts.hostname:
+            raise ValueError("Camera URL has no host")
+        self.host = parts.hostname
+        self.port = parts.port or RTSP_PORT
+        self.username = parts.username
+        self.password = parts.password or ""
+        # Never send the credentials in the request line
+        netloc = self.host
+        if parts.port is not None:
+            netloc = f"{self.host}:{self.port}"
+        self.url = parts._replace(netloc=netloc).geturl()
+        self.cseq = 0
+        self.nonce_count = 0
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        """Open the connection."""
+        self.reader, self.writer = await asyncio.open_connection(self.host,
+                                                                 self.port)
+
+    async def close(self):
+        """Close the connection."""
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+    async def request(self, method, headers=None):
+        """Send a request, answering an authentication challenge.
+
+        Returns (status, headers, body).
+        """
+        status, response_headers, body = await self.send(method, headers)
+        challenge = response_headers.get("www-authenticate", "")
+        if status == 401 and self.username is not None:
+            headers = dict(headers or {})
+            if challenge.startswith("Digest"):
+                self.nonce_count += 1
+                headers["Authorization"] = digest_authorization(
+                    challenge, method, self.url,
+                    self.username, self.password,
+                    nonce_count=self.nonce_count
+                )
+            else:
+                credentials = f"{self.username}:{self.password}".encode()
+                headers["Authorization"] = (
+                    "Basic " + base64.b64encode(credentials).decode()
+                )
+            status, response_headers, body = await self.send(method, headers)
+        return status, response_headers, body
+
+    async def send(self, method, headers=None):
+        """Send one request and read the response."""
+        self.cseq += 1
+        lines = [
+            f"{method} {self.url} RTSP/1.0",
+            f"CSeq: {self.cseq}",
+            "User-Agent: optra-demo",
+        ]
+        lines.extend(f"{key}: {value}"
+                     for key, value in (headers or {}).items())
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        await self.writer.drain()
+
+        status_line = (await self.reader.readline()).decode("latin-1")
+        fields = status_line.split(None, 2)
+        if len(fields) < 2 or not fields[0].startswith("RTSP/"):
+            raise RtspError(f"Not an RTSP response: {status_line.strip()!r}")
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            response_headers[key.strip().lower()] = value.strip()
+        length = int(response_headers.get("content-length", 0))
+        body = b""
+        if length:
+            body = await self.reader.readexactly(length)
+        return int(fields[1]), response_headers, body.decode("utf-8",
+                                                             "replace")
+
+
+# pylint: disable=too-many-instance-attributes
+class RtspProber():
+    """Periodically probes RTSP cameras with OPTIONS and DESCRIBE.
+
+    get_urls() returns the camera URLs to probe. Every interval seconds
+    all of them are probed, at most concurrency at a time; cameras that
+    appear in between are probed as soon as refresh() is called. The
+    probes run on an asyncio loop in a background thread.
+    """
+
+    LATENCY_SAMPLES = 20
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, get_urls, interval=30.0, timeout=3.0, concurrency=16):
+        self.get_urls = get_urls
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.results = {}
+        self.latencies = {}
+        self.loop = None
+        self.loop_thread = None
+        self.ready = threading.Event()
+        self.time_to_stop = threading.Event()
+        self.wakeup = None
+        self.semaphore = None
+        self.rounds = 0
+        self.round_seconds = None
+
+    def start(self):
+        """Start the probe thread."""
+        if self.loop_thread and self.loop_thread.is_alive():
+            return
+        self.time_to_stop.clear()
+        self.loop_thread = threading.Thread(
+            target=RtspProber.run_loop,
+            args=(self, ),
+            name="rtsp-prober",
+            daemon=True
+        )
+        self.loop_thread.start()
+        self.ready.wait()
+
+    def stop(self):
+        """Stop the probe thread."""
+        if not (self.loop_thread and self.loop_thread.is_alive()):
+            return
+        self.time_to_stop.set()
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+        self.loop_thread.join()
+
+    def run_loop(self):
+        """Thread that runs the probe loop."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        logging.info("Starting rtsp prober")
+        try:
+            self.loop.run_until_complete(self.probe_loop())
+        finally:
+            self.loop.close()
+        logging.info("Ending rtsp prober")
+
+    def refresh(self):
+        """Probe the cameras that have not been probed yet."""
+        if self.loop is not None and self.wakeup is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def probe_soon(self, url):
+        """Probe a camera now without waiting for the result."""
+        if self.loop is None or not self.ready.is_set():
+            return None
+        return asyncio.run_coroutine_threadsafe(self.probe_camera(url),
+                                                self.loop)
+
+    def probe_now(self, url, timeout=None):
+        """Probe a camera now and return its status."""
+        future = self.probe_soon(url)
+        if future is None:
+            return self.status(url)
+        return future.result(timeout)
+
+    def status(self, url):
+        """Return the last probe result of a camera, or None."""
+        return self.results.get(url)
+
+    def is_dead(self, url):
+        """Return True if the last probe of a camera failed to connect."""
+        result = self.results.get(url)
+        return result is not None and result["reachable"] is False
+
+    def stats(self):
+        """Return a summary of the probe results."""
+        results = list(self.results.values())
+        return {
+            "cameras": len(results),
+            "reachable": sum(1 for item in results if item["reachable"]),
+            "unreachable": sum(
+                1 for item in results if not item["reachable"]
+            ),
+            "rounds": self.rounds,
+            "round_seconds": self.round_seconds,
+            "interval": self.interval,
+            "concurrency": self.concurrency,
+        }
+
+    async def probe_loop(self):
+        """Probe all the cameras every interval."""
+        self.wakeup = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.ready.set()
+        next_round = 0.0
+        while not self.time_to_stop.is_set():
+            try:
+                urls = list(dict.fromkeys(self.get_urls()))
+            # pylint: disable=broad-except
+            except Exception as error:
+                logging.error("Could not list the cameras to probe: %s",
+                              error)
+                urls = []
+            for url in set(self.results) - set(urls):
+                self.results.pop(url, None)
+                self.latencies.pop(url, None)
+
+            start = time.monotonic()
+            if start >= next_round:
+                await asyncio.gather(*(self.probe_camera(url)
+                                       for url in urls))
+                self.rounds += 1
+                self.round_seconds = round(time.monotonic() - start, 3)
+                next_round = start + self.interval
+            else:
+                await asyncio.gather(*(self.probe_camera(url)
+                                       for url in urls
+                                       if url not in self.results))
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(),
+                                       max(next_round - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    async def probe_camera(self, url):
+        """Probe one camera, at most concurrency at a time."""
+        async with self.semaphore:
+            result = await self.probe(url)
+        latencies = self.latencies.setdefault(
+            url, collections.deque(maxlen=self.LATENCY_SAMPLES)
+        )
+        if result["latency_ms"] is not None:
+            latencies.append(result["latency_ms"])
+        previous = self.results.get(url)
+        if result["reachable"]:
+            result["failures"] = 0
+        else:
+            result["failures"] = (previous["failures"] + 1
+                                  if previous else 1)
+            if not previous or previous["reachable"]:
+                logging.info("Camera at %s is unreachable: %s",
+                             urlparse(url).hostname, result["error"])
+        result["latency"] = RtspProber.latency_stats(latencies)
+        self.results[url] = result
+        return result
+
+    async def probe(self, url):
+        """Send OPTIONS and DESCRIBE to a camera and return the result."""
+        result = {
+            "reachable": False,
+            "status": None,
+            "error": None,
+            "latency_ms": None,
+            "describe_ms": None,
+            "streams": [],
+            "checked": datetime.now().strftime("%Y/%m/%d %H:%M:%S"),
+        }
+        session = None
+        start = time.monotonic()
+        try:
+            session = RtspSession(url)
+            await asyncio.wait_for(self.handshake(session, result, start),
+                                   self.timeout)
+        except asyncio.TimeoutError:
+            result["error"] = f"No answer in {self.timeout}s"
+        except (OSError, RtspError, ValueError,
+                asyncio.IncompleteReadError) as error:
+            result["error"] = str(error) or type(error).__name__
+        finally:
+            if session is not None:
+                await session.close()
+        return result
+
+    @staticmethod
+    async def handshake(session, result, start):
+        """Run the OPTIONS and DESCRIBE requests of a probe."""
+        await session.connect()
+        status, _, _ = await session.request("OPTIONS")
+        result["reachable"] = True
+        result["status"] = status
+        result["latency_ms"] = round((time.monotonic() - start) * 1000, 1)
+
+        start = time.monotonic()
+        status, _, body = await session.request(
+            "DESCRIBE", {"Accept": "application/sdp"}
+        )
+        result["status"] = status
+        result["describe_ms"] = round((time.monotonic() - start) * 1000, 1)
+        if status == 200:
+            result["streams"] = parse_sdp(body)
+        else:
+            result["error"] = f"DESCRIBE returned {status}"
+
+    @staticmethod
+    def latency_stats(latencies):
+        """Return min, mean, p90 and max of the recent latencies."""
+        if not latencies:
+            return None
+        ordered = sorted(latencies)
+        return {
+            "samples": len(ordered),
+            "min": ordered[0],
+            "mean": round(sum(ordered) / len(ordered), 1),
+            "p90": ordered[min(int(len(ordered) * 0.9), len(ordered) - 1)],
+            "max": ordered[-1],
+        }
+
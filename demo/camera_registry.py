@@ -0,0 +1,147 @@
+"""Module camera_registry
+
+Indexed registry of the USB, twin and added cameras.
+"""
+import itertools
+from collections import namedtuple
+from functools import cached_property
+
+CameraEntry = namedtuple("CameraEntry", ["id", "name", "url", "kind"])
+CameraEntry.__doc__ = """A camera. kind is one of CameraRegistry.KINDS."""
+
+
+class CameraRegistry():
+    """Immutable registry of cameras indexed by ID, name and URL.
+
+    The cameras are listed USB cameras first, then the twin sensors and
+    then the added cameras. Changes return a new registry that shares
+    every entry that did not change, so a registry can be kept in a
+    state snapshot. Camera names are expected to be unique; if they are
+    not, lookup by name finds the camera added last.
+    """
+
+    KINDS = ("usb", "twin", "added")
+
+    def __init__(self, sections=None, by_name=None, by_url=None):
+        self.sections = sections or {kind: {} for kind in self.KINDS}
+        self.by_name = by_name or {}
+        self.by_url = by_url or {}
+
+    def __len__(self):
+        return sum(len(section) for section in self.sections.values())
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(
+            section.values() for section in self.sections.values()
+        )
+
+    def find_id(self, camera_id):
+        """Return the camera with an ID, or None."""
+        for section in self.sections.values():
+            if camera_id in section:
+                return section[camera_id]
+        return None
+
+    def find_name(self, name):
+        """Return the camera with a name, or None."""
+        key = self.by_name.get(name)
+        return self.sections[key[0]][key[1]] if key else None
+
+    def find_url(self, url):
+        """Return the camera with a URL, or None."""
+        key = self.by_url.get(url)
+        return self.sections[key[0]][key[1]] if key else None
+
+    def first(self):
+        """Return the first camera, or None."""
+        return next(iter(self), None)
+
+    @cached_property
+    def names(self):
+        """Tuple of the camera names in order."""
+        return tuple(entry.name for entry in self)
+
+    def page(self, offset=0, limit=None, kind=None, query=None):
+        """Return (total, cameras) for a page of the matching cameras.
+
+        kind limits the listing to one kind of camera. query matches a
+        case insensitive part of the name or URL.
+        """
+        if kind is None:
+            cameras, total = iter(self), len(self)
+        else:
+            section = self.sections[kind]
+            cameras, total = iter(section.values()), len(section)
+        if query:
+            query = query.lower()
+            cameras = [
+                entry for entry in cameras
+                if query in entry.name.lower() or query in entry.url.lower()
+            ]
+            total = len(cameras)
+            cameras = iter(cameras)
+        stop = None if limit is None else offset + limit
+        return total, list(itertools.islice(cameras, offset, stop))
+
+    def with_section(self, kind, cameras):
+        """Return a registry with the cameras of a kind replaced.
+
+        Cameras that did not change keep their entries and their order.
+        """
+        section = self.sections[kind]
+        wanted = {entry.id: entry for entry in cameras}
+        removals = [camera_id for camera_id in section
+                    if camera_id not in wanted]
+        upserts = [entry for entry in wanted.values()
+                   if section.get(entry.id) != entry]
+        return self.with_changes(kind, upserts, removals)
+
+    def with_changes(self, kind, upserts=(), removals=()):
+        """Return a registry with cameras of a kind upserted or removed.
+
+        A changed camera keeps its place; new cameras go last.
+        """
+        if not upserts and not removals:
+            return self
+        section = dict(self.sections[kind])
+        by_name = dict(self.by_name)
+        by_url = dict(self.by_url)
+
+        def unindex(entry):
+            key = (kind, entry.id)
+            if by_name.get(entry.name) == key:
+                del by_name[entry.name]
+            if by_url.get(entry.url) == key:
+                del by_url[entry.url]
+
+        for camera_id in removals:
+            entry = section.pop(camera_id, None)
+            if entry is not None:
+                unindex(entry)
+        for entry in upserts:
+            entry = entry._replace(kind=kind)
+            old = section.get(entry.id)
+            if old is not None:
+                unindex(old)
+            section[entry.id] = entry
+            by_name[entry.name] = (kind, entry.id)
+            by_url[entry.url] = (kind, entry.id)
+
+        sections = dict(self.sections)
+        sections[kind] = section
+        return CameraRegistry(sections, by_name, by_url)
+
+
+if __name__ == '__main__':
+    REGISTRY = CameraRegistry().with_section("twin", [
+        CameraEntry(str(i), f"Camera {i}", f"rtsp://10.0.0.{i}/s", "twin")
+        for i in range(10)
+    ])
+    REGISTRY = REGISTRY.with_section("usb", [
+        CameraEntry("/dev/video0", "/dev/video0", "/dev/video0", "usb")
+    ])
+    print(REGISTRY.names)
+    print(REGISTRY.find_name("Camera 3"))
+    print(REGISTRY.find_url("rtsp://10.0.0.4/s"))
+    print(REGISTRY.page(offset=2, limit=3))
+    print(REGISTRY.page(query="camera 1"))
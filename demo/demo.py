@@ -1,50 +1,84 @@
 #!/usr/bin/env python3
 """Python Flask application for Optra Edge Python Skill Demo"""
 import os
-import re
-from time import sleep
-import asyncio
+import atexit
+import warnings
 import json
+import math
 import subprocess
+import threading
 from datetime import datetime
 from logging.config import dictConfig
 from flask import Flask, redirect, url_for, request, render_template, Response
 from flask.logging import create_logger
-import requests
-import urllib3
-import psutil
 from version import __version__
-from azure_iot import get_twin, send_outputs
+from audio_engine import AudioEngine, PRIORITY_SPEECH
+from azure_iot import get_connection
 from camera import Camera
+from camera_health import RtspProber
+from display import Display
+from detections import DetectionAggregator
+from hotplug import VideoDeviceWatcher
+from jobs import JobRunner, JobQueueFull
+from output_queue import OutputQueue
 from settings import Settings
-
+from snapshot import SnapshotStore
+from startup import Startup
+from supervisor import Supervisor
+from pipeline import PipelineRunner
+from playlist import PlaylistPlayer, find_media, parse_items
+from relay import RelayBoard, RELAY_OFF, RELAY_ON
+from twin_cache import TwinCache
+from tts_cache import TtsCache
 
 app = Flask(__name__)
 
-def get_active_hdmi_resolution():
-    # Run the xrandr command and capture the output
-    output = subprocess.check_output("xrandr").decode("utf-8")
+# Slow operations run here so requests do not block waitress threads
+jobs = JobRunner()
 
-    # Search for the HDMI output with its current active resolution (marked with a '*')
-    match = re.search(r'HDMI.*? connected.*?\n\s+(\d+)x(\d+)\s+\d+\.\d+\*', output)
+# Playlists can use the bundled videos and removable media
+MEDIA_DIRECTORIES = ["/demo/video", "/media"]
 
-    if match:
-        width, height = match.groups()
-        return int(width), int(height)
-    else:
-        return None
+# How the GPIOs page shows the relay states
+RELAY_LABELS = {RELAY_ON: "ON", RELAY_OFF: "OFF", None: "???"}
+
+def get_active_hdmi_resolution():
+    """Return the (width, height) of the HDMI output, or None.
+
+    The mode is cached by the display service, so this does not wait on
+    the X server.
+    """
+    return display.resolution()
+
+
+def hdmi_window_sink():
+    """Return the nv3dsink description that fills the HDMI output."""
+    resolution = get_active_hdmi_resolution()
+    if resolution is None:
+        return "nv3dsink"
+    x_res, y_res = resolution
+    return (
+        "nv3dsink window-x=0 window-y=0"
+        + " window-width=" + str(x_res) + " window-height=" + str(y_res)
+    )
 
 def gen(camera):
     """Video streaming generator function."""
 
-    # Start the frame capture
-    settings.camera.start(
-        settings.camera_source,
-        settings.usb_camera_pixel_format,
-        settings.usb_camera_resolution,
-        settings.usb_camera_frame_rate,
-        settings.selected_classifier
-    )
+    # Start the frame capture, or keep the running one if it already
+    # shows the selected camera, unless the camera is known to be dead.
+    # Then the test pattern is streamed instead of waiting for the open
+    # to time out.
+    state = settings.state.snapshot
+    entry = state.cameras.find_name(state.selected_camera)
+    if entry is not None and camera_health.is_dead(entry.url):
+        app.logger.info("Camera %s is unreachable, not opening it",
+                        state.selected_camera)
+    else:
+        settings.camera.apply(
+            *capture_options(state),
+            name=state.selected_camera
+        )
 
     try:
         yield b'--frame\r\n'
@@ -60,35 +94,86 @@ def gen(camera):
 
 
 def say_it(statement):
-    """Say the statement on the selected audio device."""
-    os.system(
-        "gtts-cli \""
-        + statement
-        + "\" --lang "
-        + settings.lang
-        + " | mpg123 -a "
-        + settings.audio_output_device
-        + " - &"
-    )
+    """Say the statement on the selected audio device.
+
+    The speech comes from the TTS cache, so a phrase said before starts
+    playing without being synthesized again. Speech plays ahead of music.
+    """
+    lang = settings.lang
+    device = settings.audio_output_device
+    path = tts_cache.lookup(statement, lang)
+    if path is not None:
+        audio_engine.play(device, path, PRIORITY_SPEECH)
+        return
+    # The speech is dropped if the audio is stopped while it is synthesized
+    threading.Thread(
+        target=synthesize_and_play,
+        args=(statement, lang, device, audio_engine.generation),
+        name="say-it",
+        daemon=True
+    ).start()
+
+
+def synthesize_and_play(statement, lang, device, generation):
+    """Synthesize a statement into the TTS cache and play it.
+
+    Nothing is played if the audio was stopped since generation.
+    """
+    try:
+        audio_engine.play(device, tts_cache.get(statement, lang),
+                          PRIORITY_SPEECH, generation=generation)
+    # pylint: disable=broad-except
+    except Exception as error:
+        app.logger.error("Could not synthesize speech: %s", error)
 
 
 def play_it(file):
-    """Play the file on HDMI and selected audio device."""
-    os.system(
-        "mpg123 -a "
-        + settings.audio_output_device
-        + " "
-        + file
-        + " &"
-    )
+    """Play the file on the selected audio device.
+
+    The file replaces the music that is playing or queued.
+    """
+    audio_engine.play(settings.audio_output_device, file, interrupt=True)
 
 
 def stop_all_videos():
     """Stop all the playing videos."""
-    for proc in psutil.process_iter():
-        if proc.name() == "cmdloop" or proc.name() == "gst-launch-1.0":
-            app.logger.info("Killing %s", str(proc.pid))
-            os.system("kill " + str(proc.pid))
+    playlist_player.stop()
+    video_runner.stop()
+    stop_camera_on_hdmi()
+
+
+def stop_camera_on_hdmi():
+    """Stop showing the camera on HDMI, with the capture that fed it."""
+    if settings.camera.capture_hdmi_sink is not None:
+        settings.camera.stop()
+    settings.camera.set_hdmi_sink(None)
+
+
+def hdmi_sinks():
+    """Return the video and audio sink descriptions for HDMI playback."""
+    return (
+        "nvvidconv ! " + hdmi_window_sink(),
+        "alsasink device=" + settings.audio_output_video_device
+    )
+
+
+def hide_pointer():
+    """Hide the mouse pointer on HDMI."""
+    display.hide_pointer()
+
+
+def show_pointer():
+    """Bring back the mouse pointer on HDMI."""
+    display.show_pointer()
+
+
+def launch_x_app(args):
+    """Display an X app on HDMI."""
+    hide_pointer()
+    try:
+        supervisor.launch("x_app", args)
+    except OSError as error:
+        app.logger.error("Could not start %s: %s", args[0], error)
 
 
 def make_tree(path):
@@ -114,13 +199,20 @@ def before_request_callback():
     app.logger.info("Before request: %s %s", request.method, request.path)
 
     # If we received a GET for any path other than /video_feed,
-    # /catpure_image, or any /static path, then we need
-    # to stop the video capture
+    # /cameras, /catpure_image, the health checks, or any /static, /jobs
+    # or /api path, then we need to stop the video capture. The cameras
+    # page keeps it running so a change of options is applied to the
+    # live capture, and so does a capture that is also shown on HDMI.
     if (
         request.method == "GET"
+        and settings.camera.capture_hdmi_sink is None
         and request.path != "/video_feed"
+        and request.path != "/cameras"
         and request.path != "/capture_image"
+        and request.path not in ("/healthz", "/readyz")
         and request.path[0:7] != "/static"
+        and request.path[0:5] != "/jobs"
+        and request.path[0:4] != "/api"
     ):
         settings.camera.stop()
 
@@ -129,6 +221,10 @@ def before_request_callback():
 def after_request_callback(response):
     """Runs after a request."""
     app.logger.info("After request: %s %s", request.method, request.path)
+
+    # POSTs change settings, so save them for the next restart
+    if request.method == "POST":
+        snapshots.schedule()
     return response
 
 
@@ -203,8 +299,17 @@ def vivaldi():
 #
 @app.route('/change_volume/<return_to>', methods=['POST'])
 def change_volume(return_to):
-    """Change the volume of the headphone jack."""
-    settings.set_volume(request.form.get('volume'))
+    """Change the volume of the headphone jack.
+
+    The change is coalesced and sent in the background.
+    """
+    volume = request.form.get('volume')
+    try:
+        if not math.isfinite(float(volume)):
+            raise ValueError(volume)
+    except (TypeError, ValueError):
+        return {"error": f"Invalid volume: {volume}"}, 400
+    settings.set_volume(volume)
     return redirect(url_for(return_to))
 
 
@@ -245,12 +350,34 @@ def change_voice():
 @app.route('/stopaudio')
 def stopaudio():
     """Stop the audio"""
-    for proc in psutil.process_iter():
-        if proc.name() == "mpg123" or proc.name() == "gtts-cli":
-            os.system("kill " + str(proc.pid))
+    audio_engine.stop()
     return redirect(url_for('audio'))
 
 
+@app.route('/api/processes')
+def api_processes():
+    """Return the supervised processes."""
+    return supervisor.status()
+
+
+@app.route('/api/video')
+def api_video():
+    """Return what the HDMI video pipeline is doing."""
+    return video_runner.status()
+
+
+@app.route('/api/display')
+def api_display():
+    """Return the cached state of the HDMI display."""
+    return display.status()
+
+
+@app.route('/api/audio')
+def api_audio():
+    """Return what the audio players are doing."""
+    return audio_engine.status()
+
+
 ###########################
 #
 # Video Page
@@ -280,9 +407,7 @@ def video():
 @app.route('/xclock')
 def xclock():
     """Display xclock on HDMI."""
-    # Hide the mouse pointer
-    os.system("xsetroot -cursor blank_pointer.xbm blank_pointer.xbm")
-    os.system("xclock -bg grey &")
+    launch_x_app(["xclock", "-bg", "grey"])
     return redirect(url_for('video'))
 
 
@@ -292,9 +417,7 @@ def xclock():
 @app.route('/xlogo')
 def xlogo():
     """Display xlogo on HDMI."""
-    # Hide the mouse pointer
-    os.system("xsetroot -cursor blank_pointer.xbm blank_pointer.xbm")
-    os.system("xlogo -bg forestgreen -fg limegreen &")
+    launch_x_app(["xlogo", "-bg", "forestgreen", "-fg", "limegreen"])
     return redirect(url_for('video'))
 
 
@@ -304,9 +427,8 @@ def xlogo():
 @app.route('/xterm')
 def xterm():
     """Display xterm on HDMI."""
-    # Hide the mouse pointer
-    os.system("xsetroot -cursor blank_pointer.xbm blank_pointer.xbm")
-    os.system("xterm -fa default -rv -fs 32 -e top -c &")
+    launch_x_app(["xterm", "-fa", "default", "-rv", "-fs", "32",
+                  "-e", "top", "-c"])
     return redirect(url_for('video'))
 
 
@@ -316,12 +438,11 @@ def xterm():
 @app.route('/playvideo')
 def playvideo():
     """Play a video on HDMI."""
-    stop_all_videos()
+    playlist_player.stop()
+    stop_camera_on_hdmi()
+    hide_pointer()
 
-    # Hide the mouse pointer
-    os.system("xsetroot -cursor blank_pointer.xbm blank_pointer.xbm")
-
-    x_res, y_res = get_active_hdmi_resolution()
+    video_sink, audio_sink = hdmi_sinks()
 
     videofile = request.args.get('videofile', default='earth.mp4')
     stream = request.args.get('stream')
@@ -329,50 +450,88 @@ def playvideo():
         uri = "file:///demo/video/" + videofile
     else:
         uri = stream
-    command = (
-        "gst-launch-1.0 uridecodebin"
-            + " uri="
-            +  uri
-            + " name=demux"
-            + " demux."
-                + " ! audioconvert"
-                + " ! audioresample"
-                + " ! alsasink device=" + settings.audio_output_video_device
-            + " demux."
-                + " ! nvvidconv"
-                + " ! nv3dsink window-x=0 window-y=0 window-width=" + str(x_res) + " window-height=" + str(y_res)
-    )
+    app.logger.info("Playing %s", uri)
+    video_runner.play_uri(uri, video_sink, audio_sink)
+    return redirect(url_for('video'))
+
+
+#
+# Playlist
+#
+@app.route('/api/media')
+def api_media():
+    """Return the videos that can go in a playlist."""
+    return {"media": find_media(MEDIA_DIRECTORIES)}
+
+
+@app.route('/api/playlist', methods=['GET', 'POST', 'DELETE'])
+def api_playlist():
+    """Play a playlist on HDMI, stop it or return what it is doing.
+
+    A POST takes {"items": [...], "loop": true}. Each item has a path
+    in the media directories or a uri, and an optional duration in
+    seconds.
     """
-    command = (
-        "gst-launch-1.0 filesrc"
-            + " location=/demo/video/"
-            + videofile
-            + " ! qtdemux name=demux"
-            + " demux.audio_0"
-                + " ! queue"
-                + " ! decodebin"
-                + " ! audioconvert"
-                + " ! audioresample"
-                + " ! alsasink device=" + settings.audio_output_video_device
-            + " demux.video_0"
-                + " ! queue"
-                + " ! decodebin"
-                + " ! nvvidconv"
-                + " ! videoscale"
-                + " ! nv3dsink window-x=0 window-y=0 window-width=" + str(x_res) + " window-height=" + str(y_res)
-    )
-    command = (
-        "gst-launch-1.0 playbin"
-            + " uri="
-            + uri
-            + " audio-sink=\"alsasink device=" + settings.audio_output_video_device + "\""
-            + " video-sink=\"nv3dsink window-x=0 window-y=0 window-width=" + str(x_res) + " window-height=" + str(y_res) + "\""
-    )
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        try:
+            items = parse_items(body.get("items") or [], MEDIA_DIRECTORIES)
+        except ValueError as error:
+            return {"error": str(error)}, 400
+        video_runner.stop()
+        stop_camera_on_hdmi()
+        hide_pointer()
+        video_sink, audio_sink = hdmi_sinks()
+        playlist_player.play(items, bool(body.get("loop", True)),
+                             video_sink, audio_sink)
+    elif request.method == 'DELETE':
+        playlist_player.stop()
+        show_pointer()
+    return playlist_player.status()
+
+
+def camera_state_changed(old, new):
+    """Change the running capture when the options it depends on change.
+
+    The change is applied in the background, in place where possible.
+    A camera known to be dead is not opened; the capture is stopped.
     """
+    if (
+        not settings.camera.is_running()
+        or capture_options(old) == capture_options(new)
+    ):
+        return
+    entry = new.cameras.find_name(new.selected_camera)
+    if entry is not None and camera_health.is_dead(entry.url):
+        settings.camera.stop()
+    else:
+        settings.camera.reconfigure_soon(*capture_options(new),
+                                         name=new.selected_camera)
 
-    app.logger.info(command)
-    os.system("/demo/cmdloop '" + command + "' &")
-    return redirect(url_for('video'))
+
+def rtsp_camera_urls():
+    """Return the URLs of the RTSP cameras to probe."""
+    return [
+        entry.url for entry in settings.state.snapshot.cameras
+        if Camera.is_rtsp_cam(entry.url)
+    ]
+
+
+def camera_registry_changed(old, new):
+    """Probe the cameras that were added to the registry."""
+    if old.cameras is not new.cameras:
+        camera_health.refresh()
+
+
+def capture_options(state):
+    """Return the state the frame capture depends on."""
+    return (
+        state.camera_source,
+        state.usb_camera_pixel_format,
+        state.usb_camera_resolution,
+        state.usb_camera_frame_rate,
+        state.selected_classifier,
+    )
 
 
 #
@@ -383,25 +542,40 @@ def playcamera():
     """Play selected camera on HDMI."""
 
     # Check for a slected camera
-    if not settings.camera_source:
+    state = settings.state.snapshot
+    if not state.camera_source:
         app.logger.info("No camera selected")
         return redirect(url_for('cameras'))
 
-    stop_all_videos()
-
-    # Hide the mouse pointer
-    os.system("xsetroot -cursor blank_pointer.xbm blank_pointer.xbm")
+    hide_pointer()
+
+    # Show the frames of the web stream capture on HDMI as well, so the
+    # camera is opened and decoded once
+    if Camera.can_share_hdmi(state.camera_source):
+        playlist_player.stop()
+        video_runner.stop()
+        video_sink, _ = hdmi_sinks()
+        settings.camera.set_hdmi_sink(video_sink)
+        entry = state.cameras.find_name(state.selected_camera)
+        if entry is not None and camera_health.is_dead(entry.url):
+            app.logger.info("Camera %s is unreachable, not opening it",
+                            state.selected_camera)
+        else:
+            how = settings.camera.apply(*capture_options(state),
+                                        name=state.selected_camera)
+            app.logger.info("Camera on HDMI: %s", how)
+        return redirect(url_for('video'))
 
-    x_res, y_res = get_active_hdmi_resolution()
+    stop_camera_on_hdmi()
 
-    if Camera.is_usb_cam(settings.selected_camera):
+    if Camera.is_usb_cam(state.selected_camera):
 
         #
         # USB Cameras
         #
         width = settings.usb_camera_width()
         height = settings.usb_camera_height()
-        pixel_format = settings.usb_camera_pixel_format
+        pixel_format = state.usb_camera_pixel_format
 
         # Set the Frame Rate as a fraction for gstreamer
         frame_rate = settings.usb_camera_fractional_frame_rate()
@@ -410,7 +584,7 @@ def playcamera():
         if pixel_format == "YUYV":
             pixel_format = "YUY2"
 
-        if settings.usb_camera_pixel_format == "MJPG":
+        if state.usb_camera_pixel_format == "MJPG":
             capture_type = "image/jpeg"
             decode_conv = " ! nvv4l2decoder"
         else:
@@ -418,8 +592,8 @@ def playcamera():
             decode_conv = " ! nvvidconv"
 
         command = (
-            "gst-launch-1.0 v4l2src"
-                + " device='" + settings.camera_source + "'"
+            "v4l2src"
+                + " device='" + state.camera_source + "'"
                 + " ! '" + capture_type
                     + ", width=" + width
                     + ", height=" + height
@@ -427,7 +601,7 @@ def playcamera():
                     + ", format=" + pixel_format + "'"
                 + decode_conv
                 + " ! 'video/x-raw(memory:NVMM)'"
-                + " ! nv3dsink window-x=0 window-y=0 window-width=" + str(x_res) + " window-height=" + str(y_res)
+                + " ! " + hdmi_window_sink()
         )
 
     else:
@@ -436,14 +610,14 @@ def playcamera():
         # RTSP Cameras
         #
         command = (
-            "gst-launch-1.0 rtspsrc "
-                + "location='" + settings.camera_source + "'"
+            "rtspsrc "
+                + "location='" + state.camera_source + "'"
                 + " ! decodebin"
-                + " ! nv3dsink window-x=0 window-y=0 window-width=" + str(x_res) + " window-height=" + str(y_res)
+                + " ! " + hdmi_window_sink()
         )
 
     app.logger.info(command)
-    os.system(command + " &")
+    video_runner.play(command)
     return redirect(url_for('video'))
 
 
@@ -453,14 +627,8 @@ def playcamera():
 @app.route('/stopx')
 def stopx():
     """Stop all X Apps."""
-    for proc in psutil.process_iter():
-        if proc.name() == "xclock" or \
-           proc.name() == "xlogo" or \
-           proc.name() == "xterm":
-            os.system("kill " + str(proc.pid))
-
-    # Bring back the mouse pointer
-    os.system("xsetroot -cursor_name left_ptr")
+    supervisor.stop("x_app")
+    show_pointer()
     return redirect(url_for('video'))
 
 
@@ -471,9 +639,7 @@ def stopx():
 def stopvideo():
     """Stop all videos"""
     stop_all_videos()
-
-    # Bring back the mouse pointer
-    os.system("xsetroot -cursor_name left_ptr")
+    show_pointer()
     return redirect(url_for('video'))
 
 
@@ -483,29 +649,54 @@ def stopvideo():
 #
 ###########################
 @app.route('/inputs', methods=['GET', 'POST'])
-async def inputs():
+def inputs():
     """Render the Inputs page."""
     if request.method == 'POST':
-        settings.twin = await get_twin()
-        settings.inputs_time = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-        settings.populate_attached_cameras()
-        return redirect(url_for('inputs'))
-
-    inputs_list = json.dumps(settings.twin["desired"]["inputs"], indent=4)
-    full_twin = json.dumps(settings.twin, indent=4)
+        # Desired property patches keep the cache current, so a refresh
+        # only resyncs in the background
+        try:
+            job = jobs.submit("refresh_twin",
+                              twin_cache.refresh,
+                              key="refresh_twin")
+        except JobQueueFull as error:
+            return str(error), 503
+        response = redirect(url_for('inputs'))
+        response.headers["X-Job-Id"] = job.id
+        return response
+
+    twin = twin_cache.twin
+    updated = twin_cache.updated
+    if twin_cache.provisional:
+        updated = "restored from the last run"
+    inputs_list = json.dumps(twin["desired"].get("inputs", {}), indent=4)
+    full_twin = json.dumps(twin, indent=4)
     return render_template("inputs.html",
                            inputs=inputs_list,
-                           inputsTime=settings.inputs_time,
+                           inputsTime=(updated
+                                       + " (version "
+                                       + str(twin_cache.version)
+                                       + ")"),
                            fullTwin=full_twin)
 
 
+@app.route('/api/twin')
+def api_twin():
+    """Return the cached module twin."""
+    return {
+        "version": twin_cache.version,
+        "updated": twin_cache.updated,
+        "provisional": twin_cache.provisional,
+        "twin": twin_cache.twin
+    }
+
+
 ###########################
 #
 # Outputs Page
 #
 ###########################
 @app.route('/outputs', methods=['GET', 'POST'])
-async def outputs():
+def outputs():
     """Render the Optputs page."""
     if request.method == 'POST':
         settings.output1 = request.form.get('output1')
@@ -513,11 +704,18 @@ async def outputs():
         msg = {}
         msg["output1"] = settings.output1
         msg["output2"] = settings.output2
-        sent = await send_outputs(msg)
-        settings.outmsg = ("Sent:\n"
-                           + json.dumps(sent, indent=4)
-                           + "\n\n"
-                           + datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+        sent = output_queue.put(msg)
+        if sent is None:
+            settings.outmsg = "Dropped: output queue and spool are full"
+        else:
+            settings.outmsg = ("Queued:\n"
+                               + json.dumps(sent, indent=4))
+        settings.outmsg += (
+            "\n\n"
+            + json.dumps(output_queue.stats())
+            + "\n\n"
+            + datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        )
         return redirect(url_for('outputs'))
 
     return render_template("outputs.html",
@@ -535,85 +733,180 @@ async def outputs():
 def cameras():
     """Render the Cameras page."""
 
-    settings.set_camera_source()
-    camera_source = settings.get_camera_source_with_obscured_password()
-    app.logger.info("Camera source is: %s", settings.camera_source)
+    # The capture options were checked when the state was changed, so
+    # just read one consistent snapshot
+    state = settings.state.snapshot
+    camera_source = settings.get_camera_source_with_obscured_password(
+        state.camera_source
+    )
+    app.logger.info("Camera source is: %s", camera_source)
     classifier_list = ["none"] + Camera.available_classifiers()
-    pixel_formats = []
+
+    # Show one page of the cameras, keeping the selected camera in the list
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    total, page_cameras = state.cameras.page(
+        (page - 1) * settings.CAMERAS_PER_PAGE,
+        settings.CAMERAS_PER_PAGE,
+        query=query
+    )
+    camera_list = [entry.name for entry in page_cameras]
+    if state.selected_camera and state.selected_camera not in camera_list:
+        camera_list.insert(0, state.selected_camera)
+    pages = max((total - 1) // settings.CAMERAS_PER_PAGE + 1, 1)
+
+    # Last probe results of the RTSP cameras
+    health = {}
+    for entry in page_cameras:
+        status = camera_health.status(entry.url)
+        if status is not None:
+            health[entry.name] = status
+    entry = state.cameras.find_name(state.selected_camera)
+    selected_health = camera_health.status(entry.url) if entry else None
+
     usb_camera_resolutions = []
     usb_camera_frame_rates = []
 
     pixel_formats = (
         settings.usb_camera_info.get_format_list(
-            settings.selected_camera
+            state.selected_camera
         )
     )
     if pixel_formats:
-        if settings.usb_camera_pixel_format not in pixel_formats:
-            settings.usb_camera_pixel_format = pixel_formats[0]
         usb_camera_resolutions = (
             settings.usb_camera_info.get_resolution_list(
-                settings.selected_camera,
-                settings.usb_camera_pixel_format
+                state.selected_camera,
+                state.usb_camera_pixel_format
             )
         )
-        if usb_camera_resolutions:
-            if settings.usb_camera_resolution not in usb_camera_resolutions:
-                settings.usb_camera_resolution = usb_camera_resolutions[0]
-            usb_camera_frame_rates = (
-                settings.usb_camera_info.get_fps_list(
-                    settings.selected_camera,
-                    settings.usb_camera_pixel_format,
-                    settings.usb_camera_resolution
-                )
+    if usb_camera_resolutions:
+        usb_camera_frame_rates = (
+            settings.usb_camera_info.get_fps_list(
+                state.selected_camera,
+                state.usb_camera_pixel_format,
+                state.usb_camera_resolution
             )
-        else:
-            settings.usb_camera_resolution = ""
-
-    if usb_camera_frame_rates:
-        if settings.usb_camera_frame_rate not in usb_camera_frame_rates:
-            settings.usb_camera_frame_rate = usb_camera_frame_rates[0]
-    else:
-        settings.usb_camera_frame_rate = ""
+        )
 
     return render_template(
         "cameras.html",
         cameraSource=camera_source,
-        cameraList=settings.camera_list,
-        selectedCamera=settings.selected_camera,
+        cameraList=camera_list,
+        cameraQuery=query,
+        cameraPage=page,
+        cameraPages=pages,
+        cameraTotal=total,
+        cameraHealth=health,
+        selectedHealth=selected_health,
+        selectedCamera=state.selected_camera,
         classifierList=classifier_list,
-        selectedClassifier=settings.selected_classifier,
+        selectedClassifier=state.selected_classifier,
         cameraResolutions=settings.CAMERA_RESOLUTIONS,
-        cameraResolution=settings.camera_resolution,
+        cameraResolution=state.camera_resolution,
         cameraCompressions=settings.CAMERA_COMPRESSIONS,
-        cameraCompression=settings.camera_compression,
+        cameraCompression=state.camera_compression,
         fpsValues=settings.FPS_VALUES,
-        fpsValue=settings.fps_value,
+        fpsValue=state.fps_value,
         pixelFormats=pixel_formats,
-        pixelFormat=settings.usb_camera_pixel_format,
+        pixelFormat=state.usb_camera_pixel_format,
         usbCameraResolutions=usb_camera_resolutions,
-        usbCameraResolution=settings.usb_camera_resolution,
+        usbCameraResolution=state.usb_camera_resolution,
         usbCameraFrameRates=usb_camera_frame_rates,
-        usbCameraFrameRate=settings.usb_camera_frame_rate,
-        cameraType=Camera.camera_type(settings.camera_source)
+        usbCameraFrameRate=state.usb_camera_frame_rate,
+        cameraType=Camera.camera_type(state.camera_source)
     )
 
 
+@app.route('/api/cameras')
+def api_cameras():
+    """Return a page of the cameras.
+
+    Query arguments: offset, limit, kind (usb, twin or added) and q to
+    filter by part of the name or URL, or name or url to look up one
+    camera.
+    """
+    state = settings.state.snapshot
+    cameras = state.cameras
+    if 'name' in request.args or 'url' in request.args:
+        if 'name' in request.args:
+            entry = cameras.find_name(request.args['name'])
+        else:
+            entry = cameras.find_url(request.args['url'])
+        total, page = (1, [entry]) if entry else (0, [])
+        offset, limit = 0, 1
+    else:
+        kind = request.args.get('kind')
+        if kind is not None and kind not in cameras.KINDS:
+            return {"error": "unknown kind"}, 400
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+        total, page = cameras.page(offset, limit, kind,
+                                   request.args.get('q'))
+    return {
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "selected": state.selected_camera,
+        "cameras": [camera_to_dict(entry) for entry in page],
+    }
+
+
+@app.route('/api/cameras/<path:camera_id>')
+def api_camera(camera_id):
+    """Return a camera by its ID."""
+    entry = settings.state.snapshot.cameras.find_id(camera_id)
+    if entry is None:
+        return {"error": "unknown camera"}, 404
+    return camera_to_dict(entry)
+
+
+def camera_to_dict(entry):
+    """Return a registry entry as a dict with the password obscured."""
+    camera = entry._asdict()
+    camera["url"] = settings.get_camera_source_with_obscured_password(
+        entry.url
+    )
+    camera["health"] = camera_health.status(entry.url)
+    return camera
+
+
+@app.route('/api/cameras/health')
+def api_camera_health():
+    """Return a summary of the RTSP camera probes."""
+    return camera_health.stats()
+
+
 #
 # Change Camera
 #
 @app.route('/change_camera', methods=['POST'])
 def change_camera():
     """Change the selected camera."""
-    settings.selected_camera = request.form.get('selectedCamera')
+    state = settings.update_camera_state(
+        selected_camera=request.form.get('selectedCamera')
+    )
     settings.camera_change = True
-    settings.set_camera_source()
-    app.logger.info("Camera source is: %s", settings.camera_source)
+
+    # The stream checks the cached probe before opening the camera, so
+    # a camera that was never probed, or may have recovered since it
+    # was found dead, is probed again in the background
+    entry = state.cameras.find_name(state.selected_camera)
+    if entry is not None and Camera.is_rtsp_cam(entry.url):
+        if camera_health.is_dead(entry.url):
+            app.logger.info("Camera %s was unreachable, probing it again",
+                            entry.name)
+            camera_health.probe_soon(entry.url)
+        elif camera_health.status(entry.url) is None:
+            camera_health.probe_soon(entry.url)
+    app.logger.info("Camera source is: %s",
+                    settings.get_camera_source_with_obscured_password(
+                        state.camera_source
+                    ))
     app.logger.info("%s %s %s %s",
-                    settings.selected_camera,
-                    settings.camera_resolution,
-                    settings.camera_compression,
-                    settings.fps_value)
+                    state.selected_camera,
+                    state.camera_resolution,
+                    state.camera_compression,
+                    state.fps_value)
     return redirect(url_for('cameras'))
 
 
@@ -622,15 +915,26 @@ def change_camera():
 #
 @app.route('/refresh_usb_cameras', methods=['GET'])
 def refresh_usb_cameras():
-    """Refresh list of USB cameras.."""
+    """Refresh list of USB cameras in the background.
+
+    Cameras already probed are served from the cache unless ?force=1.
+    """
+    try:
+        job = jobs.submit(
+            "refresh_usb_cameras",
+            settings.refresh_usb_cameras,
+            request.args.get('force') == '1',
+            key="refresh_usb_cameras"
+        )
+    except JobQueueFull as error:
+        return str(error), 503
     usb_camera_info_str = json.dumps(
-        settings.usb_camera_info.refresh(),
+        settings.usb_camera_info.get_all(),
         indent=4
     )
-    settings.usb_cameras = settings.usb_camera_info.get_devices_list()
-    settings.populate_attached_cameras()
     return render_template("refusbcam.html",
-                           list=usb_camera_info_str)
+                           list=usb_camera_info_str,
+                           job=job.to_dict())
 
 
 #
@@ -710,18 +1014,22 @@ def change_usb_camera_frame_rate():
 @app.route('/change_camera_attributes', methods=['POST'])
 def change_camera_attributes():
     """Change the selected camera's attributes."""
-    settings.camera_resolution = request.form.get('cameraResolution')
-    settings.camera_compression = request.form.get('cameraCompression')
-    settings.fps_value = request.form.get('fpsValue')
+    state = settings.update_camera_state(
+        camera_resolution=request.form.get('cameraResolution'),
+        camera_compression=request.form.get('cameraCompression'),
+        fps_value=request.form.get('fpsValue')
+    )
     settings.camera_change = True
-    settings.set_camera_source()
-    app.logger.info("Camera source is: %s", settings.camera_source)
+    app.logger.info("Camera source is: %s",
+                    settings.get_camera_source_with_obscured_password(
+                        state.camera_source
+                    ))
     app.logger.info(
         "%s %s %s %s",
-        settings.selected_camera,
-        settings.camera_resolution,
-        settings.camera_compression,
-        settings.fps_value
+        state.selected_camera,
+        state.camera_resolution,
+        state.camera_compression,
+        state.fps_value
     )
     return redirect(url_for('cameras'))
 
@@ -750,6 +1058,44 @@ def video_feed():
     )
 
 
+###########################
+#
+# Health and Readiness
+#
+###########################
+@app.route('/healthz')
+def healthz():
+    """Report that the server is up."""
+    return {"status": "ok"}
+
+
+@app.route('/readyz')
+def readyz():
+    """Report the startup initializers and whether they are done."""
+    status = startup.status()
+    return status, 200 if status["ready"] else 503
+
+
+###########################
+#
+# Background Jobs
+#
+###########################
+@app.route('/jobs')
+def list_jobs():
+    """Return the status of the background jobs."""
+    return {"jobs": jobs.list()}
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Return the status of a background job."""
+    job = jobs.get(job_id)
+    if job is None:
+        return {"error": "unknown job"}, 404
+    return job.to_dict()
+
+
 ###########################
 #
 # Removable Media
@@ -771,37 +1117,12 @@ def removable_media():
 @app.route('/gpios')
 def gpios():
     """Render the GPIOs page."""
-    try:
-        fd = os.open("/dev/ttyUSB0", os.O_RDWR)
-    except Exception:
-        fd = None
-    state1 = "???"
-    state2 = "???"
-    if fd:
-        os.system("stty -F /dev/ttyUSB0 9600 ignbrk -brkint -imaxbel -opost -onlcr -isig -icanon -iexten -echo -echoe -echok -echoctl -echoke noflsh -ixon -crtscts")
-        os.write(fd, b'\xff\x01\x03')
-        sleep(0.1)
-        status1 = os.read(fd, 3)
-        if status1[2] == 1:
-            state1 = "ON"
-        elif status1[2] == 0:
-            state1 = "OFF"
-        else:
-            state1 = "!!!"
-
-        os.write(fd, b'\xff\x02\x03')
-        sleep(0.1)
-        status2 = os.read(fd, 3)
-
-        if status2[2] == 1:
-            state2 = "ON"
-        elif status2[2] == 0:
-            state2 = "OFF"
-        else:
-            state2 = "!!!"
-        os.close(fd)
+    states = relays.get_states()
+    state1, state2 = (
+        RELAY_LABELS.get(states[relay], "!!!") for relay in (1, 2)
+    )
 
-    if fd:
+    if relays.connected:
         warning = ""
     else:
         warning = ("Warning: This device ("
@@ -812,36 +1133,33 @@ def gpios():
                            state1=state1,
                            state2=state2)
 
-def ttyusb_write(s):
-    try:
-        fd = os.open("/dev/ttyUSB0", os.O_RDWR)
-    except Exception:
-        fd = None
-    if fd:
-        os.write(fd, s)
-        os.close(fd)
-
 
 @app.route('/poweron1')
 def poweron1():
-    ttyusb_write(b'\xff\x01\x01')
+    relays.set(1, True)
     return redirect(url_for('gpios'))
 
 @app.route('/poweroff1')
 def poweroff1():
-    ttyusb_write(b'\xff\x01\x00')
+    relays.set(1, False)
     return redirect(url_for('gpios'))
 
 @app.route('/poweron2')
 def poweron2():
-    ttyusb_write(b'\xff\x02\x01')
+    relays.set(2, True)
     return redirect(url_for('gpios'))
 
 @app.route('/poweroff2')
 def poweroff2():
-    ttyusb_write(b'\xff\x02\x00')
+    relays.set(2, False)
     return redirect(url_for('gpios'))
 
+
+@app.route('/api/relays')
+def api_relays():
+    """Return the relay board connection and relay states."""
+    return relays.status()
+
 ###########################
 #
 # System Page
@@ -879,10 +1197,8 @@ def about():
 ###########################
 if __name__ == '__main__':
 
-    # Eliminate insecure reqests warnings
-    requests.packages.urllib3.disable_warnings(
-        urllib3.exceptions.InsecureRequestWarning
-    )
+    # Eliminate insecure reqests warnings without importing requests
+    warnings.filterwarnings("ignore", message="Unverified HTTPS request")
 
     # Setup logging
     dictConfig({
@@ -912,18 +1228,115 @@ if __name__ == '__main__':
     # Initialize settings
     settings = Settings()
 
-    # Get Module Twin
-    settings.twin = asyncio.run(get_twin())
+    # Keep the Module Twin current from desired property patches.
+    # The attached cameras are populated from the twin by settings.
+    twin_cache = TwinCache(get_connection())
+    twin_cache.subscribe(settings.twin_changed)
 
-    # Populate attached cameras from the twin
-    settings.populate_attached_cameras()
+    # Restore the state and last known twin from before the restart.
+    # The live twin is fetched in the background by startup.
+    snapshots = SnapshotStore(
+        os.getenv("SNAPSHOT_PATH", "/tmp/settings-snapshot.json"),
+        settings.to_snapshot
+    )
+    snapshot = snapshots.load()
+    if snapshot:
+        settings.restore_snapshot(snapshot)
+        if snapshot.get("twin"):
+            twin_cache.set_twin(snapshot["twin"], provisional=True)
+        app.logger.info("Restored settings snapshot")
+    twin_cache.subscribe(snapshots.schedule)
+    settings.state.subscribe(snapshots.schedule)
+    settings.state.subscribe(camera_state_changed)
+    atexit.register(snapshots.flush)
+
+    # Launch the HDMI apps and videos as supervised children
+    supervisor = Supervisor()
+    atexit.register(supervisor.stop_all)
+    video_runner = PipelineRunner(supervisor)
+    video_runner.start()
+    atexit.register(video_runner.stop)
+    playlist_player = PlaylistPlayer(video_runner)
+    playlist_player.start()
+    atexit.register(playlist_player.stop)
+
+    # Keep the relay board port open, and switch the relays in order
+    relays = RelayBoard(os.getenv("RELAY_DEVICE", "/dev/ttyUSB0"))
+    relays.start()
+    atexit.register(relays.stop)
+
+    # Run the slow initializers concurrently while the server starts
+    startup = Startup()
+    for name, func, required in settings.initializers():
+        startup.add(name, func, required)
+    # The hub can be unreachable at boot; the twin then arrives later
+    startup.add("twin", twin_cache.start, required=False)
+
+    # Cache synthesized speech, and synthesize the fixed phrases up front
+    tts_cache = TtsCache(
+        os.getenv("TTS_CACHE_DIR", "/tmp/tts-cache"),
+        max_bytes=int(os.getenv("TTS_CACHE_MB", "50")) * 1024 * 1024
+    )
+    startup.add(
+        "tts_cache",
+        lambda: tts_cache.prewarm(
+            [settings.WE_HOLD_THESE_TRUTHS, settings.what_to_say],
+            settings.lang
+        ),
+        required=False
+    )
+    # Keep one audio player per output device running, so clips start
+    # without spawning a player. The devices are known once the audio
+    # outputs have been listed.
+    audio_engine = AudioEngine()
+    startup.add(
+        "audio_engine",
+        lambda: audio_engine.prewarm(
+            {settings.audio_output_device, *settings.audio_devices.values()}
+        ),
+        required=False,
+        after=("audio_outputs", )
+    )
+    # Follow the HDMI mode and set the pointer over one X connection
+    display = Display()
+    startup.add("display", display.start, required=False)
+    atexit.register(display.stop)
+    startup.start()
+
+    # Add and remove USB cameras as they are plugged in and unplugged
+    VideoDeviceWatcher(
+        settings.usb_camera_added,
+        settings.usb_camera_removed
+    ).start()
+
+    # Send outputs to the hub in batches, spooling while it is offline
+    output_queue = OutputQueue(
+        get_connection(),
+        spool_path=os.getenv("OUTPUT_SPOOL_PATH", "/tmp/outputs.spool")
+    )
+    output_queue.start()
+
+    # Send classifier detections to the hub as windowed summaries
+    detections = DetectionAggregator(
+        output_queue.put,
+        window=float(os.getenv("DETECTION_WINDOW_SECONDS", "60"))
+    )
+    settings.camera.detections = detections
+    detections.start()
+
+    # Probe the RTSP cameras so dead ones are known before they are opened
+    camera_health = RtspProber(
+        rtsp_camera_urls,
+        interval=float(os.getenv("CAMERA_PROBE_INTERVAL", "30"))
+    )
+    camera_health.start()
+    settings.state.subscribe(camera_registry_changed)
 
     # Set directory for captured images
     app.config['UPLOAD_FOLDER'] = os.path.join('static', 'capture')
 
     # Log the environment variables and the module twin
     app.logger.info("Environment Variables: \n%s", settings.env_vars)
-    app.logger.info("Twin: \n%s", json.dumps(settings.twin, indent=4))
 
     # Development server
     # app.run(host='0.0.0.0', port=7000, debug=True, use_reloader=False)
@@ -0,0 +1,158 @@
+"""Module detections
+
+Aggregates per-camera classifier detections into time-windowed summaries
+that are sent to the hub as a single message per window.
+"""
+import logging
+import threading
+import time
+from datetime import datetime
+
+
+# pylint: disable=too-many-instance-attributes
+class DetectionAggregator():
+    """Roll detections up into windowed summaries and emit them in batches.
+
+    Example summary:
+
+    {
+        "detections": {
+            "windowStart": "2024/01/01 12:00:00",
+            "windowEnd": "2024/01/01 12:01:00",
+            "summaries": [
+                {
+                    "camera": "/dev/video0",
+                    "classifier": "haarcascade_frontalface_default.xml",
+                    "frames": 120,
+                    "detections": 150,
+                    "peak": 3,
+                    "dwell": 42.5
+                }
+            ]
+        }
+    }
+
+    """
+
+    def __init__(self, send, window=60.0, max_gap=1.0):
+        self.send = send
+        self.window = window
+        self.max_gap = max_gap
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.window_start = time.time()
+        self.windows_sent = 0
+        self.flush_thread = None
+        self.time_to_stop = threading.Event()
+
+    def record(self, camera, classifier, count, timestamp=None):
+        """Record the number of objects detected in one frame."""
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            stat = self.stats.get((camera, classifier))
+            if stat is None:
+                stat = {
+                    "frames": 0,
+                    "detections": 0,
+                    "peak": 0,
+                    "dwell": 0.0,
+                    "last_time": timestamp,
+                    "last_count": 0,
+                }
+                self.stats[(camera, classifier)] = stat
+
+            # Dwell is the time objects stayed in view. Gaps longer than
+            # max_gap (a stalled stream) are not counted.
+            if stat["last_count"] > 0:
+                gap = timestamp - stat["last_time"]
+                if 0 < gap <= self.max_gap:
+                    stat["dwell"] += gap
+
+            stat["frames"] += 1
+            stat["detections"] += count
+            stat["peak"] = max(stat["peak"], count)
+            stat["last_time"] = timestamp
+            stat["last_count"] = count
+
+    def flush(self, now=None):
+        """Close the current window and return its summary.
+
+        Returns None if nothing was detected during the window.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            stats = self.stats
+            self.stats = {}
+            window_start = self.window_start
+            self.window_start = now
+
+        summaries = []
+        for (camera, classifier), stat in stats.items():
+            if stat["detections"] == 0:
+                continue
+            summaries.append(
+                {
+                    "camera": camera,
+                    "classifier": classifier,
+                    "frames": stat["frames"],
+                    "detections": stat["detections"],
+                    "peak": stat["peak"],
+                    "dwell": round(stat["dwell"], 3),
+                }
+            )
+        if not summaries:
+            return None
+
+        return {
+            "detections": {
+                "windowStart": datetime.fromtimestamp(window_start)
+                                       .strftime("%Y/%m/%d %H:%M:%S"),
+                "windowEnd": datetime.fromtimestamp(now)
+                                     .strftime("%Y/%m/%d %H:%M:%S"),
+                "summaries": summaries,
+            }
+        }
+
+    def emit(self, now=None):
+        """Flush the current window and send it if anything was detected."""
+        summary = self.flush(now)
+        if summary is None:
+            return None
+        try:
+            # send() returns None when the summary was dropped
+            if self.send(summary) is not None:
+                self.windows_sent += 1
+        # pylint: disable=broad-except
+        except Exception as error:
+            logging.error("Failed to send detections: %s", error)
+        return summary
+
+    def start(self):
+        """Start the thread that emits a summary every window."""
+        if self.flush_thread and self.flush_thread.is_alive():
+            return
+        self.time_to_stop.clear()
+        self.window_start = time.time()
+        self.flush_thread = threading.Thread(
+            target=DetectionAggregator.flush_loop,
+            args=(self, ),
+            daemon=True
+        )
+        self.flush_thread.start()
+
+    def stop(self):
+        """Stop the emitting thread, sending any partial window."""
+        if self.flush_thread and self.flush_thread.is_alive():
+            self.time_to_stop.set()
+            self.flush_thread.join()
+        self.emit()
+
+    def flush_loop(self):
+        """Thread that emits a summary at the end of each window."""
+        logging.info("Starting detection flush_loop(), window=%s", self.window)
+        while not self.time_to_stop.wait(self.window):
+            self.emit()
+        logging.info("Ending detection flush_loop()")
+
@@ -0,0 +1,167 @@
+"""Module device_settings
+
+Client for the device settings web service.
+"""
+import json
+import logging
+import threading
+import time
+from lazy_import import lazy_import
+
+requests = lazy_import("requests")
+
+
+# pylint: disable=too-many-instance-attributes
+class DeviceSettingsClient():
+    """Sends settings to the device web service in the background.
+
+    Connections are kept alive in a requests.Session. Only the latest
+    value of each setting is kept, and values are sent once no newer
+    change has arrived for the debounce time, so dragging the volume
+    slider results in a single PUT. Failed PUTs are retried with
+    exponential backoff.
+    """
+
+    URL = "http://172.18.0.1:8080/webservices/noauth/settings"
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        url=URL,
+        debounce=0.25,
+        retries=3,
+        backoff=0.5,
+        timeout=(3, 5)
+    ):
+        self.url = url
+        self.debounce = debounce
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = None
+        self.pending = {}
+        self.last_change = 0.0
+        self.sending = False
+        self.last_success = None
+        self.condition = threading.Condition()
+        self.send_thread = None
+        self.counters = {
+            "requested": 0,
+            "coalesced": 0,
+            "sent": 0,
+            "failed": 0,
+        }
+
+    def set(self, name, value):
+        """Set a device setting. Returns without waiting for the PUT."""
+        with self.condition:
+            if name in self.pending:
+                self.counters["coalesced"] += 1
+            self.pending[name] = value
+            self.last_change = time.monotonic()
+            self.counters["requested"] += 1
+            self.condition.notify_all()
+        self.start()
+
+    def set_volume(self, vol):
+        """Set the volume of the headphone jack."""
+        self.set("AudioVolume", float(vol))
+
+    def start(self):
+        """Start the send thread if it is not running."""
+        with self.condition:
+            if self.send_thread and self.send_thread.is_alive():
+                return
+            self.send_thread = threading.Thread(
+                target=DeviceSettingsClient.send_loop,
+                args=(self, ),
+                name="device-settings",
+                daemon=True
+            )
+            self.send_thread.start()
+
+    def flush(self, timeout=None):
+        """Wait until every pending setting has been sent.
+
+        Returns whether the last PUT succeeded, or False if the timeout
+        expired first.
+        """
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: not self.pending and not self.sending,
+                timeout
+            ):
+                return False
+            return self.last_success is not False
+
+    def get_session(self):
+        """Return the keep-alive session, creating it on first use."""
+        if self.session is None:
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=2)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+        return self.session
+
+    def take_pending(self):
+        """Wait for changes to settle, then take the latest values."""
+        with self.condition:
+            while True:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+                remaining = self.last_change + self.debounce - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            pending = self.pending
+            self.pending = {}
+            self.sending = True
+        return pending
+
+    def put(self, values):
+        """PUT the values. Returns True on success.
+
+        Connection errors and server errors are retried with backoff.
+        """
+        data = json.dumps(values)
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                resp = self.get_session().put(self.url,
+                                              data=data,
+                                              timeout=self.timeout)
+                logging.info("Status: %s", resp.status_code)
+                logging.info("Content: %s", resp.text)
+                if resp.status_code < 400:
+                    return True
+                # A rejection would only be rejected again
+                if resp.status_code < 500:
+                    logging.error("Device settings %s rejected: %s %s",
+                                  values, resp.status_code, resp.text)
+                    return False
+                logging.warning("Device settings PUT failed: %s %s",
+                                resp.status_code, resp.text)
+            except requests.RequestException as error:
+                logging.warning("Device settings PUT failed: %s", error)
+            if attempt < self.retries:
+                time.sleep(delay)
+                delay *= 2
+        return False
+
+    def send_loop(self):
+        """Thread that sends the settings."""
+        while True:
+            values = self.take_pending()
+            success = self.put(values)
+            with self.condition:
+                if success:
+                    self.counters["sent"] += 1
+                else:
+                    logging.error("Giving up on device settings %s", values)
+                    self.counters["failed"] += 1
+                self.last_success = success
+                self.sending = False
+                self.condition.notify_all()
+
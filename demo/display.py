@@ -0,0 +1,229 @@
+"""Module display
+
+Keeps one connection to the X server of the HDMI output. The active mode
+is cached and refreshed on RandR change events, and the pointer is hidden
+or shown through the connection instead of running xrandr and xsetroot.
+"""
+import logging
+import os
+import threading
+
+# The left_ptr glyph of the X cursor font and its mask
+LEFT_PTR = 68
+
+
+# pylint: disable=too-many-instance-attributes
+class Display():
+    """Cached state of the X display.
+
+    python-xlib is imported on first use, so the application runs without
+    it; resolution() is then always None. Without a display resolution()
+    returns None at once, and the connection is retried in the background
+    every retry_interval seconds.
+    """
+
+    def __init__(self, name=None, output_prefix="HDMI", retry_interval=30.0):
+        self.name = name if name is not None else os.getenv("DISPLAY")
+        self.output_prefix = output_prefix
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.connection = None
+        self.has_randr = False
+        self.mode = None
+        self.pointer_hidden = None
+        self.cursors = {}
+        self.error = None
+        self.time_to_stop = threading.Event()
+        self.counters = {
+            "connects": 0,
+            "refreshes": 0,
+        }
+        self.thread = None
+
+    def start(self):
+        """Connect, and follow the display changes in the background."""
+        self.connect()
+        self.thread = threading.Thread(
+            target=Display.event_loop,
+            args=(self, ),
+            name="display",
+            daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        """Stop following the display."""
+        self.time_to_stop.set()
+        with self.lock:
+            connection = self.connection
+        if connection is not None:
+            connection.close()
+
+    def connect(self):
+        """Open the connection and read the mode. Returns success."""
+        if not self.name:
+            self.error = "DISPLAY is not set"
+            return False
+        try:
+            # pylint: disable=import-outside-toplevel
+            import Xlib.threaded  # noqa: F401 pylint: disable=unused-import
+            from Xlib import display, error
+            from Xlib.ext import randr
+        except ImportError as import_error:
+            self.error = str(import_error)
+            return False
+        try:
+            connection = display.Display(self.name)
+        except (error.DisplayError, OSError) as connect_error:
+            self.error = str(connect_error)
+            return False
+        root = connection.screen().root
+        self.has_randr = connection.has_extension("RANDR")
+        if self.has_randr:
+            root.xrandr_select_input(
+                randr.RRScreenChangeNotifyMask
+                | randr.RRCrtcChangeNotifyMask
+                | randr.RROutputChangeNotifyMask
+            )
+        with self.lock:
+            self.connection = connection
+            self.cursors = {}
+            self.pointer_hidden = None
+            self.error = None
+            self.counters["connects"] += 1
+        logging.info("Connected to display %s", self.name)
+        try:
+            self.refresh(connection)
+        except error.XError as refresh_error:
+            logging.error("Could not read the display mode: %s",
+                          refresh_error)
+        return True
+
+    def refresh(self, connection):
+        """Read the active mode of the HDMI output."""
+        # pylint: disable=import-outside-toplevel
+        from Xlib import X
+        from Xlib.ext import randr
+        mode = None
+        root = connection.screen().root
+        if self.has_randr:
+            resources = root.xrandr_get_screen_resources_current()
+            for output in resources.outputs:
+                info = connection.xrandr_get_output_info(
+                    output, resources.config_timestamp
+                )
+                if (
+                    info.connection != randr.Connected
+                    or info.crtc == X.NONE
+                    or not info.name.startswith(self.output_prefix)
+                ):
+                    continue
+                crtc = connection.xrandr_get_crtc_info(
+                    info.crtc, resources.config_timestamp
+                )
+                if crtc.mode != X.NONE:
+                    mode = (crtc.width, crtc.height)
+                    break
+        elif not self.output_prefix:
+            screen = connection.screen()
+            mode = (screen.width_in_pixels, screen.height_in_pixels)
+        with self.lock:
+            self.mode = mode
+            self.counters["refreshes"] += 1
+        logging.info("Display mode is %s", mode)
+
+    def event_loop(self):
+        """Thread that refreshes the mode when the outputs change."""
+        # pylint: disable=import-outside-toplevel
+        if not self.name:
+            return
+        while not self.time_to_stop.is_set():
+            with self.lock:
+                connection = self.connection
+            if connection is None:
+                if not self.connect():
+                    self.time_to_stop.wait(self.retry_interval)
+                continue
+            from Xlib import error
+            try:
+                # Only RandR events are selected, so any event means the
+                # outputs or modes changed
+                connection.next_event()
+                while connection.pending_events():
+                    connection.next_event()
+                self.refresh(connection)
+            except error.XError as refresh_error:
+                logging.error("Could not read the display mode: %s",
+                              refresh_error)
+            except (error.ConnectionClosedError, OSError) as closed:
+                logging.warning("Lost display %s: %s", self.name, closed)
+                with self.lock:
+                    self.connection = None
+                    self.mode = None
+                    self.error = str(closed)
+
+    def resolution(self):
+        """Return the (width, height) of the HDMI output, or None."""
+        with self.lock:
+            return self.mode
+
+    def hide_pointer(self):
+        """Hide the mouse pointer."""
+        self.set_pointer(hidden=True)
+
+    def show_pointer(self):
+        """Bring back the mouse pointer."""
+        self.set_pointer(hidden=False)
+
+    def set_pointer(self, hidden):
+        """Set the pointer of the root window, unless it is already set."""
+        with self.lock:
+            connection = self.connection
+            if connection is None or self.pointer_hidden == hidden:
+                return
+            cursor = self.cursors.get(hidden)
+            try:
+                if cursor is None:
+                    cursor = self.cursors[hidden] = Display.make_cursor(
+                        connection, hidden
+                    )
+                connection.screen().root.change_attributes(cursor=cursor)
+                connection.flush()
+            # pylint: disable=broad-except
+            except Exception as error:
+                logging.error("Could not set the pointer: %s", error)
+                return
+            self.pointer_hidden = hidden
+
+    @staticmethod
+    def make_cursor(connection, hidden):
+        """Create a blank cursor, or the left_ptr arrow."""
+        if hidden:
+            root = connection.screen().root
+            pixmap = root.create_pixmap(1, 1, 1)
+            gc = pixmap.create_gc(foreground=0)
+            pixmap.fill_rectangle(gc, 0, 0, 1, 1)
+            cursor = pixmap.create_cursor(pixmap, (0, 0, 0), (0, 0, 0), 0, 0)
+            gc.free()
+            pixmap.free()
+            return cursor
+        font = connection.open_font("cursor")
+        cursor = font.create_glyph_cursor(
+            font, LEFT_PTR, LEFT_PTR + 1,
+            (0, 0, 0), (65535, 65535, 65535)
+        )
+        font.close()
+        return cursor
+
+    def status(self):
+        """Return the display state."""
+        with self.lock:
+            return {
+                "display": self.name,
+                "connected": self.connection is not None,
+                "resolution": self.mode,
+                "pointer_hidden": self.pointer_hidden,
+                "error": self.error,
+                **self.counters,
+            }
+
@@ -0,0 +1,223 @@
+"""Module hotplug
+
+Watches /dev for video devices being added and removed.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import re
+import select
+import struct
+import threading
+import time
+
+# inotify event masks from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+# pylint: disable=too-many-instance-attributes
+class VideoDeviceWatcher():
+    """Calls on_add(device) and on_remove(device) as /dev/video* changes.
+
+    Uses inotify on /dev, and falls back to polling the directory when
+    inotify is not available. Events for a device are coalesced over a
+    short settle time so udev can finish setting its permissions before
+    it is probed. When on_add returns False, the device is added again
+    after retry_delay seconds, up to max_retries times, in case its
+    driver was not ready yet.
+    """
+
+    DEVICE_PATTERN = re.compile(r"^video\d+$")
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        on_add,
+        on_remove,
+        directory="/dev",
+        settle_time=0.5,
+        poll_interval=2.0,
+        retry_delay=2.0,
+        max_retries=3
+    ):
+        self.on_add = on_add
+        self.on_remove = on_remove
+        self.directory = directory
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self.devices = set()
+        self.failures = {}
+        self.watch_thread = None
+        self.time_to_stop = threading.Event()
+
+    def list_devices(self):
+        """Return the video devices currently in the directory."""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return set()
+        return {
+            os.path.join(self.directory, name)
+            for name in names
+            if self.DEVICE_PATTERN.match(name)
+        }
+
+    def start(self):
+        """Start watching for devices."""
+        if self.watch_thread and self.watch_thread.is_alive():
+            return
+        self.time_to_stop.clear()
+        self.devices = self.list_devices()
+        self.watch_thread = threading.Thread(
+            target=VideoDeviceWatcher.watch_loop,
+            args=(self, ),
+            name="video-hotplug",
+            daemon=True
+        )
+        self.watch_thread.start()
+
+    def stop(self):
+        """Stop watching for devices."""
+        if self.watch_thread and self.watch_thread.is_alive():
+            self.time_to_stop.set()
+            self.watch_thread.join()
+
+    def reconcile(self):
+        """Compare the directory with the known devices and report changes.
+
+        Returns True if a device that failed to add is to be retried.
+        """
+        devices = self.list_devices()
+        for device in sorted(self.devices - devices):
+            logging.info("Video device removed: %s", device)
+            self.dispatch(self.on_remove, device)
+        for device in set(self.failures) - devices:
+            del self.failures[device]
+        added = set()
+        for device in sorted(devices - self.devices):
+            if device in self.failures:
+                logging.info("Retrying video device %s", device)
+            else:
+                logging.info("Video device added: %s", device)
+            if self.dispatch(self.on_add, device) is not False:
+                self.failures.pop(device, None)
+                added.add(device)
+                continue
+            self.failures[device] = self.failures.get(device, 0) + 1
+            if self.failures[device] > self.max_retries:
+                logging.info("Giving up on video device %s", device)
+                del self.failures[device]
+                added.add(device)
+        self.devices = (self.devices & devices) | added
+        return bool(self.failures)
+
+    @staticmethod
+    def dispatch(callback, device):
+        """Call a callback, logging any failure. Returns its result."""
+        try:
+            return callback(device)
+        # pylint: disable=broad-except
+        except Exception as error:
+            logging.error("Hotplug handler failed for %s: %s", device, error)
+            return False
+
+    def watch_loop(self):
+        """Thread that waits for device changes."""
+        logging.info("Starting video hotplug watch_loop()")
+        inotify_fd = self.open_inotify()
+
+        # Pick up anything that changed before the watch was in place
+        retry = self.reconcile()
+        try:
+            if inotify_fd is None:
+                interval = self.poll_interval
+                while not self.time_to_stop.wait(interval):
+                    interval = self.poll_interval
+                    if self.reconcile():
+                        interval = min(interval, self.retry_delay)
+            else:
+                self.inotify_loop(inotify_fd, retry)
+        finally:
+            if inotify_fd is not None:
+                os.close(inotify_fd)
+        logging.info("Ending video hotplug watch_loop()")
+
+    def open_inotify(self):
+        """Return an inotify fd watching the directory, or None."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                               use_errno=True)
+            inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if inotify_fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            watch = libc.inotify_add_watch(
+                inotify_fd,
+                os.fsencode(self.directory),
+                IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_TO | IN_MOVED_FROM
+            )
+            if watch < 0:
+                os.close(inotify_fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        except (OSError, AttributeError) as error:
+            logging.info("inotify unavailable, polling %s: %s",
+                         self.directory, error)
+            return None
+        return inotify_fd
+
+    def inotify_loop(self, inotify_fd, retry=False):
+        """Read inotify events and reconcile once they settle."""
+        pending = time.monotonic() + self.retry_delay if retry else None
+        while not self.time_to_stop.is_set():
+            timeout = 1.0
+            if pending is not None:
+                timeout = max(0.0, pending - time.monotonic())
+            readable, _, _ = select.select([inotify_fd], [], [], timeout)
+            if readable:
+                if self.read_events(inotify_fd):
+                    pending = time.monotonic() + self.settle_time
+            elif pending is not None and time.monotonic() >= pending:
+                pending = None
+                if self.reconcile():
+                    pending = time.monotonic() + self.retry_delay
+
+    def read_events(self, inotify_fd):
+        """Read the queued events. Returns True if any were for videoN."""
+        try:
+            data = os.read(inotify_fd, 4096)
+        except BlockingIOError:
+            return False
+        found = False
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if self.DEVICE_PATTERN.match(os.fsdecode(name)):
+                found = True
+        return found
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    WATCHER = VideoDeviceWatcher(
+        lambda device: print("Added:", device),
+        lambda device: print("Removed:", device)
+    )
+    WATCHER.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        WATCHER.stop()
@@ -0,0 +1,133 @@
+"""Module jobs
+
+Runs slow operations in the background so requests return immediately.
+"""
+import collections
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobQueueFull(RuntimeError):
+    """Raised when too many jobs are already waiting to run."""
+
+
+# pylint: disable=too-many-instance-attributes
+class Job():
+    """A background operation and its status."""
+
+    def __init__(self, name, key):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.key = key
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def is_active(self):
+        """Return True if the job is queued or running."""
+        return self.status in ("queued", "running")
+
+    def to_dict(self):
+        """Return the job status as a dict.
+
+        The result is included when it can be represented as JSON.
+        """
+        result = None
+        if self.status == "succeeded":
+            try:
+                json.dumps(self.result)
+                result = self.result
+            except (TypeError, ValueError):
+                pass
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "result": result,
+            "error": self.error,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "seconds": (
+                self.finished - self.started
+                if self.finished and self.started else None
+            ),
+        }
+
+
+class JobRunner():
+    """Bounded executor for slow operations.
+
+    Jobs submitted with a key are deduplicated: while a job with the same
+    key is queued or running, submitting again returns that job.
+    """
+
+    def __init__(self, max_workers=4, max_pending=32, max_history=100):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="job")
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.active = {}
+        self.max_history = max_history
+
+    def submit(self, name, func, *args, key=None, **kwargs):
+        """Run func(*args, **kwargs) in the background and return its Job."""
+        with self.lock:
+            if key is not None and key in self.active:
+                return self.active[key]
+            pending = sum(1 for job in self.jobs.values() if job.is_active())
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"{pending} jobs already pending")
+            job = Job(name, key)
+            self.jobs[job.id] = job
+            if key is not None:
+                self.active[key] = job
+            # Forget the oldest finished jobs
+            while len(self.jobs) > self.max_history:
+                oldest = next(iter(self.jobs.values()))
+                if oldest.is_active():
+                    break
+                self.jobs.popitem(last=False)
+        self.executor.submit(self.run, job, func, args, kwargs)
+        return job
+
+    def run(self, job, func, args, kwargs):
+        """Run a job and record how it went."""
+        job.status = "running"
+        job.started = time.time()
+        try:
+            job.result = func(*args, **kwargs)
+            job.status = "succeeded"
+        # pylint: disable=broad-except
+        except Exception as error:
+            logging.error("Job %s failed: %s", job.name, error)
+            job.error = str(error)
+            job.status = "failed"
+        job.finished = time.time()
+        with self.lock:
+            if job.key is not None and self.active.get(job.key) is job:
+                del self.active[job.key]
+        job.done.set()
+
+    def get(self, job_id):
+        """Return a job by id, or None."""
+        return self.jobs.get(job_id)
+
+    def list(self):
+        """Return the status of the known jobs, newest first."""
+        with self.lock:
+            known = list(self.jobs.values())
+        return [job.to_dict() for job in reversed(known)]
+
+    def shutdown(self):
+        """Wait for the running jobs and stop the workers."""
+        self.executor.shutdown(wait=True)
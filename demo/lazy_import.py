@@ -0,0 +1,21 @@
+"""Module lazy_import
+
+Defers loading heavy modules until one of their attributes is used.
+"""
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """Return a module that is only executed on first attribute access."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,30 @@
+"""Module ordered_notify
+
+Delivers queued changes to callbacks in order from whichever thread
+made them.
+"""
+import logging
+
+
+def deliver_changes(changes, notify_lock, callbacks, what):
+    """Call every callback with each change in changes, in order.
+
+    changes is a deque of argument tuples. Only the thread holding
+    notify_lock delivers; a change queued meanwhile by another thread is
+    delivered by the thread that is already delivering. A callback that
+    raises is logged as "<what> failed" and the others still run.
+    """
+    while changes:
+        if not notify_lock.acquire(blocking=False):
+            return
+        try:
+            while changes:
+                change = changes.popleft()
+                for callback in callbacks:
+                    try:
+                        callback(*change)
+                    # pylint: disable=broad-except
+                    except Exception as error:
+                        logging.error("%s failed: %s", what, error)
+        finally:
+            notify_lock.release()
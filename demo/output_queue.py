@@ -0,0 +1,333 @@
+"""Module output_queue
+
+Batches output messages to the hub, applies backpressure when the hub
+falls behind and spools to disk while the hub is unreachable.
+"""
+import collections
+import json
+import logging
+import os
+import threading
+import time
+from azure_iot import build_message, send_batch
+
+
+class OutputSpool():
+    """Append-only on-disk spool of message batches.
+
+    Each line of the spool file is one JSON batch. The offset of the
+    next batch to send is kept in a separate file so a restart resumes
+    draining in order. Lines that cannot be read back, such as one cut
+    short by a power loss, are skipped.
+    """
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.offset_path = path + ".offset"
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.offset = 0
+        self.corrupt = 0
+        try:
+            with open(self.offset_path, "r", encoding="utf-8") as file:
+                self.offset = int(file.read().strip() or 0)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as error:
+            logging.error("Unreadable spool offset, resending the spool: %s",
+                          error)
+        self.end_last_line()
+
+    def end_last_line(self):
+        """End a line cut short, so the next batch starts on its own line."""
+        try:
+            with open(self.path, "rb+") as file:
+                file.seek(0, os.SEEK_END)
+                if file.tell() == 0:
+                    return
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    file.write(b"\n")
+        except FileNotFoundError:
+            pass
+
+    def size(self):
+        """Return the size of the spool file."""
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def pending(self):
+        """Return True if there are batches waiting to be sent."""
+        return self.offset < self.size()
+
+    def append(self, batch):
+        """Append a batch. Returns False if the spool is full."""
+        line = json.dumps(batch) + "\n"
+        with self.lock:
+            if self.size() + len(line) > self.max_bytes:
+                return False
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+        return True
+
+    def peek(self):
+        """Return the oldest unsent batch and the offset following it.
+
+        Unreadable lines are skipped for good. The batch is None when only
+        such lines were left.
+        """
+        with self.lock:
+            with open(self.path, "rb") as file:
+                file.seek(self.offset)
+                while True:
+                    line = file.readline()
+                    if not line:
+                        return None, self.offset
+                    try:
+                        return json.loads(line), file.tell()
+                    except ValueError as error:
+                        logging.error("Skipping corrupt spool line at %d: %s",
+                                      self.offset, error)
+                        self.corrupt += 1
+                        self.save_offset(file.tell())
+
+    def commit(self, offset):
+        """Mark everything before offset as sent."""
+        with self.lock:
+            if offset >= self.size():
+                # Fully drained, so start over with an empty spool
+                for path in (self.path, self.offset_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self.offset = 0
+                return
+            self.save_offset(offset)
+
+    def save_offset(self, offset):
+        """Write the offset atomically. Call with the lock held."""
+        self.offset = offset
+        tmp_path = self.offset_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(str(offset))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.offset_path)
+
+
+# pylint: disable=too-many-instance-attributes
+class OutputQueue():
+    """Bounded queue that sends output messages to the hub in batches.
+
+    put() blocks while the queue is full. If it is still full after the
+    timeout, the message is spilled to the disk spool, and only dropped
+    if the spool is full too. Spooled batches are drained, in order,
+    before anything newer is sent. Messages that overflow while a batch
+    is being sent are spooled after that batch, in case it fails.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        connection,
+        spool_path="/tmp/outputs.spool",
+        max_queued=1000,
+        batch_size=50,
+        batch_interval=1.0,
+        retry_interval=5.0,
+        send_timeout=30.0
+    ):
+        self.connection = connection
+        self.spool = OutputSpool(spool_path)
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.retry_interval = retry_interval
+        self.send_timeout = send_timeout
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        # Guards the counters and the order of the spool
+        self.lock = threading.Lock()
+        self.in_flight = False
+        self.overflow = []
+        self.counters = {
+            "queued": 0,
+            "sent": 0,
+            "spilled": 0,
+            "dropped": 0,
+            "batches": 0,
+        }
+        self.send_thread = None
+        self.time_to_stop = threading.Event()
+
+    def put(self, data, timeout=1.0):
+        """Queue data to be sent. Returns the message, or None if dropped."""
+        message = build_message(data)
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while len(self.queue) >= self.max_queued:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.time_to_stop.is_set():
+                    break
+                self.condition.wait(remaining)
+            if len(self.queue) < self.max_queued:
+                self.queue.append(message)
+                with self.lock:
+                    self.counters["queued"] += 1
+                self.condition.notify_all()
+                return message
+
+            # Backpressure timed out, so spill the queue and the message
+            # to disk, oldest first
+            backlog = list(self.queue) + [message]
+            self.queue.clear()
+            self.condition.notify_all()
+
+            with self.lock:
+                if self.in_flight:
+                    # The batch being sent is older, and is spooled first
+                    # if it fails
+                    self.overflow.extend(backlog)
+                    return message
+                return message if self.spill_all(backlog) else None
+
+    def stats(self):
+        """Return the counters along with the current queue depths."""
+        with self.lock:
+            stats = dict(self.counters)
+        stats["inMemory"] = len(self.queue)
+        stats["spoolBytes"] = self.spool.size() - self.spool.offset
+        stats["spoolCorrupt"] = self.spool.corrupt
+        return stats
+
+    def start(self):
+        """Start the thread that sends the batches."""
+        if self.send_thread and self.send_thread.is_alive():
+            return
+        self.time_to_stop.clear()
+        self.send_thread = threading.Thread(
+            target=OutputQueue.send_loop,
+            args=(self, ),
+            daemon=True
+        )
+        self.send_thread.start()
+
+    def stop(self):
+        """Stop the send thread and spool anything still queued."""
+        if self.send_thread and self.send_thread.is_alive():
+            self.time_to_stop.set()
+            with self.condition:
+                self.condition.notify_all()
+            self.send_thread.join()
+        batch = self.take_batch(0)
+        while batch:
+            self.settle(batch, sent=False)
+            batch = self.take_batch(0)
+
+    def take_batch(self, wait):
+        """Take up to batch_size messages, waiting for the batch to fill.
+
+        A batch that is taken is in flight until it is settled.
+        """
+        deadline = time.monotonic() + wait
+        with self.condition:
+            while (
+                len(self.queue) < self.batch_size
+                and not self.time_to_stop.is_set()
+            ):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = []
+            while self.queue and len(batch) < self.batch_size:
+                batch.append(self.queue.popleft())
+            if batch:
+                with self.lock:
+                    self.in_flight = True
+                self.condition.notify_all()
+        return batch
+
+    def settle(self, batch, sent):
+        """Spool a batch unless it was sent, then what overflowed meanwhile."""
+        with self.lock:
+            self.in_flight = False
+            if not sent:
+                self.spill(batch)
+            overflow, self.overflow = self.overflow, []
+            self.spill_all(overflow)
+
+    def spill_all(self, messages):
+        """Spool messages in batches. Call with the lock held.
+
+        Returns True only if every batch was spooled.
+        """
+        spilled = True
+        for start in range(0, len(messages), self.batch_size):
+            spilled = (
+                self.spill(messages[start:start + self.batch_size])
+                and spilled
+            )
+        return spilled
+
+    def spill(self, batch):
+        """Write a batch to the spool, dropping it if the spool is full.
+
+        Call with the lock held.
+        """
+        if self.spool.append(batch):
+            self.counters["spilled"] += len(batch)
+            return True
+        logging.error("Output spool full, dropping %d messages", len(batch))
+        self.counters["dropped"] += len(batch)
+        return False
+
+    def send(self, batch):
+        """Send one batch to the hub. Returns True on success."""
+        try:
+            self.connection.call(send_batch, batch,
+                                 timeout=self.send_timeout)
+        # pylint: disable=broad-except
+        except Exception as error:
+            logging.warning("Failed to send %d outputs: %s",
+                            len(batch), error)
+            return False
+        with self.lock:
+            self.counters["sent"] += len(batch)
+            self.counters["batches"] += 1
+        return True
+
+    def send_loop(self):
+        """Thread that sends spooled batches, then queued batches."""
+        logging.info("Starting output send_loop()")
+        while not self.time_to_stop.is_set():
+            try:
+                self.send_next()
+            # pylint: disable=broad-except
+            except Exception as error:
+                logging.error("Output send_loop() failed: %s", error)
+                self.time_to_stop.wait(self.retry_interval)
+        logging.info("Ending output send_loop()")
+
+    def send_next(self):
+        """Send the next spooled batch, or the next queued batch."""
+        # Drain the spool first so messages go out in order, without
+        # waiting for the live queue between the spooled batches
+        if self.spool.pending():
+            batch, offset = self.spool.peek()
+            if batch is None or self.send(batch):
+                self.spool.commit(offset)
+            else:
+                self.time_to_stop.wait(self.retry_interval)
+            return
+
+        batch = self.take_batch(self.batch_interval)
+        if not batch:
+            return
+        # Anything spooled since goes out first
+        self.settle(batch,
+                    sent=not self.spool.pending() and self.send(batch))
+
@@ -0,0 +1,431 @@
+"""Module pipeline
+
+Keeps a GStreamer pipeline playing on HDMI, restarting it with backoff
+when it fails and giving up when it keeps failing.
+"""
+import collections
+import logging
+import shlex
+import subprocess
+import threading
+import time
+
+from supervisor import obscure_password
+
+
+def load_gst():
+    """Return the GStreamer module, or None without the Python bindings.
+
+    The bindings are imported on first use so the runner works without
+    them, through gst-launch-1.0.
+    """
+    try:
+        # pylint: disable=import-outside-toplevel
+        import gi
+        gi.require_version("Gst", "1.0")
+        from gi.repository import Gst
+    except (ImportError, ValueError):
+        return None
+    Gst.init(None)
+    return Gst
+
+
+PipelineSpec = collections.namedtuple(
+    "PipelineSpec",
+    ["description", "uri", "video_sink", "audio_sink", "loop"]
+)
+PipelineSpec.__doc__ = """What to play.
+
+Either a gst-launch description, or a uri played by a playbin with the
+given sink descriptions.
+"""
+
+
+class GstPipeline():
+    """A pipeline run in process through the GStreamer bindings."""
+
+    def __init__(self, gst, spec):
+        self.gst = gst
+        self.spec = spec
+        if spec.uri is None:
+            # Parsed the way gst-launch-1.0 parses its arguments
+            self.pipeline = gst.parse_launch(
+                " ".join(shlex.split(spec.description))
+            )
+        else:
+            self.pipeline = gst.ElementFactory.make("playbin", None)
+            self.pipeline.set_property("uri", spec.uri)
+            for name, sink in (("video-sink", spec.video_sink),
+                               ("audio-sink", spec.audio_sink)):
+                if sink:
+                    self.pipeline.set_property(
+                        name, gst.parse_bin_from_description(sink, True)
+                    )
+        self.bus = self.pipeline.get_bus()
+        if (
+            self.pipeline.set_state(gst.State.PLAYING)
+            == gst.StateChangeReturn.FAILURE
+        ):
+            self.close()
+            raise RuntimeError("Pipeline would not start")
+
+    def update(self, spec):
+        """Play another uri in the same playbin, if only the uri changed.
+
+        Returns whether the change was made in place.
+        """
+        if (
+            self.spec.uri is None
+            or spec.uri is None
+            or self.spec._replace(uri=None) != spec._replace(uri=None)
+        ):
+            return False
+        self.pipeline.set_state(self.gst.State.READY)
+        self.pipeline.set_property("uri", spec.uri)
+        self.pipeline.set_state(self.gst.State.PLAYING)
+        self.spec = spec
+        return True
+
+    def poll(self, timeout):
+        """Wait for the pipeline to end.
+
+        Returns None while playing, "eos" at the end of the stream or the
+        text of an error.
+        """
+        message = self.bus.timed_pop_filtered(
+            int(timeout * self.gst.SECOND),
+            self.gst.MessageType.ERROR | self.gst.MessageType.EOS
+        )
+        if message is None:
+            return None
+        if message.type == self.gst.MessageType.EOS:
+            return "eos"
+        error, debug = message.parse_error()
+        return f"{error.message} ({debug})" if debug else error.message
+
+    def rewind(self):
+        """Play the stream again from the start without rebuilding."""
+        return self.pipeline.seek_simple(
+            self.gst.Format.TIME,
+            self.gst.SeekFlags.FLUSH | self.gst.SeekFlags.KEY_UNIT,
+            0
+        )
+
+    def close(self):
+        """Stop the pipeline."""
+        self.pipeline.set_state(self.gst.State.NULL)
+
+
+class ProcessPipeline():
+    """A pipeline run by gst-launch-1.0 under the supervisor."""
+
+    def __init__(self, supervisor, role, command, spec):
+        self.supervisor = supervisor
+        self.role = role
+        self.stderr = collections.deque(maxlen=20)
+        self.exited = threading.Event()
+        self.returncode = None
+        if spec.uri is None:
+            args = shlex.split(spec.description)
+        else:
+            # Without a shell each property is one argument, so the
+            # sink descriptions need no quoting
+            args = ["playbin", f"uri={spec.uri}"]
+            if spec.video_sink:
+                args.append(f"video-sink={spec.video_sink}")
+            if spec.audio_sink:
+                args.append(f"audio-sink={spec.audio_sink}")
+        self.child = supervisor.launch(
+            role,
+            list(command) + args,
+            on_exit=self.on_exit,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+        self.stderr_thread = threading.Thread(
+            target=ProcessPipeline.read_stderr,
+            args=(self, self.child.process.stderr),
+            name=f"{role}-stderr",
+            daemon=True
+        )
+        self.stderr_thread.start()
+
+    @staticmethod
+    def update(_spec):
+        """A running gst-launch cannot change what it plays."""
+        return False
+
+    def on_exit(self, _child, returncode):
+        """Called by the supervisor when gst-launch exits."""
+        self.returncode = returncode
+        self.exited.set()
+
+    def read_stderr(self, stderr):
+        """Thread that keeps the last lines gst-launch wrote to stderr."""
+        for line in stderr:
+            line = line.strip()
+            if line:
+                self.stderr.append(line)
+
+    def poll(self, timeout):
+        """Wait for gst-launch to exit.
+
+        Returns None while running, "eos" if it exited normally or the
+        text of the error.
+        """
+        if not self.exited.wait(timeout):
+            return None
+        if self.returncode == 0:
+            return "eos"
+        # The exit can be reported before the last of stderr is read
+        self.stderr_thread.join(1.0)
+        errors = [line for line in self.stderr if "ERROR" in line]
+        return (
+            (errors or list(self.stderr) or [""])[-1]
+            or f"gst-launch exited with {self.returncode}"
+        )
+
+    @staticmethod
+    def rewind():
+        """gst-launch has exited by the end of the stream."""
+        return False
+
+    def close(self):
+        """Stop gst-launch."""
+        self.supervisor.stop(self.role)
+
+
+# pylint: disable=too-many-instance-attributes
+class PipelineRunner():
+    """Keep one pipeline playing.
+
+    A failed pipeline is restarted after a delay that doubles with each
+    failure, from min_backoff up to max_backoff seconds. After
+    crash_limit failures within crash_window seconds the runner gives up
+    until it is asked to play something else. A looping pipeline plays
+    again from the start at the end of the stream.
+
+    Pipelines run in process when the GStreamer Python bindings are
+    available, otherwise through gst-launch-1.0 under the supervisor.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, supervisor, role="video", use_gst=True,
+                 command=("gst-launch-1.0", ), min_backoff=0.5,
+                 max_backoff=30.0, crash_limit=5, crash_window=60.0):
+        self.supervisor = supervisor
+        self.role = role
+        self.gst = load_gst() if use_gst else None
+        self.command = command
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.crash_limit = crash_limit
+        self.crash_window = crash_window
+        self.condition = threading.Condition()
+        self.wanted = None
+        self.retry_at = None
+        self.failures = collections.deque()
+        self.state = "stopped"
+        self.last_error = None
+        self.started = None
+        self.counters = {
+            "starts": 0,
+            "switches": 0,
+            "failures": 0,
+            "loops": 0,
+        }
+        self.thread = None
+
+    def start(self):
+        """Start the runner thread."""
+        self.thread = threading.Thread(
+            target=PipelineRunner.run_loop,
+            args=(self, ),
+            name=f"pipeline-{self.role}",
+            daemon=True
+        )
+        self.thread.start()
+
+    def play(self, description, loop=True):
+        """Play a gst-launch pipeline description."""
+        self.want(PipelineSpec(description, None, None, None, loop))
+
+    def play_uri(self, uri, video_sink=None, audio_sink=None, loop=True):
+        """Play a uri with playbin.
+
+        With the GStreamer bindings a change of uri alone is made in the
+        running playbin, without rebuilding the pipeline.
+        """
+        self.want(PipelineSpec(None, uri, video_sink, audio_sink, loop))
+
+    def want(self, spec):
+        """Ask the runner thread to play spec, or nothing for None."""
+        with self.condition:
+            self.wanted = spec
+            self.retry_at = time.monotonic() if spec is not None else None
+            self.failures.clear()
+            self.condition.notify_all()
+
+    def stop(self, timeout=5.0):
+        """Stop the pipeline and wait for it to stop."""
+        self.want(None)
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.state == "stopped", timeout
+            )
+
+    def due(self):
+        """Return whether a (re)start is due. Call with the lock held."""
+        return (
+            self.retry_at is not None
+            and self.retry_at <= time.monotonic()
+        )
+
+    def run_loop(self):
+        """Thread that keeps the wanted pipeline playing."""
+        pipeline = None
+        spec = None
+        while True:
+            with self.condition:
+                while (
+                    self.wanted is spec
+                    and pipeline is None
+                    and not self.due()
+                ):
+                    timeout = None
+                    if self.retry_at is not None:
+                        timeout = self.retry_at - time.monotonic()
+                    self.condition.wait(timeout)
+                wanted = self.wanted
+
+            if wanted is not spec:
+                if pipeline is not None and wanted is not None:
+                    if pipeline.update(wanted):
+                        spec = wanted
+                        with self.condition:
+                            self.counters["switches"] += 1
+                            self.started = time.monotonic()
+                        continue
+                if pipeline is not None:
+                    pipeline.close()
+                    pipeline = None
+                spec = wanted
+                if spec is None:
+                    self.set_state("stopped")
+                    continue
+
+            if pipeline is None:
+                with self.condition:
+                    if spec is None or not self.due():
+                        continue
+                    self.retry_at = None
+                pipeline = self.open(spec)
+                continue
+
+            result = pipeline.poll(0.1)
+            if result is None:
+                continue
+            if result == "eos" and not spec.loop:
+                pipeline.close()
+                pipeline = None
+                self.set_state("finished")
+                continue
+            # A looping stream that ends at once would restart in a
+            # busy loop, so that counts as a failure
+            ran = time.monotonic() - self.started
+            if result == "eos" and ran >= self.min_backoff:
+                with self.condition:
+                    self.counters["loops"] += 1
+                    self.started = time.monotonic()
+                if pipeline.rewind():
+                    continue
+                # Start it again at once, as the stream played through
+                pipeline.close()
+                pipeline = None
+                with self.condition:
+                    self.retry_at = time.monotonic()
+                continue
+            pipeline.close()
+            pipeline = None
+            self.failed(
+                "Stream ended at once" if result == "eos" else result
+            )
+
+    def open(self, spec):
+        """Start a pipeline for spec, returning None if it failed."""
+        try:
+            if self.gst is not None:
+                pipeline = GstPipeline(self.gst, spec)
+            else:
+                pipeline = ProcessPipeline(self.supervisor, self.role,
+                                           self.command, spec)
+        # pylint: disable=broad-except
+        except Exception as error:
+            self.failed(str(error))
+            return None
+        with self.condition:
+            self.counters["starts"] += 1
+            self.started = time.monotonic()
+            self.state = "playing"
+            self.condition.notify_all()
+        return pipeline
+
+    def set_state(self, state):
+        """Set the state and wake up the waiters."""
+        with self.condition:
+            self.state = state
+            self.condition.notify_all()
+
+    def failed(self, error):
+        """Schedule a restart after a failure, or give up."""
+        with self.condition:
+            now = time.monotonic()
+            self.counters["failures"] += 1
+            self.last_error = obscure_password(error)
+            self.failures.append(now)
+            while self.failures[0] < now - self.crash_window:
+                self.failures.popleft()
+            if len(self.failures) >= self.crash_limit:
+                logging.error("Pipeline failed %d times in %.0fs, giving "
+                              "up: %s", len(self.failures),
+                              self.crash_window, self.last_error)
+                self.state = "crash_loop"
+                self.retry_at = None
+            else:
+                delay = min(
+                    self.max_backoff,
+                    self.min_backoff * 2 ** (len(self.failures) - 1)
+                )
+                logging.warning("Pipeline failed, restarting in %.1fs: %s",
+                                delay, self.last_error)
+                self.state = "backoff"
+                self.retry_at = now + delay
+            self.condition.notify_all()
+
+    def status(self):
+        """Return what the runner is doing."""
+        with self.condition:
+            spec = self.wanted
+            playing = None
+            if spec is not None:
+                playing = obscure_password(
+                    spec.uri if spec.uri is not None else spec.description
+                )
+            retry_in = None
+            if self.retry_at is not None:
+                retry_in = round(max(0, self.retry_at - time.monotonic()), 1)
+            return {
+                "backend": "gst" if self.gst is not None else "gst-launch",
+                "state": self.state,
+                "playing": playing,
+                "uptime": (
+                    round(time.monotonic() - self.started, 1)
+                    if self.state == "playing" else None
+                ),
+                "retry_in": retry_in,
+                "recent_failures": len(self.failures),
+                "last_error": self.last_error,
+                **self.counters,
+            }
+
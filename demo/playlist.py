@@ -0,0 +1,461 @@
+"""Module playlist
+
+Plays a list of videos on HDMI back to back. With the GStreamer Python
+bindings the next item is queued in the playing playbin before the
+current one ends, so there is no gap between items.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+from pipeline import load_gst
+from supervisor import obscure_password
+
+MEDIA_EXTENSIONS = (".mp4", ".mkv", ".mov", ".avi", ".webm", ".mpg", ".ts")
+
+PlaylistItem = collections.namedtuple("PlaylistItem", ["uri", "duration"])
+PlaylistItem.__doc__ = """A playlist entry, cut after duration seconds
+unless duration is None."""
+
+
+def find_media(directories, max_depth=3):
+    """Return the video files in directories and their subdirectories."""
+    media = []
+    for directory in directories:
+        directory = os.path.abspath(directory)
+        for root, dirs, files in os.walk(directory):
+            depth = root[len(directory):].count(os.sep)
+            if depth >= max_depth:
+                dirs[:] = []
+            for name in sorted(files):
+                if not name.lower().endswith(MEDIA_EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                media.append({
+                    "name": name,
+                    "path": path,
+                    "uri": "file://" + path,
+                    "size": size,
+                })
+    return media
+
+
+def parse_items(entries, directories):
+    """Return PlaylistItems for a list of entries from the API.
+
+    An entry has a uri, or the path of a file in one of directories,
+    relative to the first one. It may have a duration in seconds.
+    Raises ValueError for a bad entry.
+    """
+    roots = [os.path.realpath(directory) for directory in directories]
+    items = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise ValueError("an item must be an object")
+        duration = entry.get("duration")
+        if duration is not None:
+            if (
+                isinstance(duration, bool)
+                or not isinstance(duration, (int, float))
+                or duration <= 0
+            ):
+                raise ValueError("duration must be a positive number")
+            duration = float(duration)
+        if "path" in entry:
+            path = os.path.realpath(
+                os.path.join(roots[0], str(entry["path"]))
+            )
+            if not any(path.startswith(root + os.sep) for root in roots):
+                raise ValueError(f"{entry['path']} is not in the media "
+                                 "directories")
+            if not os.path.isfile(path):
+                raise ValueError(f"{entry['path']} does not exist")
+            uri = "file://" + path
+        elif "uri" in entry:
+            uri = str(entry["uri"]).strip()
+            if "://" not in uri:
+                raise ValueError(f"{uri} is not a uri")
+        else:
+            raise ValueError("an item needs a path or a uri")
+        items.append(PlaylistItem(uri, duration))
+    if not items:
+        raise ValueError("the playlist is empty")
+    return items
+
+
+# pylint: disable=too-many-instance-attributes
+class PlaylistPlayer():
+    """Play a playlist on HDMI.
+
+    With the GStreamer bindings one playbin plays the whole playlist.
+    When the playing item is about to finish, playbin asks for the next
+    uri and prerolls it, so the next item starts without a gap. An item
+    with a duration has the end of its segment set to the duration, so
+    it finishes the same way. A probe on the video sink measures the
+    time between the last frame of an item and the first frame of the
+    next one.
+
+    Without the bindings the items play one after another through the
+    pipeline runner, with a gap between them.
+    """
+
+    def __init__(self, runner, use_gst=True):
+        self.runner = runner
+        self.gst = load_gst() if use_gst else None
+        self.condition = threading.Condition()
+        self.items = []
+        self.loop = True
+        self.sinks = (None, None)
+        self.generation = 0
+        self.index = None
+        self.next_index = None
+        self.state = "stopped"
+        self.last_error = None
+        self.started = None
+        self.cut_at = None
+        self.frames = {
+            "last": None,
+            "boundary": False,
+            "interval_ms": None,
+        }
+        self.gaps_ms = collections.deque(maxlen=100)
+        self.counters = {
+            "transitions": 0,
+            "loops": 0,
+            "errors": 0,
+        }
+        self.thread = None
+
+    def start(self):
+        """Start the player thread."""
+        self.thread = threading.Thread(
+            target=(PlaylistPlayer.gst_loop if self.gst is not None
+                    else PlaylistPlayer.runner_loop),
+            args=(self, ),
+            name="playlist",
+            daemon=True
+        )
+        self.thread.start()
+
+    def play(self, items, loop=True, video_sink=None, audio_sink=None):
+        """Play a list of PlaylistItems from the start."""
+        with self.condition:
+            self.items = list(items)
+            self.loop = loop
+            self.sinks = (video_sink, audio_sink)
+            self.generation += 1
+            self.state = "starting"
+            self.last_error = None
+            self.condition.notify_all()
+
+    def stop(self, timeout=5.0):
+        """Stop the playlist and wait for it to stop."""
+        with self.condition:
+            if self.state == "stopped":
+                return
+            self.items = []
+            self.generation += 1
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: self.state == "stopped", timeout)
+
+    def following(self, index):
+        """Return the index after index, or None at the end.
+
+        Call with the lock held.
+        """
+        if index + 1 < len(self.items):
+            return index + 1
+        return 0 if self.loop else None
+
+    def set_state(self, state):
+        """Set the state and wake up the waiters."""
+        with self.condition:
+            self.state = state
+            self.condition.notify_all()
+
+    def wait_for_playlist(self, generation):
+        """Wait for a playlist other than generation.
+
+        Returns the new generation, or None to stop.
+        """
+        with self.condition:
+            while self.generation == generation:
+                self.condition.wait()
+            if not self.items:
+                return None
+            return self.generation
+
+    def gst_loop(self):
+        """Thread that plays the playlists with one playbin."""
+        gst = self.gst
+        generation = 0
+        while True:
+            generation = self.wait_for_playlist(generation)
+            while generation is not None:
+                generation = self.play_with_playbin(gst, generation)
+            self.set_state("stopped")
+            generation = self.generation
+
+    def play_with_playbin(self, gst, generation):
+        """Play the playlist of generation until it is replaced.
+
+        Returns the generation to play next, or None to stop.
+        """
+        with self.condition:
+            video_sink, audio_sink = self.sinks
+            self.index = 0
+            self.next_index = None
+            uri = self.items[0].uri
+        playbin = gst.ElementFactory.make("playbin", None)
+        playbin.set_property("uri", uri)
+        if audio_sink:
+            playbin.set_property(
+                "audio-sink", gst.parse_bin_from_description(audio_sink, True)
+            )
+        sink = gst.parse_bin_from_description(
+            video_sink or "autovideosink", True
+        )
+        playbin.set_property("video-sink", sink)
+        sink.get_static_pad("sink").add_probe(
+            gst.PadProbeType.BUFFER | gst.PadProbeType.EVENT_DOWNSTREAM,
+            self.on_sink_data
+        )
+        playbin.connect("about-to-finish", self.on_about_to_finish)
+        bus = playbin.get_bus()
+        playbin.set_state(gst.State.PLAYING)
+        failures = 0
+        try:
+            while True:
+                with self.condition:
+                    if self.generation != generation:
+                        return self.generation if self.items else None
+                    cut = (
+                        self.cut_at is not None
+                        and time.monotonic() >= self.cut_at
+                    )
+                message = bus.timed_pop_filtered(
+                    100 * gst.MSECOND,
+                    gst.MessageType.ERROR
+                    | gst.MessageType.EOS
+                    | gst.MessageType.STREAM_START
+                )
+                if cut:
+                    # The segment end could not be set, so cut the item
+                    # by switching uri, with a short gap
+                    if not self.skip(playbin, gst):
+                        self.set_state("finished")
+                        self.wait_for_playlist(generation)
+                        return self.generation if self.items else None
+                if message is None:
+                    continue
+                if message.type == gst.MessageType.STREAM_START:
+                    failures = 0
+                    self.on_stream_start(playbin, gst)
+                elif message.type == gst.MessageType.EOS:
+                    self.set_state("finished")
+                    self.wait_for_playlist(generation)
+                    return self.generation if self.items else None
+                else:
+                    error, _debug = message.parse_error()
+                    failures += 1
+                    with self.condition:
+                        self.counters["errors"] += 1
+                        self.last_error = obscure_password(error.message)
+                        logging.error("Playlist item %s failed: %s",
+                                      self.index, self.last_error)
+                        give_up = failures >= len(self.items)
+                    if give_up or not self.skip(playbin, gst):
+                        self.set_state("failed")
+                        self.wait_for_playlist(generation)
+                        return self.generation if self.items else None
+        finally:
+            playbin.set_state(gst.State.NULL)
+            with self.condition:
+                self.index = None
+                self.cut_at = None
+
+    def on_about_to_finish(self, playbin):
+        """Queue the next item. Called from a GStreamer thread."""
+        with self.condition:
+            if self.index is None:
+                return
+            self.next_index = self.following(self.index)
+            if self.next_index is None:
+                return
+            playbin.set_property("uri", self.items[self.next_index].uri)
+
+    def on_stream_start(self, playbin, gst):
+        """An item started, so apply its duration."""
+        with self.condition:
+            if self.next_index is not None:
+                if self.next_index <= self.index:
+                    self.counters["loops"] += 1
+                self.index = self.next_index
+                self.next_index = None
+                self.counters["transitions"] += 1
+            self.started = time.monotonic()
+            self.state = "playing"
+            self.cut_at = None
+            duration = self.items[self.index].duration
+        if duration is None:
+            return
+        # End the segment at the duration. The item then drains and
+        # playbin moves on to the next one as at a natural end.
+        if not playbin.seek(
+            1.0, gst.Format.TIME, gst.SeekFlags.NONE,
+            gst.SeekType.NONE, 0,
+            gst.SeekType.SET, int(duration * gst.SECOND)
+        ):
+            with self.condition:
+                self.cut_at = self.started + duration
+
+    def skip(self, playbin, gst):
+        """Switch to the next item at once. Returns False at the end."""
+        with self.condition:
+            following = self.following(self.index)
+            if following is None:
+                return False
+            self.next_index = following
+            uri = self.items[following].uri
+            self.cut_at = None
+        playbin.set_state(gst.State.READY)
+        playbin.set_property("uri", uri)
+        playbin.set_state(gst.State.PLAYING)
+        return True
+
+    def on_sink_data(self, _pad, info):
+        """Measure the gap between items. Called for each video buffer."""
+        gst = self.gst
+        now = time.monotonic()
+        frames = self.frames
+        if info.type & gst.PadProbeType.EVENT_DOWNSTREAM:
+            if info.get_event().type == gst.EventType.STREAM_START:
+                frames["boundary"] = True
+            return gst.PadProbeReturn.OK
+        last = frames["last"]
+        if last is not None:
+            interval = (now - last) * 1000
+            if frames["boundary"]:
+                self.gaps_ms.append(round(interval, 1))
+            elif frames["interval_ms"] is None:
+                frames["interval_ms"] = interval
+            else:
+                frames["interval_ms"] += (
+                    interval - frames["interval_ms"]
+                ) / 30
+        frames["boundary"] = False
+        frames["last"] = now
+        return gst.PadProbeReturn.OK
+
+    def runner_loop(self):
+        """Thread that plays the playlists item by item with the runner."""
+        generation = 0
+        while True:
+            generation = self.wait_for_playlist(generation)
+            while generation is not None:
+                generation = self.play_with_runner(generation)
+            self.runner.stop()
+            self.set_state("stopped")
+            generation = self.generation
+
+    def play_with_runner(self, generation):
+        """Play the playlist of generation until it is replaced.
+
+        Returns the generation to play next, or None to stop.
+        """
+        with self.condition:
+            self.index = None
+        index = 0
+        while index is not None:
+            with self.condition:
+                if self.generation != generation:
+                    return self.generation if self.items else None
+                item = self.items[index]
+                video_sink, audio_sink = self.sinks
+                if self.index is not None:
+                    self.counters["transitions"] += 1
+                    if index <= self.index:
+                        self.counters["loops"] += 1
+                self.index = index
+                self.started = time.monotonic()
+                self.state = "playing"
+            with self.runner.condition:
+                starts = self.runner.counters["starts"]
+            self.runner.play_uri(item.uri, video_sink, audio_sink,
+                                 loop=False)
+            deadline = (
+                None if item.duration is None
+                else time.monotonic() + item.duration
+            )
+            state = self.wait_for_item(generation, deadline, starts)
+            if state == "crash_loop":
+                with self.condition:
+                    self.counters["errors"] += 1
+                    self.last_error = self.runner.status()["last_error"]
+            with self.condition:
+                index = self.following(index)
+        self.runner.stop()
+        with self.condition:
+            self.index = None
+        self.set_state("finished")
+        self.wait_for_playlist(generation)
+        return self.generation if self.items else None
+
+    def wait_for_item(self, generation, deadline, starts):
+        """Wait for the runner to finish an item or for its duration.
+
+        starts is the runner's start count before the item was asked
+        for. Returns the state of the runner.
+        """
+        runner = self.runner
+        while True:
+            with self.condition:
+                if self.generation != generation:
+                    return "replaced"
+            if deadline is not None and time.monotonic() >= deadline:
+                return "cut"
+            with runner.condition:
+                # The item must have started before it can finish
+                if (
+                    runner.state == "crash_loop"
+                    or runner.state == "finished"
+                    and runner.counters["starts"] > starts
+                ):
+                    return runner.state
+                runner.condition.wait(0.2)
+
+    def status(self):
+        """Return what the playlist is doing."""
+        with self.condition:
+            gaps = list(self.gaps_ms)
+            interval = self.frames["interval_ms"]
+            return {
+                "backend": "gst" if self.gst is not None else "gst-launch",
+                "gapless": self.gst is not None,
+                "state": self.state,
+                "loop": self.loop,
+                "index": self.index,
+                "items": [
+                    {"uri": obscure_password(item.uri),
+                     "duration": item.duration}
+                    for item in self.items
+                ],
+                "last_error": self.last_error,
+                "gaps_ms": {
+                    "count": len(gaps),
+                    "last": gaps[-1] if gaps else None,
+                    "max": max(gaps) if gaps else None,
+                    "mean": round(sum(gaps) / len(gaps), 1) if gaps else None,
+                    "frame_interval_ms": (
+                        round(interval, 1) if interval is not None else None
+                    ),
+                },
+                **self.counters,
+            }
+
@@ -0,0 +1,290 @@
+"""Module relay
+
+Talks to the KMTronic USB relay board on /dev/ttyUSB0. The port is opened
+and configured once, and one worker thread sends the commands in order so
+requests never share or reopen the port. The relay states are cached.
+
+Each relay is addressed with three bytes: 0xFF, the relay number and 0x01
+(on), 0x00 (off) or 0x03 (query). A query is answered with 0xFF, the relay
+number and the state.
+"""
+import logging
+import os
+import queue
+import select
+import termios
+import threading
+import time
+
+RELAY_OFF = 0x00
+RELAY_ON = 0x01
+RELAY_QUERY = 0x03
+
+
+# pylint: disable=too-many-instance-attributes
+class RelayBoard():
+    """Serial connection to the relay board.
+
+    The port is opened by the worker thread on first use. When it cannot be
+    opened, the commands fail at once and the open is retried after
+    retry_interval seconds.
+    """
+
+    def __init__(self, path="/dev/ttyUSB0", relays=(1, 2), read_timeout=0.5,
+                 retry_interval=5.0):
+        self.path = path
+        self.relays = tuple(relays)
+        self.read_timeout = read_timeout
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.commands = queue.Queue()
+        self.fd = None
+        self.retry_at = 0.0
+        self.error = None
+        self.states = {relay: None for relay in self.relays}
+        self.checked = None
+        self.query_ms = None
+        self.counters = {
+            "opens": 0,
+            "writes": 0,
+            "queries": 0,
+            "timeouts": 0,
+        }
+        self.thread = None
+
+    def start(self):
+        """Start the worker thread."""
+        self.thread = threading.Thread(
+            target=RelayBoard.worker,
+            args=(self, ),
+            name="relay",
+            daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        """Stop the worker and close the port."""
+        if self.thread is None:
+            return
+        self.commands.put(None)
+        self.thread.join()
+        self.thread = None
+
+    @property
+    def connected(self):
+        """Return True while the port is open."""
+        return self.fd is not None
+
+    def set(self, relay, on, timeout=1.0):
+        """Switch a relay on or off. Returns True once it was written."""
+        if relay not in self.relays:
+            raise ValueError(f"No relay {relay}")
+        return self.submit(("set", relay, on), timeout)
+
+    def get_states(self, max_age=1.0, timeout=1.0):
+        """Return {relay: state byte or None}.
+
+        The board is queried only when the cached states are older than
+        max_age seconds.
+        """
+        with self.lock:
+            checked = self.checked
+        if checked is None or time.monotonic() - checked > max_age:
+            self.submit(("query", None, None), timeout)
+        with self.lock:
+            return dict(self.states)
+
+    def submit(self, command, timeout):
+        """Queue a command and wait for the worker to run it.
+
+        A command still queued when the wait times out is cancelled, so a
+        switch reported as not done is never made later. One the worker
+        already took is waited for, as it is being written.
+        """
+        if self.thread is None:
+            return False
+        done = threading.Event()
+        ticket = {"state": "queued", "ok": False}
+        self.commands.put((command, done, ticket))
+        if not done.wait(timeout):
+            with self.lock:
+                if ticket["state"] == "queued":
+                    ticket["state"] = "cancelled"
+            if ticket["state"] == "cancelled":
+                logging.warning("Relay command %s timed out", command)
+                return False
+            done.wait()
+        return ticket["ok"]
+
+    def worker(self):
+        """Thread that runs the queued commands."""
+        while True:
+            entry = self.commands.get()
+            if entry is None:
+                break
+            # Take everything that queued up meanwhile, so the switches are
+            # written in order and the queries are answered by one read
+            batch = [entry]
+            while True:
+                try:
+                    entry = self.commands.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    self.commands.put(None)
+                    break
+                batch.append(entry)
+            self.run(batch)
+        self.close()
+
+    def run(self, batch):
+        """Run a batch of commands and wake up their callers.
+
+        Commands whose callers gave up waiting are skipped.
+        """
+        with self.lock:
+            batch = [entry for entry in batch
+                     if entry[2]["state"] != "cancelled"]
+            for _, _, ticket in batch:
+                ticket["state"] = "taken"
+        if not batch:
+            return
+        ok = self.open()
+        sets = [command for command, _, _ in batch if command[0] == "set"]
+        wants_query = len(sets) < len(batch)
+        try:
+            if ok and sets:
+                self.write(sets)
+            if ok and wants_query:
+                self.query()
+        except OSError as error:
+            logging.error("Relay board %s failed: %s", self.path, error)
+            self.error = str(error)
+            self.close()
+            ok = False
+        for _, done, ticket in batch:
+            ticket["ok"] = ok
+            done.set()
+
+    def open(self):
+        """Open and configure the port if needed. Returns success."""
+        if self.fd is not None:
+            return True
+        if time.monotonic() < self.retry_at:
+            return False
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        except OSError as error:
+            self.error = str(error)
+            self.retry_at = time.monotonic() + self.retry_interval
+            return False
+        try:
+            RelayBoard.configure(fd)
+        except (OSError, termios.error) as error:
+            os.close(fd)
+            self.error = str(error)
+            self.retry_at = time.monotonic() + self.retry_interval
+            return False
+        self.fd = fd
+        self.error = None
+        self.counters["opens"] += 1
+        logging.info("Opened relay board %s", self.path)
+        return True
+
+    def close(self):
+        """Close the port and forget the relay states."""
+        if self.fd is None:
+            return
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+        self.fd = None
+        self.retry_at = time.monotonic() + self.retry_interval
+        with self.lock:
+            self.states = {relay: None for relay in self.relays}
+            self.checked = None
+
+    @staticmethod
+    def configure(fd):
+        """Set the port to raw 9600 8N1 without flow control."""
+        attributes = termios.tcgetattr(fd)
+        attributes[0] = termios.IGNBRK                  # iflag
+        attributes[1] = 0                               # oflag
+        attributes[2] = termios.CS8 | termios.CREAD | termios.CLOCAL
+        attributes[3] = termios.NOFLSH                  # lflag
+        attributes[4] = termios.B9600                   # ispeed
+        attributes[5] = termios.B9600                   # ospeed
+        attributes[6][termios.VMIN] = 0
+        attributes[6][termios.VTIME] = 0
+        termios.tcsetattr(fd, termios.TCSANOW, attributes)
+        termios.tcflush(fd, termios.TCIOFLUSH)
+
+    def write(self, sets):
+        """Write the switch commands, in order, and cache the states."""
+        os.write(self.fd, b"".join(
+            bytes((0xFF, relay, RELAY_ON if on else RELAY_OFF))
+            for _, relay, on in sets
+        ))
+        self.counters["writes"] += len(sets)
+        with self.lock:
+            for _, relay, on in sets:
+                self.states[relay] = RELAY_ON if on else RELAY_OFF
+
+    def query(self):
+        """Query all relays at once and read the replies."""
+        started = time.monotonic()
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+        os.write(self.fd, b"".join(
+            bytes((0xFF, relay, RELAY_QUERY)) for relay in self.relays
+        ))
+        reply = self.read(3 * len(self.relays))
+        states = {relay: None for relay in self.relays}
+        index = 0
+        while index + 3 <= len(reply):
+            if reply[index] == 0xFF and reply[index + 1] in states:
+                states[reply[index + 1]] = reply[index + 2]
+                index += 3
+            else:
+                index += 1
+        if None in states.values():
+            self.counters["timeouts"] += 1
+            logging.warning("Relay board %s answered %s", self.path,
+                            reply.hex())
+        self.counters["queries"] += 1
+        with self.lock:
+            self.states = states
+            self.checked = time.monotonic()
+            self.query_ms = (self.checked - started) * 1000
+
+    def read(self, size):
+        """Read up to size bytes, waiting at most read_timeout."""
+        reply = bytearray()
+        deadline = time.monotonic() + self.read_timeout
+        while len(reply) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                break
+            chunk = os.read(self.fd, size - len(reply))
+            if not chunk:
+                raise OSError(f"{self.path} was closed")
+            reply += chunk
+        return bytes(reply)
+
+    def status(self):
+        """Return the connection and relay states."""
+        with self.lock:
+            return {
+                "path": self.path,
+                "connected": self.fd is not None,
+                "error": self.error,
+                "states": {
+                    str(relay): state for relay, state in self.states.items()
+                },
+                "query_ms": self.query_ms,
+                **self.counters,
+            }
+
@@ -4,14 +4,29 @@
 import os
 import json
 import time
-import requests
-import logging
 from collections import OrderedDict
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields, replace
 from typing import ClassVar
 from urllib.parse import urlparse
 from usbcaminfo import UsbCameraInfo
 from camera import Camera
+from device_settings import DeviceSettingsClient
+from camera_registry import CameraEntry
+from state_store import CameraState, StateStore
+
+# Camera state fields that hold a list
+CAMERA_STATE_LISTS = ("usb_cameras", "camera_added_list")
+
+
+def camera_state_property(name):
+    """Return a property for a field of the camera state."""
+    def getter(self):
+        return getattr(self.state.snapshot, name)
+
+    def setter(self, value):
+        self.update_camera_state(**{name: value})
+
+    return property(getter, setter)
 
 
 # pylint: disable=too-many-instance-attributes
@@ -38,6 +53,9 @@ class Settings:
         "that among these are Life, Liberty and the pursuit of Happiness."
     )
     volume: int = -20
+    device_settings: DeviceSettingsClient = field(
+        default_factory=DeviceSettingsClient
+    )
     VOLUME_MAX: ClassVar[int] = 0
     VOLUME_MIN: ClassVar[int] = -127
     voice: str = "English"
@@ -84,11 +102,6 @@ class Settings:
     audio_output_video_device: str = "default"
     audio_output_video: str = "default"
 
-    #
-    # Inputs Page
-    #
-    inputs_time: str = ""
-
     #
     # Outputs Page
     #
@@ -99,21 +112,37 @@ class Settings:
     #
     # Camera Page
     #
-    camera: Camera = Camera()
-    camera_source: str = ""
-    camera_info: dict = field(default_factory=dict)
-    camera_added_info: dict = field(default_factory=dict)
-    selected_camera: str = ""
-    camera_list: list = field(default_factory=list)
-    camera_added_list: list = field(default_factory=list)
-    selected_classifier: str = "none"
-    camera_resolution: str = "default"
+    camera: Camera = field(default_factory=Camera)
+    # The camera selection lives in an immutable snapshot that request
+    # threads read without locking. The attributes below read and write it.
+    state: StateStore = field(
+        default_factory=lambda: StateStore(CameraState())
+    )
+    usb_cameras = camera_state_property("usb_cameras")
+    cameras = camera_state_property("cameras")
+    camera_added_info = camera_state_property("camera_added_info")
+    camera_added_list = camera_state_property("camera_added_list")
+    selected_camera = camera_state_property("selected_camera")
+    camera_source = camera_state_property("camera_source")
+    selected_classifier = camera_state_property("selected_classifier")
+    camera_resolution = camera_state_property("camera_resolution")
+    camera_compression = camera_state_property("camera_compression")
+    fps_value = camera_state_property("fps_value")
+    usb_camera_pixel_format = camera_state_property("usb_camera_pixel_format")
+    usb_camera_resolution = camera_state_property("usb_camera_resolution")
+    usb_camera_frame_rate = camera_state_property("usb_camera_frame_rate")
+
+    @property
+    def camera_list(self):
+        """Names of all the cameras in order."""
+        return self.state.snapshot.cameras.names
+
+    CAMERAS_PER_PAGE: ClassVar[int] = 50
     CAMERA_RESOLUTIONS: ClassVar[list] = [
         "default",
         "320x240", "640x480", "800x600", "1024x768", "1280x960",
         "352x240", "640x360", "1024x576", "1280x720", "1920x1080", "2688x1520",
     ]
-    camera_compression: str = "default"
     CAMERA_COMPRESSIONS: ClassVar[list] = [
         "default",
         "0",
@@ -127,7 +156,6 @@ class Settings:
         "75",
         "100",
     ]
-    fps_value: str = "default"
     FPS_VALUES: ClassVar[list] = [
         "default",
         "0",
@@ -145,24 +173,108 @@ class Settings:
     ]
     camera_change: bool = False
     video_frame = None
-    usb_camera_info = UsbCameraInfo()
-    usb_cameras = usb_camera_info.get_devices_list()
-    usb_camera_pixel_format: str = ""
-    usb_camera_resolution: str = ""
-    usb_camera_frame_rate: str = ""
+    usb_camera_info: UsbCameraInfo = field(
+        default_factory=lambda: UsbCameraInfo(probe=False)
+    )
+
+    #
+    # State saved across restarts
+    #
+    SNAPSHOT_FIELDS: ClassVar[list] = [
+        "what_to_say",
+        "volume",
+        "voice",
+        "lang",
+        "audio_output_device",
+        "audio_output",
+        "audio_output_video_device",
+        "audio_output_video",
+        "output1",
+        "output2",
+        "camera_added_info",
+        "camera_added_list",
+        "selected_camera",
+        "selected_classifier",
+        "camera_resolution",
+        "camera_compression",
+        "fps_value",
+        "usb_cameras",
+        "usb_camera_pixel_format",
+        "usb_camera_resolution",
+        "usb_camera_frame_rate",
+    ]
 
     #
     # Method that runs after all variables are initialized
     #
     def __post_init__(self):
-        self.populate_audio_outputs()
         self.init_env_vars()
         self.device_has_hdmi = self.env['OPTRA_DEVICE_MODEL'][0] == 'v'
-        self.set_volume(self.volume)
+
+    def initializers(self):
+        """Return the slow initializers as (name, function, required).
+
+        They are run concurrently at startup.
+        """
+        return [
+            ("audio_outputs", self.populate_audio_outputs, True),
+            ("volume", self.init_volume, False),
+            ("usb_cameras", self.refresh_usb_cameras, True),
+        ]
 
     #
     # Support methods
     #
+    def to_snapshot(self):
+        """Return the state to save across restarts."""
+        snapshot = {
+            name: getattr(self, name) for name in self.SNAPSHOT_FIELDS
+        }
+        snapshot["twin"] = self.twin
+        return snapshot
+
+    def restore_snapshot(self, snapshot):
+        """Restore the state saved by to_snapshot().
+
+        The camera state and the cameras of every section are restored
+        in one transaction, so the selected camera is kept.
+        """
+        state_names = {item.name for item in fields(CameraState)}
+        changes = {}
+        for name in self.SNAPSHOT_FIELDS:
+            if name not in snapshot:
+                continue
+            if name in state_names:
+                changes[name] = snapshot[name]
+            else:
+                setattr(self, name, snapshot[name])
+        for name in CAMERA_STATE_LISTS:
+            if name in changes:
+                changes[name] = tuple(changes[name])
+        if snapshot.get("twin"):
+            self.twin = snapshot["twin"]
+        sensors = self.twin.get("desired", {}).get("device", {}).get(
+            "sensors", {}
+        )
+
+        # The last known cameras stand in until they are probed and the
+        # live twin is fetched
+        def restore(state):
+            state = replace(state, **changes)
+            return replace(
+                state,
+                cameras=state.cameras.with_section(
+                    "usb", Settings.usb_camera_entries(state.usb_cameras)
+                ).with_section(
+                    "twin", Settings.twin_camera_entries(sensors)
+                ).with_section(
+                    "added",
+                    Settings.added_camera_entries(state.camera_added_info)
+                )
+            )
+
+        self.transaction(restore)
+
     def populate_audio_outputs(self):
         """Populate audio outputs from aplay."""
         self.audio_outputs = []
@@ -181,34 +293,166 @@ class Settings:
         oenv = OrderedDict(sorted(self.env.items()))
         self.env_vars = json.dumps(oenv, indent=4)
 
+    def update_camera_state(self, **changes):
+        """Change fields of the camera state in one transaction."""
+        for name in CAMERA_STATE_LISTS:
+            if name in changes:
+                changes[name] = tuple(changes[name])
+        return self.transaction(lambda state: replace(state, **changes))
+
+    def transaction(self, func):
+        """Replace the camera state with func(state) atomically.
+
+        The selected camera and the camera source are derived from the
+        new state before it is published.
+        """
+        return self.state.transaction(
+            lambda state: self.derive_camera_state(func(state))
+        )
+
+    def derive_camera_state(self, state):
+        """Return state with the selected camera and what derives from it."""
+        cameras = state.cameras
+        if len(cameras) and cameras.find_name(state.selected_camera) is None:
+            state = replace(state, selected_camera=cameras.first().name)
+        state = self.with_usb_camera_options(state)
+        return replace(state, camera_source=Settings.camera_source_for(state))
+
+    def with_usb_camera_options(self, state):
+        """Return state with capture options the selected camera supports.
+
+        The state is unchanged if the camera has not been probed.
+        """
+        camera = state.selected_camera
+        pixel_formats = self.usb_camera_info.get_format_list(camera)
+        if not pixel_formats:
+            return state
+        pixel_format = state.usb_camera_pixel_format
+        if pixel_format not in pixel_formats:
+            pixel_format = pixel_formats[0]
+        resolution = ""
+        frame_rate = ""
+        resolutions = self.usb_camera_info.get_resolution_list(camera,
+                                                               pixel_format)
+        if resolutions:
+            resolution = state.usb_camera_resolution
+            if resolution not in resolutions:
+                resolution = resolutions[0]
+            frame_rates = self.usb_camera_info.get_fps_list(camera,
+                                                            pixel_format,
+                                                            resolution)
+            if frame_rates:
+                frame_rate = state.usb_camera_frame_rate
+                if frame_rate not in frame_rates:
+                    frame_rate = frame_rates[0]
+        return replace(state,
+                       usb_camera_pixel_format=pixel_format,
+                       usb_camera_resolution=resolution,
+                       usb_camera_frame_rate=frame_rate)
+
     def populate_attached_cameras(self):
         """Populate the attached cameras from the module twin."""
-        self.camera_info = {}
-        self.camera_list = []
+        self.transaction(self.with_attached_cameras)
+
+    def with_attached_cameras(self, state):
+        """Return state with the cameras from the module twin."""
+        sensors = self.twin["desired"]["device"]["sensors"]
+        return replace(state, cameras=state.cameras.with_section(
+            "twin", Settings.twin_camera_entries(sensors)
+        ))
+
+    @staticmethod
+    def twin_camera_entry(key, value):
+        """Return the registry entry for a twin sensor."""
+        return CameraEntry(key, value["name"], value["ip"], "twin")
+
+    @staticmethod
+    def twin_camera_entries(sensors):
+        """Return the registry entries for the twin sensors."""
+        return [Settings.twin_camera_entry(key, value)
+                for key, value in sensors.items()]
+
+    @staticmethod
+    def usb_camera_entries(devices):
+        """Return the registry entries for USB camera devices."""
+        return [CameraEntry(device, device, device, "usb")
+                for device in devices]
 
-        if self.usb_cameras:
-            self.camera_list = self.usb_cameras.copy()
+    @staticmethod
+    def added_camera_entries(camera_added_info):
+        """Return the registry entries for the added cameras."""
+        return [CameraEntry(key, value["name"], value["ip"], "added")
+                for key, value in camera_added_info.items()]
 
-        for key, value in (self.twin["desired"]
-                                    ["device"]
-                                    ["sensors"].items()):
-            self.camera_info[key] = {"name": value["name"],
-                                     "ip":   value["ip"]}
-            self.camera_list.append(value["name"])
+    def refresh_usb_cameras(self, force=False):
+        """Re-enumerate the USB cameras and return their info."""
+        info = self.usb_camera_info.refresh(force)
+        self.update_usb_cameras()
+        return info
 
-        self.camera_info.update(self.camera_added_info)
-        self.camera_list.extend(self.camera_added_list)
+    def usb_camera_added(self, device):
+        """Add a newly plugged in USB camera.
 
-        if self.camera_list and self.selected_camera not in self.camera_list:
-            self.selected_camera = self.camera_list[0]
+        Returns False if the device has no formats, or could not be probed.
+        """
+        if not self.usb_camera_info.add_device(device):
+            return False
+        self.update_usb_cameras()
+        return True
+
+    def usb_camera_removed(self, device):
+        """Remove an unplugged USB camera, stopping it if it is in use."""
+        self.usb_camera_info.remove_device(device)
+        if self.camera.source == device:
+            self.camera.stop()
+        self.update_usb_cameras()
+
+    def update_usb_cameras(self):
+        """Replace the USB cameras in the camera registry."""
+        usb_cameras = tuple(self.usb_camera_info.get_devices_list())
+        self.transaction(lambda state: replace(
+            state,
+            usb_cameras=usb_cameras,
+            cameras=state.cameras.with_section(
+                "usb", Settings.usb_camera_entries(usb_cameras)
+            )
+        ))
+
+    def twin_changed(self, twin, patch):
+        """Update the cameras from a twin cache change."""
+        self.twin = twin
+        if patch is None:
+            self.populate_attached_cameras()
+            return
+        sensors = patch.get("device", {}).get("sensors")
+        if sensors:
+            self.update_sensors(sensors.keys())
+
+    def update_sensors(self, keys):
+        """Update only the twin sensors that changed."""
+        sensors = self.twin["desired"]["device"].get("sensors", {})
+
+        upserts = [Settings.twin_camera_entry(key, sensors[key])
+                   for key in keys if sensors.get(key) is not None]
+        removals = [key for key in keys if sensors.get(key) is None]
+        self.transaction(lambda state: replace(
+            state,
+            cameras=state.cameras.with_changes("twin", upserts, removals)
+        ))
 
     def add_rtsp_camera(self, name, url):
         """Add an RTSP camera to the camera list."""
-        self.camera_added_info[str(time.time())] = {"name": name,
-                                                    "ip": url}
-        self.camera_added_list.append(name)
-        self.selected_camera = name
-        self.populate_attached_cameras()
+        key = str(time.time())
+        self.transaction(lambda state: replace(
+            state,
+            camera_added_info={**state.camera_added_info,
+                               key: {"name": name, "ip": url}},
+            camera_added_list=state.camera_added_list + (name, ),
+            cameras=state.cameras.with_changes(
+                "added", [CameraEntry(key, name, url, "added")]
+            ),
+            selected_camera=name
+        ))
 
     def usb_camera_width(self):
         """Return the usb camera width from usb_camera_resolution."""
@@ -224,49 +468,59 @@ class Settings:
 
     def set_camera_source(self):
         """Set the camera url based on the selected camera."""
-        if Camera.is_usb_cam(self.selected_camera):
-            self.camera_source = self.selected_camera
-            return
+        self.transaction(lambda state: state)
+
+    @staticmethod
+    def camera_source_for(state):
+        """Return the camera url for the selected camera in state."""
+        if Camera.is_usb_cam(state.selected_camera):
+            return state.selected_camera
 
-        for value in self.camera_info.values():
-            if value["name"] == self.selected_camera:
-                self.camera_source = value["ip"]
-                if "axis-media" in self.camera_source:
-                    separator = "?"
-                    if self.camera_resolution != "default":
-                        self.camera_source = (
-                            self.camera_source
-                            + separator
-                            + "resolution="
-                            + self.camera_resolution
-                        )
-                        separator = "&"
-                    if self.camera_compression != "default":
-                        self.camera_source = (
-                            self.camera_source
-                            + separator
-                            + "compression="
-                            + self.camera_compression
-                        )
-                        separator = "&"
-                    if self.fps_value != "default":
-                        self.camera_source = (
-                            self.camera_source
-                            + separator
-                            + "fps="
-                            + self.fps_value
-                        )
-                        separator = "&"
-                break
+        entry = state.cameras.find_name(state.selected_camera)
+        if entry is None:
+            return state.camera_source
+        camera_source = entry.url
+        if "axis-media" in camera_source:
+            separator = "?"
+            if state.camera_resolution != "default":
+                camera_source = (
+                    camera_source
+                    + separator
+                    + "resolution="
+                    + state.camera_resolution
+                )
+                separator = "&"
+            if state.camera_compression != "default":
+                camera_source = (
+                    camera_source
+                    + separator
+                    + "compression="
+                    + state.camera_compression
+                )
+                separator = "&"
+            if state.fps_value != "default":
+                camera_source = (
+                    camera_source
+                    + separator
+                    + "fps="
+                    + state.fps_value
+                )
+                separator = "&"
+        return camera_source
 
     def set_volume(self, vol):
-        """Set the volume of the headphone jack."""
+        """Set the volume of the headphone jack.
+
+        The device settings client sends it in the background.
+        """
         self.volume = vol
-        resp = requests.put('http://172.18.0.1:8080/webservices/noauth/settings',
-                            data='{"AudioVolume":' + str(vol) + '.0}',
-                            timeout=(3,5))
-        logging.info("Status: %s", resp.status_code)
-        logging.info("Content: %s",  resp.text)
+        self.device_settings.set_volume(vol)
+
+    def init_volume(self):
+        """Send the initial volume and wait for it to be delivered."""
+        self.set_volume(self.volume)
+        if not self.device_settings.flush(timeout=30):
+            raise RuntimeError("Volume was not delivered")
 
     def set_voice(self, value):
         """Set the voice for the gtts-cli program."""
@@ -276,9 +530,11 @@ class Settings:
         else:
             self.lang = self.VOICE_TO_LANG[value]
 
-    def get_camera_source_with_obscured_password(self):
+    def get_camera_source_with_obscured_password(self, camera_source=None):
         """Return the camera_source with the password obscured."""
-        parts = urlparse(self.camera_source)
+        if camera_source is None:
+            camera_source = self.camera_source
+        parts = urlparse(camera_source)
         if parts.password is not None:
             # split out the host portion manually. We could use
             # parts.hostname and parts.port, but then you'd have to check
@@ -289,4 +545,4 @@ class Settings:
             )
             return parts.geturl()
 
-        return self.camera_source
+        return camera_source
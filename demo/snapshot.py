@@ -0,0 +1,75 @@
+"""Module snapshot
+
+Persists application state to a file so a restart can resume where it
+left off.
+"""
+import json
+import logging
+import os
+import threading
+
+
+class SnapshotStore():
+    """Debounced, atomic JSON snapshot file.
+
+    schedule() asks for a save. The state is collected and written once
+    no further changes have been scheduled for debounce seconds.
+    """
+
+    def __init__(self, path, get_state, debounce=1.0):
+        self.path = path
+        self.get_state = get_state
+        self.debounce = debounce
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.timer = None
+        self.saves = 0
+
+    def load(self):
+        """Return the saved state, or None if there is none."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            logging.error("Could not load snapshot %s: %s", self.path, error)
+            return None
+
+    def schedule(self, *_args):
+        """Save the state after the debounce time."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.debounce, self.save)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def save(self):
+        """Write the state now, replacing the file atomically."""
+        with self.lock:
+            self.timer = None
+        tmp_path = self.path + ".tmp"
+        # The timer and flush() can save at once, and must not share the
+        # temporary file
+        with self.save_lock:
+            try:
+                data = json.dumps(self.get_state(), separators=(",", ":"))
+                with open(tmp_path, "w", encoding="utf-8") as file:
+                    file.write(data)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, self.path)
+                self.saves += 1
+            # pylint: disable=broad-except
+            except Exception as error:
+                logging.error("Could not save snapshot %s: %s",
+                              self.path, error)
+
+    def flush(self):
+        """Save now if a save is scheduled."""
+        with self.lock:
+            timer = self.timer
+        if timer is not None:
+            timer.cancel()
+            self.save()
@@ -0,0 +1,133 @@
+"""Module startup
+
+Runs the application initializers concurrently and reports readiness.
+"""
+import collections
+import logging
+import threading
+import time
+
+
+class Startup():
+    """Run named initializers in parallel and track their status.
+
+    The application is ready once every required initializer succeeded.
+    An initializer can wait for others to finish before it runs.
+    """
+
+    def __init__(self):
+        self.initializers = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.started = None
+        self.finished = None
+        self.all_done = threading.Event()
+
+    def add(self, name, func, required=True, after=()):
+        """Add an initializer to run at startup, after the named ones."""
+        self.initializers[name] = {
+            "func": func,
+            "required": required,
+            "after": tuple(after),
+            "done": threading.Event(),
+            "status": "pending",
+            "error": None,
+            "started": None,
+            "seconds": None,
+        }
+
+    def start(self):
+        """Start all the initializers without waiting for them.
+
+        Raises ValueError if an initializer runs after one that was
+        never added.
+        """
+        for name, initializer in self.initializers.items():
+            for dependency in initializer["after"]:
+                if dependency not in self.initializers:
+                    raise ValueError(f"Initializer {name} runs after "
+                                     f"unknown initializer {dependency}")
+        self.started = time.monotonic()
+        threads = []
+        for name in self.initializers:
+            thread = threading.Thread(
+                target=Startup.run,
+                args=(self, name),
+                name="init-" + name,
+                daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+        threading.Thread(
+            target=Startup.report,
+            args=(self, threads),
+            name="init-report",
+            daemon=True
+        ).start()
+
+    def run(self, name):
+        """Run one initializer once its dependencies finished."""
+        initializer = self.initializers[name]
+        for dependency in initializer["after"]:
+            self.initializers[dependency]["done"].wait()
+        with self.lock:
+            initializer["status"] = "running"
+            initializer["started"] = time.monotonic()
+        try:
+            initializer["func"]()
+            status = "succeeded"
+            error = None
+        # pylint: disable=broad-except
+        except Exception as exc:
+            logging.error("Startup initializer %s failed: %s", name, exc)
+            status = "failed"
+            error = str(exc)
+        with self.lock:
+            initializer["status"] = status
+            initializer["error"] = error
+            initializer["seconds"] = round(
+                time.monotonic() - initializer["started"], 3
+            )
+        initializer["done"].set()
+
+    def report(self, threads):
+        """Wait for the initializers and log the startup timing report."""
+        for thread in threads:
+            thread.join()
+        self.finished = time.monotonic()
+        self.all_done.set()
+        lines = [f"Startup finished in {self.finished - self.started:.3f}s"]
+        for name, initializer in self.initializers.items():
+            lines.append(
+                f"  {name:<20} {initializer['status']:<10} "
+                f"{initializer['seconds']}s"
+            )
+        logging.info("\n".join(lines))
+
+    def is_ready(self):
+        """Return True once every required initializer succeeded."""
+        return self.status()["ready"]
+
+    def status(self):
+        """Return the status and timing of each initializer."""
+        with self.lock:
+            elapsed = None
+            if self.started is not None:
+                end = self.finished or time.monotonic()
+                elapsed = round(end - self.started, 3)
+            return {
+                "ready": all(
+                    initializer["status"] == "succeeded"
+                    for initializer in self.initializers.values()
+                    if initializer["required"]
+                ),
+                "seconds": elapsed,
+                "initializers": {
+                    name: {
+                        "status": initializer["status"],
+                        "required": initializer["required"],
+                        "seconds": initializer["seconds"],
+                        "error": initializer["error"],
+                    }
+                    for name, initializer in self.initializers.items()
+                },
+            }
@@ -0,0 +1,85 @@
+"""Module state_store
+
+Copy-on-write store of immutable state snapshots.
+"""
+import collections
+import threading
+from dataclasses import dataclass, field
+from camera_registry import CameraRegistry
+from ordered_notify import deliver_changes
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass(frozen=True)
+class CameraState:
+    """Immutable snapshot of the camera selection state.
+
+    The dicts are never modified once they are in a snapshot; writers
+    build new ones.
+    """
+    usb_cameras: tuple = ()
+    cameras: CameraRegistry = field(default_factory=CameraRegistry)
+    camera_added_info: dict = field(default_factory=dict)
+    camera_added_list: tuple = ()
+    selected_camera: str = ""
+    camera_source: str = ""
+    selected_classifier: str = "none"
+    camera_resolution: str = "default"
+    camera_compression: str = "default"
+    fps_value: str = "default"
+    usb_camera_pixel_format: str = ""
+    usb_camera_resolution: str = ""
+    usb_camera_frame_rate: str = ""
+
+
+class StateStore():
+    """Holds the current immutable snapshot.
+
+    Readers take the snapshot without locking and always see a
+    consistent state. Writers run transactions one at a time, each
+    producing a new snapshot, and subscribers are told about every
+    change, in order. They are called after the write lock is released,
+    so a slow subscriber does not hold up the other writers.
+    """
+
+    def __init__(self, initial):
+        self.current = initial
+        self.version = 0
+        self.write_lock = threading.RLock()
+        self.subscribers = []
+        self.changes = collections.deque()
+        self.notify_lock = threading.Lock()
+
+    @property
+    def snapshot(self):
+        """Return the current snapshot."""
+        return self.current
+
+    def subscribe(self, callback):
+        """Call callback(old, new) after every change."""
+        self.subscribers.append(callback)
+
+    def transaction(self, func):
+        """Replace the snapshot with func(snapshot) atomically.
+
+        Returns the new snapshot.
+        """
+        with self.write_lock:
+            old = self.current
+            new = func(old)
+            if new == old:
+                return old
+            self.current = new
+            self.version += 1
+            self.changes.append((old, new))
+        self.notify()
+        return new
+
+    def notify(self):
+        """Tell the subscribers about the pending changes, in order.
+
+        Only one thread notifies at a time; a change made meanwhile is
+        delivered by the thread that is already notifying.
+        """
+        deliver_changes(self.changes, self.notify_lock, self.subscribers,
+                        "State subscriber")
@@ -0,0 +1,199 @@
+"""Module supervisor
+
+Launches child processes without a shell and keeps track of them by
+role, so they can be stopped without scanning the process table.
+"""
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+
+
+def obscure_password(text):
+    """Replace the passwords of the URLs in text."""
+    return re.sub(r"(://[^:/@\s]+:)[^/\s]*@", r"\1****@", text)
+
+
+# pylint: disable=too-many-instance-attributes
+class Child():
+    """A supervised child process.
+
+    A child that is restarted keeps its Child, with a new process.
+    """
+
+    def __init__(self, role, args, restart, on_exit, popen_kwargs):
+        self.role = role
+        self.args = list(args)
+        self.restart = restart
+        self.on_exit = on_exit
+        self.popen_kwargs = popen_kwargs
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.stopping = False
+        self.returncode = None
+
+    @property
+    def pid(self):
+        """Return the process id of the running process."""
+        return self.process.pid if self.process else None
+
+    def status(self):
+        """Return the state of the child."""
+        return {
+            "role": self.role,
+            "pid": self.pid,
+            "args": [obscure_password(arg) for arg in self.args],
+            "uptime": round(time.monotonic() - self.started, 1),
+            "restarts": self.restarts,
+        }
+
+
+class Supervisor():
+    """Registry of child processes by role.
+
+    Each child runs in its own process group and has a thread that waits
+    for it, so an exited child is reaped at once and never left a
+    zombie. Stopping a role sends SIGTERM to its process groups and
+    SIGKILL to those still running after stop_timeout seconds.
+    """
+
+    def __init__(self, stop_timeout=5.0, restart_delay=1.0):
+        self.stop_timeout = stop_timeout
+        self.restart_delay = restart_delay
+        self.lock = threading.Lock()
+        self.roles = {}
+        self.counters = {}
+
+    def launch(self, role, args, restart=False, on_exit=None, **kwargs):
+        """Start a child process and return its Child.
+
+        args is the argument list, run without a shell. A child with
+        restart is started again when it exits unless it was stopped.
+        on_exit(child, returncode) is called when a child exits and is
+        not restarted. Other keyword arguments go to subprocess.Popen.
+
+        Raises OSError if the program cannot be started.
+        """
+        child = Child(role, args, restart, on_exit, kwargs)
+        with self.lock:
+            self.spawn(child)
+            self.roles.setdefault(role, {})[id(child)] = child
+            self.count(role, "launched")
+        return child
+
+    def spawn(self, child):
+        """Start the process of a child. Call with the lock held."""
+        # pylint: disable=consider-using-with
+        child.process = subprocess.Popen(
+            child.args,
+            stdin=subprocess.DEVNULL,
+            start_new_session=True,
+            **child.popen_kwargs
+        )
+        child.started = time.monotonic()
+        logging.info("Started %s %s as %d", child.role, child.args[0],
+                     child.pid)
+        threading.Thread(
+            target=Supervisor.wait_for,
+            args=(self, child, child.process),
+            name=f"supervise-{child.role}-{child.pid}",
+            daemon=True
+        ).start()
+
+    def count(self, role, counter):
+        """Increment a counter of a role. Call with the lock held."""
+        counters = self.counters.setdefault(
+            role, {"launched": 0, "exited": 0, "restarts": 0}
+        )
+        counters[counter] += 1
+
+    def wait_for(self, child, process):
+        """Thread that reaps a child process and restarts it if asked."""
+        returncode = process.wait()
+        logging.info("%s %d exited with %d", child.role, process.pid,
+                     returncode)
+        with self.lock:
+            self.count(child.role, "exited")
+        if child.restart and not child.stopping:
+            time.sleep(self.restart_delay)
+        with self.lock:
+            if child.restart and not child.stopping:
+                try:
+                    self.spawn(child)
+                    child.restarts += 1
+                    self.count(child.role, "restarts")
+                    return
+                except OSError as error:
+                    logging.error("Could not restart %s: %s",
+                                  child.role, error)
+            child.returncode = returncode
+            self.roles.get(child.role, {}).pop(id(child), None)
+        if child.on_exit is not None:
+            child.on_exit(child, returncode)
+
+    def children(self, role):
+        """Return the running children of a role."""
+        with self.lock:
+            return list(self.roles.get(role, {}).values())
+
+    def stop(self, role, timeout=None):
+        """Stop every child of a role and wait for them to exit.
+
+        Returns the number of children stopped.
+        """
+        if timeout is None:
+            timeout = self.stop_timeout
+        with self.lock:
+            children = list(self.roles.get(role, {}).values())
+            for child in children:
+                child.stopping = True
+        for child in children:
+            Supervisor.signal(child, signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        for child in children:
+            try:
+                child.process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logging.warning("%s %d did not stop, killing it",
+                                role, child.pid)
+                Supervisor.signal(child, signal.SIGKILL)
+                child.process.wait()
+        return len(children)
+
+    @staticmethod
+    def signal(child, signum):
+        """Send a signal to the process group of a running child."""
+        if child.process.poll() is not None:
+            # Reaped, so its process id may belong to another process
+            return
+        try:
+            os.killpg(child.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def stop_all(self):
+        """Stop every child."""
+        with self.lock:
+            roles = list(self.roles)
+        for role in roles:
+            self.stop(role)
+
+    def status(self):
+        """Return the running children and the counters of each role."""
+        with self.lock:
+            return {
+                "children": [
+                    child.status()
+                    for children in self.roles.values()
+                    for child in children.values()
+                ],
+                "roles": {
+                    role: dict(counters)
+                    for role, counters in self.counters.items()
+                },
+            }
+
@@ -0,0 +1,180 @@
+"""Module tts_cache
+
+Disk cache of synthesized speech so repeated phrases are played without
+synthesizing them again.
+"""
+import collections
+import hashlib
+import logging
+import os
+import threading
+
+
+def gtts_synthesize(text, lang, path):
+    """Synthesize text to an MP3 file with Google Text-to-Speech.
+
+    gTTS is imported on first use so the cache works without it.
+    """
+    # pylint: disable=import-outside-toplevel
+    from gtts import gTTS
+    gTTS(text=text, lang=lang).save(path)
+
+
+# pylint: disable=too-many-instance-attributes
+class TtsCache():
+    """Size bounded LRU cache of MP3 speech keyed by (text, lang).
+
+    synthesize(text, lang, path) writes the speech for a miss to path;
+    it defaults to gTTS. The least recently used files are removed when
+    the cache grows past max_bytes. The recency order survives a restart
+    through the file modification times.
+    """
+
+    def __init__(self, directory, max_bytes=50 * 1024 * 1024,
+                 synthesize=gtts_synthesize):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.synthesize = synthesize
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.in_flight = {}
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "errors": 0,
+        }
+        self.load()
+
+    @staticmethod
+    def key(text, lang):
+        """Return the cache key of a phrase."""
+        return hashlib.sha256(f"{lang}\0{text}".encode()).hexdigest()
+
+    def path(self, key):
+        """Return the file of a cache key."""
+        return os.path.join(self.directory, key + ".mp3")
+
+    def load(self):
+        """Index the files already in the cache directory."""
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".mp3"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name[:-4], stat.st_size))
+        with self.lock:
+            for _, key, size in sorted(files):
+                self.entries[key] = size
+                self.size += size
+            self.evict()
+        logging.info("TTS cache has %d phrases, %d bytes",
+                     len(self.entries), self.size)
+
+    def lookup(self, text, lang):
+        """Return the file of a cached phrase, or None on a miss."""
+        key = TtsCache.key(text, lang)
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def get(self, text, lang):
+        """Return the MP3 file of a phrase, synthesizing it on a miss.
+
+        Concurrent misses for the same phrase synthesize it once.
+        """
+        key = TtsCache.key(text, lang)
+        while True:
+            path = self.lookup(text, lang)
+            if path is not None:
+                return path
+            with self.lock:
+                done = self.in_flight.get(key)
+                if done is None:
+                    done = self.in_flight[key] = threading.Event()
+                    break
+            done.wait()
+            with self.lock:
+                if key not in self.entries:
+                    raise RuntimeError(f"Could not synthesize {text!r}")
+
+        try:
+            return self.add(key, text, lang)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            done.set()
+
+    def add(self, key, text, lang):
+        """Synthesize a phrase into the cache and return its file."""
+        path = self.path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            self.synthesize(text, lang, tmp_path)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            with self.lock:
+                self.counters["errors"] += 1
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self.lock:
+            self.counters["misses"] += 1
+            self.entries[key] = size
+            self.size += size
+            self.evict()
+        return path
+
+    def evict(self):
+        """Remove the least recently used files while over max_bytes.
+
+        The newest phrase is always kept. Call with the lock held.
+        """
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.counters["evictions"] += 1
+            try:
+                os.remove(self.path(key))
+            except OSError as error:
+                logging.warning("Could not remove TTS file: %s", error)
+
+    def prewarm(self, phrases, lang):
+        """Synthesize the phrases that are not cached yet.
+
+        Returns the number synthesized.
+        """
+        synthesized = 0
+        for text in phrases:
+            if self.lookup(text, lang) is not None:
+                continue
+            try:
+                self.get(text, lang)
+                synthesized += 1
+            # pylint: disable=broad-except
+            except Exception as error:
+                logging.error("Could not prewarm %r: %s", text, error)
+        return synthesized
+
+    def stats(self):
+        """Return the cache counters."""
+        with self.lock:
+            return dict(self.counters,
+                        phrases=len(self.entries),
+                        bytes=self.size,
+                        max_bytes=self.max_bytes)
+
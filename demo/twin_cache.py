@@ -0,0 +1,160 @@
+"""Module twin_cache
+
+Keeps an in-memory copy of the module twin that is updated from desired
+property patches pushed by the hub.
+"""
+import collections
+import json
+import logging
+import threading
+from datetime import datetime
+from azure_iot import fetch_twin
+from ordered_notify import deliver_changes
+
+
+def merge_patch(base, patch):
+    """Return a copy of base with a twin patch applied. None removes a key.
+
+    Only the dictionaries along the patched paths are copied, so readers
+    holding the previous twin are never affected.
+    """
+    result = dict(base)
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        elif isinstance(value, dict) and isinstance(base.get(key), dict):
+            result[key] = merge_patch(base[key], value)
+        else:
+            result[key] = value
+    return result
+
+
+class TwinCache():
+    """Versioned cache of the module twin.
+
+    Listeners are called with (twin, patch) on every change, in version
+    order. patch is the desired property patch, or None when the whole
+    twin was replaced. A fetched twin older than the cached one is
+    ignored, so a fetch that was in flight cannot undo a newer patch.
+    A provisional twin, such as one restored from a snapshot, has no
+    version, and is replaced by the first twin fetched from the hub.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.twin = {"desired": {}, "reported": {}}
+        self.version = None
+        self.provisional = False
+        self.updated = ""
+        self.listeners = []
+        self.refreshing = False
+        self.changes = collections.deque()
+        self.notify_lock = threading.Lock()
+
+    def subscribe(self, listener):
+        """Call listener(twin, patch) whenever the twin changes."""
+        self.listeners.append(listener)
+
+    def start(self):
+        """Subscribe to desired property patches and fetch the twin."""
+        self.connection.add_patch_handler(self.apply_patch)
+        self.refresh()
+
+    def refresh(self):
+        """Fetch the full twin from the hub."""
+        self.set_twin(self.connection.call(fetch_twin))
+
+    def refresh_async(self):
+        """Fetch the full twin in the background."""
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        future = self.connection.submit(fetch_twin)
+        future.add_done_callback(self.refresh_done)
+
+    def refresh_done(self, future):
+        """Install the twin fetched by refresh_async()."""
+        with self.lock:
+            self.refreshing = False
+        try:
+            self.set_twin(future.result())
+        # pylint: disable=broad-except
+        except Exception as error:
+            logging.error("Twin refresh failed: %s", error)
+
+    def set_twin(self, twin, provisional=False):
+        """Replace the whole twin.
+
+        A provisional twin is ignored once the hub's twin is cached.
+        """
+        logging.info("Twin: \n%s", json.dumps(twin, indent=4))
+        version = None
+        if not provisional:
+            version = twin.get("desired", {}).get("$version")
+        refresh = False
+        with self.lock:
+            if provisional and self.updated:
+                logging.info("Ignoring provisional twin")
+                return
+            if (
+                version is not None
+                and self.version is not None
+                and version < self.version
+            ):
+                logging.info("Ignoring twin %s older than %s",
+                             version, self.version)
+                # Patches on a provisional twin do not make it current
+                refresh = self.provisional
+            else:
+                self.twin = twin
+                self.version = version
+                self.provisional = provisional
+                if not provisional:
+                    self.updated = datetime.now().strftime(
+                        "%Y/%m/%d %H:%M:%S"
+                    )
+                self.changes.append((twin, None))
+        self.notify()
+        if refresh:
+            self.refresh_async()
+
+    def apply_patch(self, patch):
+        """Apply a desired property patch pushed by the hub."""
+        version = patch.get("$version")
+        with self.lock:
+            if (
+                version is not None
+                and self.version is not None
+                and version <= self.version
+            ):
+                logging.info("Ignoring stale twin patch %s", version)
+                return
+            # Without a version the cache holds no fetched twin yet
+            missed = version is not None and (
+                self.version is None or version != self.version + 1
+            )
+            twin = dict(self.twin)
+            twin["desired"] = merge_patch(self.twin.get("desired", {}),
+                                          patch)
+            self.twin = twin
+            self.version = version
+            self.updated = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+            self.changes.append((twin, patch))
+        self.notify()
+
+        # A gap in the versions means a patch was missed while
+        # disconnected, so fetch the whole twin to catch up
+        if missed:
+            logging.info("Missed twin patches before %s, refreshing", version)
+            self.refresh_async()
+
+    def notify(self):
+        """Call the listeners with the pending changes, in order.
+
+        Only one thread notifies at a time; a change made meanwhile is
+        delivered by the thread that is already notifying.
+        """
+        deliver_changes(self.changes, self.notify_lock, self.listeners,
+                        "Twin listener")
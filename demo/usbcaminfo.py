@@ -1,29 +1,72 @@
 """Module usbcam
 """
+import os
+import re
 import subprocess
 import json
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 # pylint: disable=too-many-instance-attributes
 class UsbCameraInfo():
-    """Class to extract USB Camera information using v4l2-ctl."""
+    """Class to extract USB Camera information using v4l2-ctl.
+
+    The hotplug watcher and the refresh job change the info from their
+    own threads, so the cache and the camera list are changed under a
+    lock. Readers get the list or index that was current.
+    """
+
+    SYSFS_VIDEO = "/sys/class/video4linux"
+    MAX_PROBE_WORKERS = 8
 
     # pylint: disable=no-member
-    def __init__(self):
-        self.init_usb_camera_info()
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        run_command=None,
+        identify=None,
+        cache_path=None,
+        probe=True
+    ):
+        if run_command is None:
+            run_command = UsbCameraInfo.exec_cmd_return_output
+        if identify is None:
+            identify = UsbCameraInfo.device_identity
+        if cache_path is None:
+            cache_path = os.getenv("USB_CAMERA_CACHE",
+                                   "/tmp/usbcaminfo.json")
+        self.run_command = run_command
+        self.identify = identify
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.cache = self.load_cache()
+        self.usb_camera_info = []
+        self.index = {}
+        if probe:
+            self.init_usb_camera_info()
 
     @staticmethod
     def exec_cmd_return_output(command):
-        """Execute a command and return the output."""
+        """Execute a command and return the output.
+
+        A list is run directly, a string is run through the shell.
+        """
         lines = []
-        with subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-            shell=True
-        ) as cmdpipe:
+        try:
+            cmdpipe = subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                shell=isinstance(command, str)
+            )
+        except OSError as error:
+            logging.error("Command '%s' failed: %s", command, error)
+            return lines
+        with cmdpipe:
             stdout, stderr = cmdpipe.communicate()
             status = cmdpipe.wait()
             lines = stdout.splitlines()
@@ -33,8 +76,15 @@ class UsbCameraInfo():
                 logging.error(err)
         return lines
 
-    def refresh(self):
-        """Refresh the USB camera info."""
+    def refresh(self, force=False):
+        """Refresh the USB camera info.
+
+        Only devices not already in the cache are probed unless force is
+        set.
+        """
+        if force:
+            with self.lock:
+                self.cache = {}
         self.init_usb_camera_info()
         return self.usb_camera_info
 
@@ -44,55 +94,168 @@ class UsbCameraInfo():
 
     def get_devices_list(self):
         """Return the list of usb camera devices."""
-        devices_list = []
-        info = self.usb_camera_info
-        if info:
-            for cam in info:
-                devices_list.append(cam["Device"])
-        return devices_list
+        return list(self.index.keys())
 
     def get_format_list(self, device):
         """Return the list of formats for a device."""
-        pixel_format_list = []
-        info = self.usb_camera_info
-        if info:
-            for cam in info:
-                if cam["Device"] == device:
-                    for fmt in cam["Formats"]:
-                        pixel_format_list.append(fmt["Format"])
-        return pixel_format_list
+        return list(self.index.get(device, {}).keys())
 
     def get_resolution_list(self, device, pixel_format):
         """Return the list of resolutions for a device/format."""
-        resolution_list = []
-        info = self.usb_camera_info
-        # pylint: disable=too-many-nested-blocks
-        if info:
-            for cam in info:
-                if cam["Device"] == device:
-                    for fmt in cam["Formats"]:
-                        if fmt["Format"] == pixel_format:
-                            for res in fmt["Resolutions"]:
-                                resolution_list.append(res["Resolution"])
-        return resolution_list
+        return list(self.index.get(device, {}).get(pixel_format, {}).keys())
 
     def get_fps_list(self, device, pixel_format, resolution):
         """Return list of frame rates for device/format/resolution."""
-        fps_list = []
-        info = self.usb_camera_info
-        # pylint: disable=too-many-nested-blocks
-        if info:
-            for cam in info:
-                if cam["Device"] == device:
-                    for fmt in cam["Formats"]:
-                        if fmt["Format"] == pixel_format:
-                            for res in fmt["Resolutions"]:
-                                if res["Resolution"] == resolution:
-                                    if res["FrameRates"]:
-                                        for fps in res["FrameRates"]:
-                                            if fps not in fps_list:
-                                                fps_list.append(fps)
-        return fps_list
+        return list(
+            self.index.get(device, {})
+                      .get(pixel_format, {})
+                      .get(resolution, [])
+        )
+
+    def build_index(self):
+        """Index the camera info by device, format and resolution.
+
+        Call with the lock held.
+        """
+        index = {}
+        for cam in self.usb_camera_info:
+            formats = index.setdefault(cam["Device"], {})
+            for fmt in cam["Formats"]:
+                resolutions = formats.setdefault(fmt["Format"], {})
+                for res in fmt["Resolutions"]:
+                    fps_list = resolutions.setdefault(res["Resolution"], [])
+                    for fps in res["FrameRates"] or []:
+                        if fps not in fps_list:
+                            fps_list.append(fps)
+        self.index = index
+
+    @staticmethod
+    def device_identity(device):
+        """Return a key identifying the camera behind a device node.
+
+        The key is the USB vendor, product and serial, the bus path the
+        camera is plugged into, and the index of the node on the camera.
+        Returns None if sysfs does not describe the device.
+        """
+        node = os.path.join(UsbCameraInfo.SYSFS_VIDEO,
+                            os.path.basename(device))
+
+        def read(path):
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    return file.read().strip()
+            except OSError:
+                return ""
+
+        # device links to the USB interface, whose parent is the USB device
+        interface = os.path.realpath(os.path.join(node, "device"))
+        usb_device = os.path.dirname(interface)
+        vendor = read(os.path.join(usb_device, "idVendor"))
+        product = read(os.path.join(usb_device, "idProduct"))
+        if not vendor or not product:
+            return None
+        serial = read(os.path.join(usb_device, "serial"))
+        bus_path = os.path.basename(usb_device)
+        index = read(os.path.join(node, "index"))
+        return f"{vendor}:{product}:{serial}@{bus_path}#{index}"
+
+    def load_cache(self):
+        """Load the capability cache from disk."""
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self):
+        """Write the capability cache to disk atomically."""
+        if not self.cache_path:
+            return
+        tmp_path = self.cache_path + ".tmp"
+        # Only one thread writes the file at a time, and the cache is
+        # copied so the probes can go on changing it meanwhile
+        with self.save_lock:
+            with self.lock:
+                data = json.dumps(self.cache)
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as file:
+                    file.write(data)
+                os.replace(tmp_path, self.cache_path)
+            except OSError as error:
+                logging.info("Could not save USB camera cache: %s", error)
+
+    def probe_device(self, device):
+        """Return the formats for one device, from the cache if possible."""
+        identity = self.identify(device)
+        with self.lock:
+            if identity is not None and identity in self.cache:
+                return self.cache[identity]
+        formats = UsbCameraInfo.parse_formats_ext(
+            self.run_command(
+                ["v4l2-ctl", "-d", device, "--list-formats-ext"]
+            )
+        )
+        # An empty result is not cached: during hotplug the node can be
+        # busy or not yet readable, and the camera would stay hidden
+        if identity is not None and formats:
+            with self.lock:
+                self.cache[identity] = formats
+        return formats
+
+    def add_device(self, device):
+        """Probe one newly added device and add it to the info.
+
+        Returns True if the device is a camera with formats.
+        """
+        formats = self.probe_device(device)
+        self.save_cache()
+        if not formats:
+            return False
+        name = ""
+        node = os.path.join(self.SYSFS_VIDEO, os.path.basename(device))
+        try:
+            with open(os.path.join(node, "name"), "r",
+                      encoding="utf-8") as file:
+                name = file.read().strip()
+        except OSError:
+            pass
+        with self.lock:
+            usb_camera_info = [
+                cam for cam in self.usb_camera_info
+                if cam["Device"] != device
+            ]
+            usb_camera_info.append(
+                {
+                    "Device": device,
+                    "Name": name,
+                    "Formats": formats
+                }
+            )
+            usb_camera_info.sort(
+                key=lambda cam: UsbCameraInfo.device_sort_key(cam["Device"])
+            )
+            self.usb_camera_info = usb_camera_info
+            self.build_index()
+        return True
+
+    @staticmethod
+    def device_sort_key(device):
+        """Return a key that sorts /dev/video2 before /dev/video10."""
+        match = re.match(r"(.*?)(\d+)$", device)
+        if match is None:
+            return (device, -1)
+        return (match.group(1), int(match.group(2)))
+
+    def remove_device(self, device):
+        """Remove a device that has been unplugged from the info."""
+        with self.lock:
+            self.usb_camera_info = [
+                cam for cam in self.usb_camera_info
+                if cam["Device"] != device
+            ]
+            self.build_index()
 
     @staticmethod
     def width_from_resolution(resolution):
@@ -110,11 +273,76 @@ class UsbCameraInfo():
         numerator, denominator = float(frame_rate).as_integer_ratio()
         return str(numerator) + "/" + str(denominator)
 
-    # pylint: disable=too-many-locals
-    # pylint: disable=too-many-branches
+    @staticmethod
+    def parse_devices(lines):
+        """Parse the output of v4l2-ctl --list-devices."""
+        devices = []
+        prev_line = ""
+        for line in lines:
+            if line.strip()[0:10] == "/dev/video":
+                devices.append(
+                    {
+                        "Device": line.strip(),
+                        "Name": prev_line
+                    }
+                )
+            elif line.strip() and not line[0].isspace():
+                prev_line = line.rstrip()[:-1]
+        return devices
+
+    @staticmethod
+    def parse_formats_ext(lines):
+        """Parse the output of v4l2-ctl --list-formats-ext.
+
+        Returns the "Formats" list for the device.
+        """
+        formats = []
+        resolutions = None
+        frame_rates = None
+        for line in lines:
+            fields = line.strip().split(" ")
+            if "[" in line and "'" in line:
+                parsed_line = line.strip().split("'")
+                if len(parsed_line) < 2 or parsed_line[1] == "":
+                    logging.info("Bad Pixel Format line")
+                    # Pixel Format line not valid, so skip its sizes
+                    resolutions = None
+                    frame_rates = None
+                    continue
+                resolutions = []
+                frame_rates = None
+                formats.append(
+                    {
+                        "Format": parsed_line[1],
+                        "Resolutions": resolutions
+                    }
+                )
+            elif fields[0] == "Size:" and resolutions is not None:
+                resolution = fields[2]
+                width = resolution.split("x")[0]
+                height = resolution.split("x")[1]
+                frame_rates = []
+                resolutions.append(
+                    {
+                        "Resolution": width+"x"+height,
+                        "FrameRates": frame_rates
+                    }
+                )
+            elif (
+                fields[0] == "Interval:"
+                and fields[1] == "Discrete"
+                and frame_rates is not None
+            ):
+                frame_rates.append(fields[3][1:])
+        return formats
+
     def init_usb_camera_info(self):
         """Gets the USB Camera info from v4l2-ctl.
 
+        Runs v4l2-ctl once to list the devices and once per device to get
+        all of its formats, sizes and frame intervals. Devices are probed
+        in parallel and cached on disk by device identity.
+
         Example:
 
         [
@@ -126,8 +354,7 @@ class UsbCameraInfo():
                         "Format": "MJPG",
                         "Resolutions": [
                             {
-                                "Width": "1920",
-                                "Height": "1080",
+                                "Resolution": "1920x1080",
                                 "FrameRates": [
                                     "60.000",
                                     "30.000"
@@ -141,102 +368,64 @@ class UsbCameraInfo():
 
         """
 
-        self.usb_camera_info = []
-
-        cmd = "v4l2-ctl --list-devices"
-        lines = UsbCameraInfo.exec_cmd_return_output(cmd)
+        devices = UsbCameraInfo.parse_devices(
+            self.run_command(["v4l2-ctl", "--list-devices"])
+        )
 
-        prev_line = ""
-        for line in lines:
-            if line.strip()[0:10] == "/dev/video":
-                self.usb_camera_info.append(
-                    {
-                        "Device": line.strip(),
-                        "Name": prev_line
-                    }
+        # Probe the devices in parallel. Cameras already in the cache
+        # are not probed again.
+        with self.lock:
+            cached = len(self.cache)
+        if devices:
+            with ThreadPoolExecutor(
+                max_workers=min(len(devices), self.MAX_PROBE_WORKERS)
+            ) as executor:
+                all_formats = executor.map(
+                    self.probe_device,
+                    [cam["Device"] for cam in devices]
                 )
-            else:
-                prev_line = line[:-1]
-
-        # pylint: disable=too-many-nested-blocks
-        for cam in self.usb_camera_info:
-            # Get number following "/dev/video"
-            index = cam["Device"].split("video", 1)[1]
-
-            cmd = f"v4l2-ctl -d{index} --list-formats"
-            lines = UsbCameraInfo.exec_cmd_return_output(cmd)
-
-            cam["Formats"] = []
-
-            for line in lines:
-                if "[" in line:
-                    parsed_line = line.strip().split("'")
-                    if len(parsed_line) < 2 or parsed_line[1] == "":
-                        logging.info("Bad Pixel Format line")
-                        # Pixel Format line not valid, so continue
-                        continue
-                    pixel_format = parsed_line[1]
-                    pixel_format_index = len(cam["Formats"])
-                    fmts = cam["Formats"]
-                    fmts.append(
-                        {
-                            "Format": pixel_format,
-                            "Resolutions": []
-                        }
-                    )
-
-                    cmd = (
-                        f"v4l2-ctl -d{index} --list-framesizes={pixel_format}"
-                    )
-                    lines2 = UsbCameraInfo.exec_cmd_return_output(cmd)
-
-                    for line2 in lines2:
-                        if "Size" in line2:
-                            resolution = line2.strip().split(" ")[2]
-                            width = resolution.split("x")[0]
-                            height = resolution.split("x")[1]
-                            resolution_index = (
-                                len(
-                                    cam["Formats"]
-                                    [pixel_format_index]
-                                    ["Resolutions"]
-                                )
-                            )
-                            res = fmts[pixel_format_index]["Resolutions"]
-                            res.append(
-                                    {
-                                        "Resolution": width+"x"+height,
-                                        "FrameRates": []
-                                    }
-                            )
-
-                            cmd = (
-                                f"v4l2-ctl -d{index} --list-frameintervals="
-                                + f"width={width},"
-                                + f"height={height},"
-                                + f"pixelformat={pixel_format}"
-                            )
-                            lines3 = UsbCameraInfo.exec_cmd_return_output(cmd)
-
-                            for line3 in lines3:
-                                if "Interval" in line3:
-                                    frame_rate = (
-                                        line3.strip().split(" ")[3][1:]
-                                    )
-                                    frame_rates = (
-                                        res[resolution_index]["FrameRates"]
-                                    )
-                                    frame_rates.append(frame_rate)
+                for cam, formats in zip(devices, all_formats):
+                    cam["Formats"] = formats
+        with self.lock:
+            changed = len(self.cache) != cached
+        if changed:
+            self.save_cache()
 
         # Remove devices that do not have Formats
-        for cam in self.usb_camera_info:
-            if not cam["Formats"]:
+        usb_camera_info = []
+        for cam in devices:
+            if cam["Formats"]:
+                usb_camera_info.append(cam)
+            else:
                 logging.info(
                     "Removing device with no formats: %s",
                     json.dumps(cam, indent=4)
                 )
-                self.usb_camera_info.remove(cam)
+        with self.lock:
+            self.usb_camera_info = usb_camera_info
+            self.build_index()
+
+
+class FixtureCommandRunner():
+    """Replays recorded v4l2-ctl output instead of running v4l2-ctl.
+
+    The directory holds list-devices.txt and one videoN.txt per device
+    with the output of --list-formats-ext.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
 
+    def __call__(self, command):
+        if "--list-devices" in command:
+            name = "list-devices.txt"
+        else:
+            device = command[command.index("-d") + 1]
+            name = os.path.basename(device) + ".txt"
+        try:
+            with open(os.path.join(self.directory, name), "r",
+                      encoding="utf-8") as file:
+                return file.read().splitlines()
+        except OSError:
+            return []
 
-if __name__ == '__main__':
-    print(json.dumps(UsbCameraInfo().get_all(), indent=4))
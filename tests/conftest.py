@@ -0,0 +1,11 @@
+"""Test configuration.
+
+The demo modules import each other by name, as they do when demo.py
+runs from the demo directory, so that directory goes on the path.
+"""
+import os
+import sys
+
+DEMO_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "demo")
+sys.path.insert(0, DEMO_DIR)
@@ -0,0 +1,166 @@
+"""Tests for the audio engine, with a stand-in for mpg123."""
+import os
+import sys
+import time
+
+import pytest
+
+from audio_engine import PRIORITY_SPEECH, AudioEngine
+
+# Stand-in for mpg123 -R. A clip named "name-seconds" plays for that
+# many seconds. Every loaded clip is appended to the file in argv[1].
+FAKE_MPG123 = """
+import sys, threading
+timer = None
+def say(text):
+    print(text, flush=True)
+say("@R MPG123 (stand-in)")
+for line in sys.stdin:
+    command, _, argument = line.strip().partition(" ")
+    if command in ("LOAD", "STOP") and timer is not None:
+        timer.cancel()
+        say("@P 0")
+    if command == "LOAD":
+        with open(sys.argv[1], "a") as log:
+            log.write(argument + "\\n")
+        say("@P 2")
+        timer = threading.Timer(float(argument.rsplit("-", 1)[1]),
+                                say, ("@P 0", ))
+        timer.start()
+"""
+
+
+def wait_for(condition, timeout=10.0):
+    """Wait until condition() is true."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+@pytest.fixture(name="loaded")
+def fixture_loaded(tmp_path):
+    """The file the stand-in player logs the loaded clips to."""
+    return str(tmp_path / "loaded.txt")
+
+
+@pytest.fixture(name="engine")
+def fixture_engine(loaded):
+    """An engine whose players are the stand-in."""
+    return AudioEngine(command=(sys.executable, "-c", FAKE_MPG123, loaded))
+
+
+def clips(loaded):
+    """Return the clips the player loaded, in order."""
+    if not os.path.exists(loaded):
+        return []
+    with open(loaded, encoding="utf-8") as file:
+        return file.read().split()
+
+
+def status(engine):
+    """Return the status of the default player."""
+    return engine.player("default").status()
+
+
+def playing(engine, path):
+    """Return whether the default player is playing a clip."""
+    current = status(engine)["current"]
+    return (current is not None and current["path"] == path
+            and current["playing"])
+
+
+def idle(engine):
+    """Return whether the default player has nothing left to play."""
+    player_status = status(engine)
+    return player_status["current"] is None and not player_status["queue"]
+
+
+def test_clips_play_in_turn(engine, loaded):
+    assert engine.play("default", "bach-0.1")
+    assert engine.play("default", "vivaldi-0.1")
+    wait_for(lambda: status(engine)["played"] == 2)
+    assert clips(loaded) == ["bach-0.1", "vivaldi-0.1"]
+    assert status(engine)["start_latency_ms"] is not None
+
+
+def test_speech_preempts_music(engine, loaded):
+    engine.play("default", "bach-30")
+    wait_for(lambda: playing(engine, "bach-30"))
+    engine.play("default", "hello-0.1", PRIORITY_SPEECH)
+    wait_for(lambda: idle(engine))
+    assert clips(loaded) == ["bach-30", "hello-0.1"]
+    player_status = status(engine)
+    assert player_status["preempted"] == 1
+    assert player_status["played"] == 1
+
+
+def test_queue_is_in_priority_order(engine, loaded):
+    engine.play("default", "welcome-0.5", PRIORITY_SPEECH)
+    wait_for(lambda: playing(engine, "welcome-0.5"))
+    engine.play("default", "bach-0.1")
+    engine.play("default", "hello-0.1", PRIORITY_SPEECH)
+    assert status(engine)["queue"] == [
+        {"path": "hello-0.1", "priority": PRIORITY_SPEECH},
+        {"path": "bach-0.1", "priority": 0},
+    ]
+    wait_for(lambda: idle(engine))
+    assert clips(loaded) == ["welcome-0.5", "hello-0.1", "bach-0.1"]
+    assert status(engine)["preempted"] == 0
+
+
+def test_interrupt_drops_same_priority(engine, loaded):
+    engine.play("default", "bach-30")
+    wait_for(lambda: playing(engine, "bach-30"))
+    engine.play("default", "vivaldi-30")
+    engine.play("default", "mozart-0.1", interrupt=True)
+    wait_for(lambda: idle(engine))
+    assert clips(loaded) == ["bach-30", "mozart-0.1"]
+    assert status(engine)["preempted"] == 1
+
+
+def test_interrupt_keeps_higher_priority(engine, loaded):
+    engine.play("default", "welcome-0.5", PRIORITY_SPEECH)
+    wait_for(lambda: playing(engine, "welcome-0.5"))
+    engine.play("default", "hello-0.1", PRIORITY_SPEECH)
+    engine.play("default", "bach-0.1", interrupt=True)
+    wait_for(lambda: idle(engine))
+    assert clips(loaded) == ["welcome-0.5", "hello-0.1", "bach-0.1"]
+    assert status(engine)["preempted"] == 0
+
+
+def test_stop_drops_everything(engine, loaded):
+    engine.play("default", "bach-30")
+    engine.play("default", "vivaldi-30")
+    wait_for(lambda: playing(engine, "bach-30"))
+    engine.stop()
+    wait_for(lambda: idle(engine))
+    assert clips(loaded) == ["bach-30"]
+    assert status(engine)["stopped"] == 1
+
+
+def test_clip_prepared_before_stop_is_dropped(engine, loaded):
+    engine.prewarm(["default"])
+    generation = engine.generation
+    engine.stop()
+    assert not engine.play("default", "hello-0.1", PRIORITY_SPEECH,
+                           generation=generation)
+    assert engine.play("default", "hello-0.1", PRIORITY_SPEECH,
+                       generation=engine.generation)
+    wait_for(lambda: status(engine)["played"] == 1)
+    assert clips(loaded) == ["hello-0.1"]
+
+
+def test_dead_player_is_restarted(engine):
+    engine.prewarm(["default"])
+    pid = status(engine)["pid"]
+    engine.player("default").process.kill()
+    wait_for(lambda: status(engine)["restarts"] == 1)
+    assert status(engine)["pid"] != pid
+    assert engine.play("default", "hello-0.1")
+    wait_for(lambda: status(engine)["played"] == 1)
+
+
+def test_missing_player(tmp_path):
+    engine = AudioEngine(command=(str(tmp_path / "mpg123"), "-R"))
+    assert not engine.play("default", "hello-0.1")
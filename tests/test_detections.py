@@ -0,0 +1,74 @@
+"""Tests for the detection aggregator."""
+import pytest
+
+from detections import DetectionAggregator
+
+
+def test_frames_are_rolled_up_per_camera_and_classifier():
+    aggregator = DetectionAggregator(lambda summary: summary)
+    start = 1000.0
+    for frame in range(300):
+        aggregator.record("camera1", "face.xml", frame % 4,
+                          start + frame / 30)
+        aggregator.record("camera2", "eye.xml", 0, start + frame / 30)
+    summary = aggregator.flush(start + 10)
+
+    summaries = summary["detections"]["summaries"]
+    # A camera that detected nothing is left out
+    assert len(summaries) == 1
+    assert summaries[0]["camera"] == "camera1"
+    assert summaries[0]["classifier"] == "face.xml"
+    assert summaries[0]["frames"] == 300
+    assert summaries[0]["detections"] == 75 * (0 + 1 + 2 + 3)
+    assert summaries[0]["peak"] == 3
+    # Objects stayed in view after 3 of every 4 frames, except the last
+    assert summaries[0]["dwell"] == pytest.approx(224 / 30, abs=0.001)
+
+
+def test_flush_starts_a_new_window():
+    aggregator = DetectionAggregator(lambda summary: summary)
+    aggregator.record("camera1", "face.xml", 1, 1000.0)
+    assert aggregator.flush(1001.0) is not None
+    assert aggregator.flush(1002.0) is None
+
+
+def test_dwell_skips_stalled_stream():
+    aggregator = DetectionAggregator(lambda summary: summary, max_gap=1.0)
+    aggregator.record("camera1", "face.xml", 1, 1000.0)
+    aggregator.record("camera1", "face.xml", 1, 1000.5)
+    aggregator.record("camera1", "face.xml", 1, 1010.0)
+    summary = aggregator.flush(1011.0)
+    assert summary["detections"]["summaries"][0]["dwell"] == 0.5
+
+
+def test_emit_sends_one_message_per_window():
+    sent = []
+    aggregator = DetectionAggregator(
+        lambda summary: sent.append(summary) or summary
+    )
+    start = 1000.0
+    for frame in range(3000):
+        aggregator.record("camera1", "face.xml", 1, start + frame / 30)
+        if frame % 300 == 299:
+            aggregator.emit(start + frame / 30)
+    assert len(sent) == 10
+    assert aggregator.windows_sent == 10
+    assert aggregator.emit(start + 200) is None
+    assert len(sent) == 10
+
+
+def test_dropped_window_is_not_counted():
+    aggregator = DetectionAggregator(lambda summary: None)
+    aggregator.record("camera1", "face.xml", 1, 1000.0)
+    assert aggregator.emit(1001.0) is not None
+    assert aggregator.windows_sent == 0
+
+
+def test_failed_send_is_not_counted():
+    def fail(_summary):
+        raise ConnectionError("offline")
+
+    aggregator = DetectionAggregator(fail)
+    aggregator.record("camera1", "face.xml", 1, 1000.0)
+    aggregator.emit(1001.0)
+    assert aggregator.windows_sent == 0
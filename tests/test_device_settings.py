@@ -0,0 +1,97 @@
+"""Tests for the device settings client against a stand-in service."""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+
+# pylint: disable=wrong-import-position
+from device_settings import DeviceSettingsClient
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Stand-in for the device settings web service.
+
+    Answers with the server's queued statuses, then with 200.
+    """
+    protocol_version = "HTTP/1.1"
+
+    # pylint: disable=invalid-name
+    def do_PUT(self):
+        """Record the settings."""
+        length = int(self.headers["Content-Length"])
+        with self.server.lock:
+            self.server.received.append(json.loads(self.rfile.read(length)))
+            statuses = self.server.statuses
+            status = statuses.pop(0) if statuses else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *_args):
+        pass
+
+
+@pytest.fixture(name="server")
+def fixture_server():
+    """A running stand-in service."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.lock = threading.Lock()
+    server.received = []
+    server.statuses = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(name="client")
+def fixture_client(server):
+    """A client of the stand-in service."""
+    return DeviceSettingsClient(
+        f"http://127.0.0.1:{server.server_address[1]}/settings",
+        debounce=0.1,
+        backoff=0.01
+    )
+
+
+def test_slider_drag_is_sent_once(server, client):
+    for volume in range(-127, 1):
+        client.set_volume(volume)
+    assert client.flush(timeout=10)
+    assert server.received == [{"AudioVolume": 0.0}]
+    assert client.counters["requested"] == 128
+    assert client.counters["coalesced"] == 127
+    assert client.counters["sent"] == 1
+
+
+def test_server_error_is_retried(server, client):
+    server.statuses = [503, 500]
+    client.set_volume(-20)
+    assert client.flush(timeout=10)
+    assert len(server.received) == 3
+    assert client.counters["sent"] == 1
+
+
+def test_rejected_put_is_not_retried(server, client):
+    server.statuses = [400]
+    client.set_volume(-20)
+    assert not client.flush(timeout=10)
+    assert len(server.received) == 1
+    assert client.counters["failed"] == 1
+
+    # The next PUT reports its own outcome
+    client.set_volume(-10)
+    assert client.flush(timeout=10)
+    assert client.counters["sent"] == 1
+
+
+def test_gives_up_after_the_retries(server, client):
+    server.statuses = [500] * 4
+    client.set_volume(-20)
+    assert not client.flush(timeout=10)
+    assert len(server.received) == 4
+    assert client.counters["failed"] == 1
@@ -0,0 +1,53 @@
+"""Tests for the display service."""
+import importlib.util
+import shutil
+import subprocess
+import time
+
+import pytest
+
+from display import Display
+
+
+def test_resolution_is_none_without_display():
+    display = Display(name="")
+    display.start()
+    assert display.resolution() is None
+    assert display.status()["error"] == "DISPLAY is not set"
+    display.hide_pointer()
+    assert display.status()["pointer_hidden"] is None
+    display.stop()
+
+
+def test_unreachable_display_does_not_block():
+    display = Display(name=":987", retry_interval=60.0)
+    start = time.monotonic()
+    display.start()
+    assert display.resolution() is None
+    assert time.monotonic() - start < 2.0
+    assert not display.status()["connected"]
+    display.stop()
+
+
+@pytest.mark.skipif(
+    shutil.which("Xvfb") is None or importlib.util.find_spec("Xlib") is None,
+    reason="needs Xvfb and python-xlib"
+)
+def test_resolution_from_xvfb():
+    # A virtual X server whose only output is called "screen"
+    with subprocess.Popen(["Xvfb", ":98", "-screen", "0",
+                           "1280x720x24"]) as xvfb:
+        try:
+            display = Display(name=":98", output_prefix="")
+            deadline = time.monotonic() + 10
+            while not display.connect():
+                assert time.monotonic() < deadline, display.error
+                time.sleep(0.1)
+            assert display.resolution() == (1280, 720)
+            display.hide_pointer()
+            assert display.status()["pointer_hidden"] is True
+            display.show_pointer()
+            assert display.status()["pointer_hidden"] is False
+            display.stop()
+        finally:
+            xvfb.terminate()
@@ -0,0 +1,133 @@
+"""Tests for the output queue and its disk spool."""
+import json
+import time
+
+import pytest
+
+from azure_iot import LocalModuleClient, ModuleConnection
+from output_queue import OutputQueue, OutputSpool
+
+
+def wait_for(condition, timeout=10.0):
+    """Wait until condition() is true."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def counts(hub):
+    """Return the counts of the messages the hub received, in order."""
+    result = []
+    for _, text in hub.messages:
+        message = json.loads(text)
+        for item in message.get("batch", [message]):
+            result.append(item["data"]["count"])
+    return result
+
+
+@pytest.fixture(name="hub")
+def fixture_hub():
+    """A local stand-in hub."""
+    return LocalModuleClient()
+
+
+@pytest.fixture(name="connection")
+def fixture_connection(hub):
+    """A module connection to the stand-in hub."""
+    connection = ModuleConnection(lambda: hub, retries=0,
+                                  reconnect_delay=0.01)
+    yield connection
+    connection.stop()
+
+
+def test_spool_replays_in_order_after_a_restart(tmp_path):
+    path = str(tmp_path / "outputs.spool")
+    spool = OutputSpool(path)
+    for count in range(3):
+        assert spool.append([{"count": count}])
+    batch, offset = spool.peek()
+    assert batch == [{"count": 0}]
+    spool.commit(offset)
+
+    spool = OutputSpool(path)
+    batch, offset = spool.peek()
+    assert batch == [{"count": 1}]
+    spool.commit(offset)
+    batch, offset = spool.peek()
+    spool.commit(offset)
+    assert batch == [{"count": 2}]
+    # Drained, so the spool starts over
+    assert not spool.pending()
+    assert spool.size() == 0
+
+
+def test_spool_skips_a_corrupt_line(tmp_path):
+    path = tmp_path / "outputs.spool"
+    path.write_text('[{"count": 0}]\n[{"cou\n[{"count": 2}]\n',
+                    encoding="utf-8")
+    spool = OutputSpool(str(path))
+    batch, offset = spool.peek()
+    spool.commit(offset)
+    assert batch == [{"count": 0}]
+    batch, offset = spool.peek()
+    assert batch == [{"count": 2}]
+    assert spool.corrupt == 1
+
+
+def test_spool_ends_a_line_cut_short(tmp_path):
+    path = tmp_path / "outputs.spool"
+    path.write_text('[{"count": 0}]\n[{"cou', encoding="utf-8")
+    spool = OutputSpool(str(path))
+    spool.append([{"count": 2}])
+    spool.commit(spool.peek()[1])
+    assert spool.peek()[0] == [{"count": 2}]
+    assert spool.corrupt == 1
+
+
+def test_full_spool_drops_the_batch(tmp_path):
+    spool = OutputSpool(str(tmp_path / "outputs.spool"), max_bytes=40)
+    assert spool.append([{"count": 0}])
+    assert not spool.append([{"count": 1}, {"count": 2}])
+
+
+def test_overflow_is_dropped_when_the_spool_is_full(tmp_path, connection):
+    queue = OutputQueue(connection, spool_path=str(tmp_path / "spool"),
+                        max_queued=2)
+    queue.spool.max_bytes = 0
+    assert queue.put({"count": 0}) is not None
+    assert queue.put({"count": 1}) is not None
+    assert queue.put({"count": 2}, timeout=0.01) is None
+    assert queue.stats()["dropped"] == 3
+
+
+def test_spill_all_reports_a_dropped_batch(tmp_path, connection):
+    queue = OutputQueue(connection, spool_path=str(tmp_path / "spool"),
+                        batch_size=1)
+    results = iter([True, False, True])
+    queue.spool.append = lambda batch: next(results)
+    with queue.lock:
+        assert not queue.spill_all([{"count": 0}, {"count": 1},
+                                    {"count": 2}])
+
+
+def test_offline_outputs_are_spooled_and_sent_in_order(
+        tmp_path, hub, connection):
+    queue = OutputQueue(connection, spool_path=str(tmp_path / "spool"),
+                        max_queued=20, batch_size=10, batch_interval=0.05,
+                        retry_interval=0.1)
+    queue.start()
+    hub.online = False
+    for count in range(100):
+        assert queue.put({"count": count}, timeout=0.01) is not None
+    wait_for(lambda: queue.stats()["spilled"] > 0)
+    assert counts(hub) == []
+
+    hub.online = True
+    wait_for(lambda: len(counts(hub)) == 100)
+    queue.stop()
+    assert counts(hub) == list(range(100))
+    stats = queue.stats()
+    assert stats["sent"] == 100
+    assert stats["dropped"] == 0
+    assert stats["spoolBytes"] == 0
@@ -0,0 +1,166 @@
+"""Tests for the playlist player."""
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import playlist
+from pipeline import PipelineRunner, load_gst
+from playlist import PlaylistItem, PlaylistPlayer, find_media, parse_items
+from supervisor import Supervisor
+
+# Stand-in for gst-launch-1.0 that plays each item for 0.2 seconds
+FAKE_GST_LAUNCH = "import time; time.sleep(0.2)"
+
+# The parts of GStreamer the sink probe uses
+FAKE_GST = SimpleNamespace(
+    PadProbeType=SimpleNamespace(BUFFER=1, EVENT_DOWNSTREAM=2),
+    EventType=SimpleNamespace(STREAM_START="stream-start", EOS="eos"),
+    PadProbeReturn=SimpleNamespace(OK="ok"),
+)
+BUFFER = SimpleNamespace(type=FAKE_GST.PadProbeType.BUFFER)
+STREAM_START = SimpleNamespace(
+    type=FAKE_GST.PadProbeType.EVENT_DOWNSTREAM,
+    get_event=lambda: SimpleNamespace(type=FAKE_GST.EventType.STREAM_START)
+)
+
+
+def wait_for(condition, timeout=10.0):
+    """Wait until condition() is true."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+@pytest.fixture(name="media")
+def fixture_media(tmp_path):
+    """A media directory with two empty clips."""
+    for name in ("a.avi", "b.avi", "notes.txt"):
+        (tmp_path / name).write_bytes(b"")
+    return str(tmp_path)
+
+
+def test_find_media_lists_the_videos(media):
+    assert [item["name"] for item in find_media([media])] == ["a.avi",
+                                                              "b.avi"]
+
+
+def test_parse_items_rejects_paths_outside_the_media(media):
+    items = parse_items([{"path": "a.avi", "duration": 2}], [media])
+    assert items == [PlaylistItem("file://" + os.path.join(
+        os.path.realpath(media), "a.avi"), 2.0)]
+    with pytest.raises(ValueError):
+        parse_items([{"path": "../a.avi"}], [media])
+    with pytest.raises(ValueError):
+        parse_items([{"path": "a.avi", "duration": 0}], [media])
+    with pytest.raises(ValueError):
+        parse_items([], [media])
+
+
+def test_gap_statistics(monkeypatch):
+    player = PlaylistPlayer(None, use_gst=False)
+    player.gst = FAKE_GST
+    clock = [100.0]
+    monkeypatch.setattr(playlist.time, "monotonic", lambda: clock[0])
+
+    def frame(after_ms):
+        clock[0] += after_ms / 1000
+        assert player.on_sink_data(None, BUFFER) == "ok"
+
+    # An item at 30 fps, the next one starting 50 ms after its last
+    # frame, and a third one without a gap
+    for _ in range(10):
+        frame(1000 / 30)
+    player.on_sink_data(None, STREAM_START)
+    frame(50)
+    for _ in range(10):
+        frame(1000 / 30)
+    player.on_sink_data(None, STREAM_START)
+    frame(1000 / 30)
+
+    gaps = player.status()["gaps_ms"]
+    assert gaps["count"] == 2
+    assert gaps["last"] == 33.3
+    assert gaps["max"] == 50.0
+    assert gaps["mean"] == pytest.approx(41.65, abs=0.06)
+    assert gaps["frame_interval_ms"] == 33.3
+
+
+@pytest.fixture(name="runner")
+def fixture_runner():
+    """A pipeline runner using the stand-in gst-launch-1.0."""
+    supervisor = Supervisor(stop_timeout=1.0)
+    runner = PipelineRunner(
+        supervisor,
+        use_gst=False,
+        command=(sys.executable, "-c", FAKE_GST_LAUNCH)
+    )
+    runner.start()
+    yield runner
+    runner.stop()
+    supervisor.stop_all()
+
+
+def test_runner_plays_items_in_order(media, runner):
+    player = PlaylistPlayer(runner, use_gst=False)
+    player.start()
+    player.play(parse_items([{"path": "a.avi"}, {"path": "b.avi"}],
+                            [media]), loop=False)
+    wait_for(lambda: player.status()["state"] == "finished")
+    status = player.status()
+    assert status["transitions"] == 1
+    assert status["errors"] == 0
+    assert runner.status()["failures"] == 0
+    assert runner.status()["starts"] == 2
+    player.stop()
+    assert player.status()["state"] == "stopped"
+
+
+def test_runner_loops_the_playlist(media, runner):
+    player = PlaylistPlayer(runner, use_gst=False)
+    player.start()
+    player.play(parse_items([{"path": "a.avi"}, {"path": "b.avi"}],
+                            [media]), loop=True)
+    wait_for(lambda: player.status()["loops"] >= 1)
+    assert player.status()["state"] == "playing"
+    player.stop()
+
+
+@pytest.mark.skipif(load_gst() is None,
+                    reason="needs the GStreamer Python bindings")
+def test_gstreamer_playlist_is_gapless(tmp_path):
+    gst = load_gst()
+    # Two one second test clips, played headless with software sinks
+    # that keep to the clock
+    for name, pattern in (("a.avi", "smpte"), ("b.avi", "ball")):
+        clip = gst.parse_launch(
+            f"videotestsrc num-buffers=30 pattern={pattern} "
+            "! video/x-raw,width=320,height=240,framerate=30/1 "
+            "! jpegenc ! avimux ! filesink location="
+            + str(tmp_path / name)
+        )
+        clip.set_state(gst.State.PLAYING)
+        clip.get_bus().timed_pop_filtered(10 * gst.SECOND,
+                                          gst.MessageType.EOS)
+        clip.set_state(gst.State.NULL)
+
+    player = PlaylistPlayer(None)
+    player.start()
+    player.play(
+        parse_items([{"path": "a.avi"}, {"path": "b.avi"},
+                     {"path": "a.avi", "duration": 0.5}], [str(tmp_path)]),
+        loop=False,
+        video_sink="fakesink sync=true",
+        audio_sink="fakesink sync=true"
+    )
+    wait_for(lambda: player.status()["state"] == "finished", timeout=15)
+    status = player.status()
+    player.stop()
+    assert status["transitions"] == 2
+    assert status["gaps_ms"]["count"] == 2
+    # No more than a frame or two between the items
+    assert status["gaps_ms"]["max"] < 3 * status["gaps_ms"][
+        "frame_interval_ms"]
@@ -0,0 +1,133 @@
+"""Tests for the relay board, simulated on a pseudo-terminal."""
+import os
+import pty
+import threading
+import time
+
+import pytest
+
+from relay import RelayBoard, RELAY_OFF, RELAY_ON, RELAY_QUERY
+
+
+class BoardSimulator():
+    """Answers the commands like the relay board does.
+
+    Every byte written to the board is kept in received.
+    """
+
+    def __init__(self):
+        self.fd, self.board_fd = pty.openpty()
+        self.path = os.ttyname(self.board_fd)
+        self.states = {1: RELAY_OFF, 2: RELAY_OFF}
+        self.received = bytearray()
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        """Thread that reads the commands and answers the queries."""
+        pending = b""
+        while True:
+            try:
+                data = os.read(self.fd, 64)
+            except OSError:
+                return
+            with self.lock:
+                self.received += data
+            pending += data
+            while len(pending) >= 3:
+                if pending[0] != 0xFF:
+                    pending = pending[1:]
+                    continue
+                relay, command = pending[1], pending[2]
+                pending = pending[3:]
+                if command == RELAY_QUERY:
+                    os.write(self.fd,
+                             bytes((0xFF, relay, self.states.get(relay, 9))))
+                else:
+                    self.states[relay] = command
+
+    def wait_for(self, size, timeout=2.0):
+        """Return the bytes received once there are at least size."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                if len(self.received) >= size:
+                    return bytes(self.received)
+            assert time.monotonic() < deadline, "timed out"
+            time.sleep(0.01)
+
+    def close(self):
+        """Close both ends of the pseudo-terminal."""
+        os.close(self.board_fd)
+        os.close(self.fd)
+
+
+@pytest.fixture(name="simulator")
+def fixture_simulator():
+    """A simulated relay board."""
+    simulator = BoardSimulator()
+    yield simulator
+    simulator.close()
+
+
+@pytest.fixture(name="board")
+def fixture_board(simulator):
+    """A started RelayBoard on the simulated board."""
+    board = RelayBoard(simulator.path)
+    board.start()
+    yield board
+    board.stop()
+
+
+def test_switching_on_writes_the_command(simulator, board):
+    assert board.set(1, True)
+    assert simulator.wait_for(3) == b"\xff\x01\x01"
+    assert board.set(2, False)
+    assert simulator.wait_for(6)[3:] == b"\xff\x02\x00"
+
+
+def test_query_reads_the_states(simulator, board):
+    simulator.states[2] = RELAY_ON
+    assert board.get_states() == {1: RELAY_OFF, 2: RELAY_ON}
+    assert simulator.wait_for(6) == b"\xff\x01\x03\xff\x02\x03"
+    assert board.status()["queries"] == 1
+
+
+def test_states_are_cached(simulator, board):
+    board.get_states()
+    board.get_states(max_age=60)
+    assert board.status()["queries"] == 1
+    board.set(1, True)
+    assert board.get_states(max_age=60)[1] == RELAY_ON
+    assert board.get_states(max_age=0) == {1: RELAY_ON, 2: RELAY_OFF}
+    assert simulator.states == {1: RELAY_ON, 2: RELAY_OFF}
+    assert board.status()["opens"] == 1
+
+
+def test_unknown_relay_is_refused(board):
+    with pytest.raises(ValueError):
+        board.set(3, True)
+
+
+def test_missing_port_fails_at_once(tmp_path):
+    board = RelayBoard(str(tmp_path / "ttyUSB9"), retry_interval=60.0)
+    board.start()
+    start = time.monotonic()
+    assert not board.set(1, True)
+    assert board.get_states() == {1: None, 2: None}
+    assert time.monotonic() - start < 1.0
+    assert not board.status()["connected"]
+    board.stop()
+
+
+def test_timed_out_switch_is_never_made(simulator):
+    board = RelayBoard(simulator.path)
+    # Queue the switch while no worker runs, so the wait times out
+    board.thread = threading.current_thread()
+    assert not board.set(1, True, timeout=0.05)
+    board.thread = None
+    board.start()
+    assert board.get_states() == {1: RELAY_OFF, 2: RELAY_OFF}
+    board.stop()
+    assert simulator.wait_for(6) == b"\xff\x01\x03\xff\x02\x03"
+    assert simulator.states[1] == RELAY_OFF
@@ -0,0 +1,123 @@
+"""Tests for the TTS disk cache, with a stand-in synthesizer."""
+import os
+import threading
+import time
+
+import pytest
+
+from tts_cache import TtsCache
+
+
+class StandInSynthesizer():
+    """Writes 100 bytes of fake audio per phrase and counts the calls."""
+
+    def __init__(self, delay=0.0, fail=()):
+        self.delay = delay
+        self.fail = fail
+        self.calls = []
+
+    def __call__(self, text, lang, path):
+        self.calls.append((text, lang))
+        time.sleep(self.delay)
+        if text in self.fail:
+            raise OSError("Synthesis failed")
+        with open(path, "wb") as file:
+            file.write(f"{lang}:{text}".encode().ljust(100, b"\0"))
+
+
+@pytest.fixture(name="synthesize")
+def fixture_synthesize():
+    """A stand-in synthesizer."""
+    return StandInSynthesizer()
+
+
+def cached_keys(cache):
+    """Return the keys of the cached phrases from oldest to newest."""
+    return list(cache.entries)
+
+
+def test_miss_then_hit(tmp_path, synthesize):
+    cache = TtsCache(str(tmp_path), synthesize=synthesize)
+    path = cache.get("Hello", "en")
+    assert cache.get("Hello", "en") == path
+    assert os.path.getsize(path) == 100
+    assert synthesize.calls == [("Hello", "en")]
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 1
+    assert stats["bytes"] == 100
+
+
+def test_language_is_part_of_the_key(tmp_path, synthesize):
+    cache = TtsCache(str(tmp_path), synthesize=synthesize)
+    assert cache.get("Hello", "en") != cache.get("Hello", "fr")
+    assert len(synthesize.calls) == 2
+
+
+def test_least_recently_used_is_evicted(tmp_path, synthesize):
+    cache = TtsCache(str(tmp_path), max_bytes=300, synthesize=synthesize)
+    paths = {text: cache.get(text, "en") for text in ["a", "b", "c"]}
+    cache.get("a", "en")
+    cache.get("d", "en")
+    assert not os.path.exists(paths["b"])
+    assert os.path.exists(paths["a"])
+    assert cache.lookup("b", "en") is None
+    assert cached_keys(cache) == [TtsCache.key(text, "en")
+                                   for text in ["c", "a", "d"]]
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 300
+
+
+def test_newest_phrase_is_kept_when_too_big(tmp_path, synthesize):
+    cache = TtsCache(str(tmp_path), max_bytes=50, synthesize=synthesize)
+    cache.get("a", "en")
+    path = cache.get("b", "en")
+    assert os.path.exists(path)
+    assert cache.stats()["phrases"] == 1
+
+
+def test_recency_survives_a_restart(tmp_path, synthesize):
+    cache = TtsCache(str(tmp_path), synthesize=synthesize)
+    paths = [cache.get(text, "en") for text in ["a", "b", "c"]]
+    # a was used most recently, b least recently
+    for mtime, path in zip([300, 100, 200], paths):
+        os.utime(path, (mtime, mtime))
+    restarted = TtsCache(str(tmp_path), max_bytes=200,
+                         synthesize=synthesize)
+    assert cached_keys(restarted) == [TtsCache.key(text, "en")
+                                       for text in ["c", "a"]]
+    assert not os.path.exists(paths[1])
+
+
+def test_concurrent_misses_synthesize_once(tmp_path):
+    synthesize = StandInSynthesizer(delay=0.2)
+    cache = TtsCache(str(tmp_path), synthesize=synthesize)
+    paths = []
+    threads = [threading.Thread(
+        target=lambda: paths.append(cache.get("Hello", "en"))
+    ) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(paths)) == 1
+    assert len(paths) == 4
+    assert synthesize.calls == [("Hello", "en")]
+
+
+def test_failed_synthesis_leaves_nothing(tmp_path):
+    synthesize = StandInSynthesizer(fail=["Hello"])
+    cache = TtsCache(str(tmp_path), synthesize=synthesize)
+    with pytest.raises(OSError):
+        cache.get("Hello", "en")
+    assert os.listdir(tmp_path) == []
+    assert cache.stats()["errors"] == 1
+    assert cache.lookup("Hello", "en") is None
+
+
+def test_prewarm_synthesizes_the_missing_phrases(tmp_path):
+    synthesize = StandInSynthesizer(fail=["Broken"])
+    cache = TtsCache(str(tmp_path), synthesize=synthesize)
+    cache.get("Hello", "en")
+    assert cache.prewarm(["Hello", "Goodbye", "Broken"], "en") == 1
+    assert cache.lookup("Goodbye", "en") is not None
@@ -0,0 +1,136 @@
+"""Tests for the USB camera info, replaying recorded v4l2-ctl output."""
+import json
+import os
+
+import pytest
+
+from usbcaminfo import FixtureCommandRunner, UsbCameraInfo
+
+FIXTURES = os.path.join(os.path.dirname(__file__), os.pardir, "demo",
+                        "fixtures", "v4l2")
+
+NAME = "UVC Camera (0603:8612) (usb-3610000.xhci-2.1)"
+
+
+class RecordingRunner(FixtureCommandRunner):
+    """Replays the fixtures and records the commands."""
+
+    def __init__(self, directory=FIXTURES):
+        super().__init__(directory)
+        self.commands = []
+
+    def __call__(self, command):
+        self.commands.append(command)
+        return super().__call__(command)
+
+    def probed(self):
+        """Return the devices whose formats were listed."""
+        return [command[command.index("-d") + 1]
+                for command in self.commands if "-d" in command]
+
+
+@pytest.fixture(name="runner")
+def fixture_runner():
+    """A runner replaying the recorded v4l2-ctl output."""
+    return RecordingRunner()
+
+
+def test_replay_of_recorded_cameras(runner):
+    info = UsbCameraInfo(runner, cache_path="")
+    cameras = info.get_all()
+    # video1 is the metadata node of the same camera and has no formats
+    assert [(cam["Device"], cam["Name"]) for cam in cameras] == [
+        ("/dev/video0", NAME)
+    ]
+    assert sorted(runner.probed()) == ["/dev/video0", "/dev/video1"]
+    assert info.get_devices_list() == ["/dev/video0"]
+    assert info.get_format_list("/dev/video0") == ["MJPG", "YUYV"]
+    assert info.get_resolution_list("/dev/video0", "MJPG") == [
+        "1920x1080", "1280x720", "640x480"
+    ]
+    assert info.get_fps_list("/dev/video0", "MJPG", "640x480") == [
+        "120.101", "60.000", "30.000"
+    ]
+    assert info.get_fps_list("/dev/video0", "YUYV", "1920x1080") == [
+        "5.000"
+    ]
+    assert info.get_fps_list("/dev/video9", "MJPG", "640x480") == []
+
+
+def test_cached_cameras_are_not_probed_again(runner, tmp_path):
+    cache_path = str(tmp_path / "usbcaminfo.json")
+    first = UsbCameraInfo(runner, identify=lambda device: device,
+                          cache_path=cache_path)
+    with open(cache_path, "r", encoding="utf-8") as file:
+        # Devices without formats are not cached
+        assert list(json.load(file)) == ["/dev/video0"]
+
+    again = RecordingRunner()
+    second = UsbCameraInfo(again, identify=lambda device: device,
+                           cache_path=cache_path)
+    assert second.get_all() == first.get_all()
+    assert again.probed() == ["/dev/video1"]
+
+    second.refresh(force=True)
+    assert sorted(again.probed()) == [
+        "/dev/video0", "/dev/video1", "/dev/video1"
+    ]
+
+
+def test_hotplugged_cameras_are_sorted(runner):
+    info = UsbCameraInfo(runner, cache_path="", probe=False)
+    # Nothing was recorded for these nodes, so they have no formats
+    for device in ["/dev/video10", "/dev/video2"]:
+        assert not info.add_device(device)
+    video0 = os.path.join(FIXTURES, "video0.txt")
+    with open(video0, "r", encoding="utf-8") as file:
+        lines = file.read().splitlines()
+    info.run_command = lambda command: lines
+    for device in ["/dev/video10", "/dev/video2", "/dev/video0"]:
+        assert info.add_device(device)
+    assert info.get_devices_list() == [
+        "/dev/video0", "/dev/video2", "/dev/video10"
+    ]
+    info.remove_device("/dev/video2")
+    assert info.get_devices_list() == ["/dev/video0", "/dev/video10"]
+    assert info.get_format_list("/dev/video2") == []
+
+
+def test_parse_devices():
+    with open(os.path.join(FIXTURES, "list-devices.txt"), "r",
+              encoding="utf-8") as file:
+        lines = file.read().splitlines()
+    assert UsbCameraInfo.parse_devices(lines) == [
+        {"Device": "/dev/video0", "Name": NAME},
+        {"Device": "/dev/video1", "Name": NAME},
+    ]
+
+
+def test_parse_formats_skips_a_bad_pixel_format():
+    lines = [
+        "\t[0]: '' (broken)",
+        "\t\tSize: Discrete 640x480",
+        "\t\t\tInterval: Discrete 0.033s (30.000 fps)",
+        "\t[1]: 'YUYV' (YUYV 4:2:2)",
+        "\t\tSize: Discrete 320x240",
+        "\t\t\tInterval: Discrete 0.033s (30.000 fps)",
+    ]
+    assert UsbCameraInfo.parse_formats_ext(lines) == [
+        {"Format": "YUYV", "Resolutions": [
+            {"Resolution": "320x240", "FrameRates": ["30.000"]}
+        ]}
+    ]
+
+
+def test_device_sort_key():
+    devices = ["/dev/video10", "/dev/video2", "/dev/media0", "/dev/video"]
+    assert sorted(devices, key=UsbCameraInfo.device_sort_key) == [
+        "/dev/media0", "/dev/video", "/dev/video2", "/dev/video10"
+    ]
+
+
+def test_frame_rate_helpers():
+    assert UsbCameraInfo.fractional_frame_rate("30.000") == "30/1"
+    assert UsbCameraInfo.fractional_frame_rate("7.5") == "15/2"
+    assert UsbCameraInfo.width_from_resolution("1920x1080") == "1920"
+    assert UsbCameraInfo.height_from_resolution("1920x1080") == "1080"